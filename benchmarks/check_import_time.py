@@ -0,0 +1,124 @@
+"""
+CHECK_IMPORT_TIME Script
+------------------------
+
+@author : Stratoshad
+
+Checks that importing the src modules
+stays cheap. Every module is imported in
+a fresh interpreter and the check fails if
+it takes longer than its budget or pulls
+in one of the heavy dependencies (plotly,
+sklearn, scipy, tqdm) at import time.
+
+Usage:
+
+    python benchmarks/check_import_time.py
+    python benchmarks/check_import_time.py --budget 0.8
+
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+
+# Budgets in seconds. pandas itself takes most
+# of it so these leave room for slower machines
+BUDGETS = {
+    "src.features.build_features": 1.0,
+    "src.data.utils": 1.0,
+    "src.models.modeling": 1.0,
+    "src.visualization.visualize": 1.0,
+}
+
+HEAVY_MODULES = ["plotly", "sklearn", "scipy", "tqdm", "joblib"]
+
+_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure_import(module, repeat=3):
+
+    """
+    Imports a module in a fresh interpreter
+    a few times and keeps the fastest run.
+
+    Parameters:
+    -----------
+
+    module : str
+
+    The dotted module name
+
+    repeat : int (default = 3)
+
+    The number of fresh imports
+
+    Returns:
+    --------
+
+    result : dictionary
+
+    The best import time in seconds and
+    the heavy modules that got imported
+
+    """
+
+    runs = []
+
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    best = min(runs, key=lambda r: r["seconds"])
+
+    return {"seconds": round(best["seconds"], 3), "heavy": best["heavy"]}
+
+
+def main(argv=None):
+
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(description="Check the src import times.")
+    parser.add_argument(
+        "--budget", type=float, default=None, help="Override every module's budget"
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+
+    for module, budget in BUDGETS.items():
+
+        budget = args.budget if args.budget is not None else budget
+        result = measure_import(module)
+        ok = (result["seconds"] <= budget) and (len(result["heavy"]) == 0)
+        failed |= not ok
+
+        print(
+            f"{'OK  ' if ok else 'FAIL'} {module:<32} {result['seconds']:.3f}s "
+            f"(budget {budget:.2f}s) heavy imports: {result['heavy'] or 'none'}"
+        )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
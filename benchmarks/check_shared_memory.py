@@ -0,0 +1,123 @@
+"""
+CHECK_SHARED_MEMORY Script
+--------------------------
+
+@author : Stratoshad
+
+Checks the shared memory hand-off of
+src.data.utils (publish_dataframe and
+attach_dataframe). Every case runs in a
+fresh interpreter so a crash (e.g. reading
+an unmapped block) fails the case rather
+than the script.
+
+Usage:
+
+    python benchmarks/check_shared_memory.py
+
+"""
+
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+
+_SETUP = """
+import pickle
+import numpy as np
+import pandas as pd
+from src.data import utils
+"""
+
+# Every case prints "ok" when it passes
+CASES = {
+    "read_after_release": """
+df = pd.DataFrame({"a": np.arange(1000.0), "s": ["x", "y"] * 500})
+handle = utils.publish_dataframe(df)
+df_shared = utils.attach_dataframe(handle)
+utils.release_dataframe(handle)
+assert df_shared["a"].sum() == df["a"].sum()
+assert list(df_shared["s"].astype(str)) == list(df["s"])
+print("ok")
+""",
+    "context_manager": """
+df = pd.DataFrame({"a": np.arange(10), "b": np.linspace(0, 1, 10)})
+with utils.shared_dataframe(df) as handle:
+    df_shared = utils.attach_dataframe(handle)
+    pd.testing.assert_frame_equal(df_shared, df)
+assert df_shared["b"].max() == 1
+print("ok")
+""",
+    "column_types": """
+n = 1000
+dates = pd.date_range("2011-01-01", periods=n, freq="h")
+df = pd.DataFrame(
+    {
+        "int": np.arange(n),
+        "nullable": pd.array([None if i % 7 else i for i in range(n)], "Int64"),
+        "flag": pd.array([None if i % 5 else i % 2 == 0 for i in range(n)], "boolean"),
+        "date": dates,
+        "date_tz": dates.tz_localize("Europe/London"),
+        "cat": pd.Categorical(["b", "a"] * (n // 2), ["b", "a"], ordered=True),
+        "text": [None if i % 9 == 0 else f"t{i % 13}" for i in range(n)],
+    },
+    index=pd.Index([f"id{i}" for i in range(n)], name="key"),
+)
+handle = utils.publish_dataframe(df)
+df_shared = utils.attach_dataframe(handle, categorical=False)
+pd.testing.assert_frame_equal(df_shared, df)
+assert str(df_shared["nullable"].dtype) == "Int64"
+# The handle holds no data however many distinct keys there are
+assert len(pickle.dumps(handle)) < 4000
+utils.release_dataframe(handle)
+print("ok")
+""",
+}
+
+
+def run_case(name):
+
+    """
+    Runs a case in a fresh interpreter
+    and returns its exit code and output
+    """
+
+    out = subprocess.run(
+        [sys.executable, "-c", _SETUP + CASES[name]],
+        cwd=PROJECT_DIR,
+        capture_output=True,
+        text=True,
+    )
+
+    return out.returncode, (out.stdout + out.stderr).strip()
+
+
+def main(argv=None):
+
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(description="Check the shared memory hand-off.")
+    parser.add_argument("--case", nargs="+", choices=list(CASES), default=None)
+    args = parser.parse_args(argv)
+
+    failed = False
+
+    for name in args.case or list(CASES):
+
+        code, output = run_case(name)
+        ok = (code == 0) and output.endswith("ok")
+        failed |= not ok
+
+        print(f"{'OK  ' if ok else 'FAIL'} {name:<24} exit code {code}")
+        if not ok:
+            print(output)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+"""
+RUN_BENCHMARKS Script
+---------------------
+
+@author : Stratoshad
+
+Times the main src functions on synthetic
+"Online Retail" data of different sizes and
+appends the results (time and peak memory)
+to a JSON history file so that runs from
+different commits can be compared.
+
+Every benchmark runs in a fresh process so
+that the peak memory of one doesn't leak
+into the next.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --sizes 10k 1m
+    python benchmarks/run_benchmarks.py --compare
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+HISTORY_PATH = PROJECT_DIR / "benchmarks" / "history.json"
+
+if str(PROJECT_DIR) not in sys.path:
+    sys.path.insert(0, str(PROJECT_DIR))
+
+SIZES = {"10k": 10000, "100k": 100000, "1m": 1000000, "10m": 10000000}
+
+# Functions that are still quadratic (one pass over
+# the data per cancellation / customer) are capped so
+# a full run finishes. Use --no-limits to lift them.
+ROW_LIMITS = {
+    "process_cancellations": 100000,
+    "process_customer_data": 1000000,
+}
+
+
+def _peak_rss_mb():
+
+    """
+    Returns the peak RSS of the current
+    process in MB (None on Windows)
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+
+    return peak / 1024
+
+
+def _prepare_raw(n_rows):
+
+    """
+    Synthetic raw data with the cancellation
+    flag and filled in CustomerIDs as NB1 does
+    """
+
+    from src.data.synthetic import make_online_retail
+
+    df = make_online_retail(n_rows=n_rows)
+    df["Cancelled"] = df["InvoiceNo"].str.startswith("C").astype(int)
+    df["CustomerID"] = df["CustomerID"].astype(object).where(
+        df["CustomerID"].notnull(), "00000"
+    )
+
+    return df
+
+
+def _prepare_tables(n_rows):
+
+    """
+    Customer and invoice tables built
+    from synthetic data as NB1 does
+    """
+
+    df = _prepare_raw(n_rows)
+    df = df.loc[(df["Cancelled"] == 0) & (df["CustomerID"] != "00000")]
+    df = df.assign(total_price=df["Quantity"] * df["UnitPrice"])
+
+    df_inv = (
+        df.groupby(["InvoiceNo", "CustomerID"])
+        .agg(invc_date=("InvoiceDate", "min"), revenue=("total_price", "sum"))
+        .reset_index()
+        .rename(columns={"InvoiceNo": "invc_num", "CustomerID": "customer_id"})
+    )
+    df_inv["invc_date"] = df_inv["invc_date"].dt.strftime("%Y-%m-%d %H:%M:%S")
+
+    df_cust = (
+        df.groupby("CustomerID")
+        .agg(
+            orders=("InvoiceNo", "nunique"),
+            first_purchase=("InvoiceDate", "min"),
+            last_purchase=("InvoiceDate", "max"),
+            quantity=("Quantity", "sum"),
+            total_spend=("total_price", "sum"),
+        )
+        .reset_index()
+        .rename(columns={"CustomerID": "customer_id"})
+    )
+
+    return df_cust, df_inv
+
+
+def _prepare_features(n_rows):
+
+    """
+    Log-normal customer features (one
+    row per customer) for the clustering
+    """
+
+    import numpy as np
+    import pandas as pd
+    from src.models import modeling
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.lognormal(size=(n_rows, 4)),
+        columns=["orders", "total_spend", "time_inactive", "lifetime"],
+    )
+
+    return modeling.log_scale_dataset(df)
+
+
+def _run_case(name, n_rows):
+
+    """
+    Prepares the data for a benchmark, runs
+    it once and returns its time and memory.
+    Runs inside a fresh worker process.
+    """
+
+    from src.features import build_features
+    from src.models import modeling
+    from src.visualization import visualize
+
+    cases = {
+        "process_cancellations": (
+            _prepare_raw,
+            lambda df: build_features.process_cancellations(df),
+        ),
+        "get_df_date_features": (
+            _prepare_raw,
+            lambda df: build_features.get_df_date_features(df, "InvoiceDate"),
+        ),
+        "process_customer_data": (
+            _prepare_tables,
+            lambda t: build_features.process_customer_data(df_cust=t[0], df_inv=t[1]),
+        ),
+        "run_elbow_method": (
+            _prepare_features,
+            lambda df: modeling.run_elbow_method(df, max_clusters=6, engine="sampled"),
+        ),
+        "make_histogram": (
+            _prepare_raw,
+            lambda df: visualize.make_histogram(
+                df, "UnitPrice", "Country", cap=True, prebinned=True
+            ),
+        ),
+        "make_scatter": (
+            _prepare_raw,
+            lambda df: visualize.make_scatter(
+                df, "Quantity", "UnitPrice", "Quantity vs Price", "Country"
+            ),
+        ),
+    }
+
+    prepare, run = cases[name]
+    data = prepare(n_rows)
+
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    run(data)
+    seconds = time.perf_counter() - start
+    rss_after = _peak_rss_mb()
+
+    return {
+        "seconds": round(seconds, 4),
+        "peak_rss_mb": None if rss_after is None else round(rss_after, 1),
+        "peak_rss_delta_mb": None
+        if rss_after is None
+        else round(rss_after - rss_before, 1),
+    }
+
+
+BENCHMARKS = [
+    "process_cancellations",
+    "get_df_date_features",
+    "process_customer_data",
+    "run_elbow_method",
+    "make_histogram",
+    "make_scatter",
+]
+
+
+def _git_commit():
+
+    """
+    Returns the current git commit
+    (or None outside a repository)
+    """
+
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, names=None, limits=True):
+
+    """
+    Runs every benchmark for every size,
+    each in a fresh process.
+
+    Parameters:
+    -----------
+
+    sizes : list
+
+    Size labels (e.g. ["10k", "1m"])
+
+    names : list (default = None)
+
+    The benchmarks to run. If
+    None runs all of them.
+
+    limits : bool (default = True)
+
+    Skip sizes above ROW_LIMITS
+
+    Returns:
+    --------
+
+    results : list
+
+    One dictionary per benchmark and size
+
+    """
+
+    names = BENCHMARKS if names is None else names
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+
+    for name in names:
+        for size in sizes:
+
+            n_rows = SIZES[size]
+            result = {"benchmark": name, "size": size, "n_rows": n_rows}
+
+            if limits and n_rows > ROW_LIMITS.get(name, float("inf")):
+                result["status"] = "skipped"
+                results.append(result)
+                print(f"{name:<25} {size:>5} skipped (over the row limit)")
+                continue
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                try:
+                    result.update(executor.submit(_run_case, name, n_rows).result())
+                    result["status"] = "ok"
+                except Exception as e:
+                    result["status"] = "error"
+                    result["error"] = f"{type(e).__name__}: {e}"
+
+            results.append(result)
+            print(
+                f"{name:<25} {size:>5} {result['status']:<6} "
+                f"{result.get('seconds', '')} s {result.get('peak_rss_mb', '')} MB"
+            )
+
+    return results
+
+
+def load_history(path=HISTORY_PATH):
+
+    """
+    Loads the list of previous runs
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_run(results, path=HISTORY_PATH):
+
+    """
+    Appends a run to the history file
+    together with the commit and machine
+    """
+
+    history = load_history(path)
+    history.append(
+        {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "results": results,
+        }
+    )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
+
+    return history
+
+
+def compare_runs(history, base=-2, new=-1):
+
+    """
+    Compares two runs of the history.
+
+    Parameters:
+    -----------
+
+    history : list
+
+    The runs (see load_history)
+
+    base : int (default = -2)
+
+    The position of the baseline run
+
+    new : int (default = -1)
+
+    The position of the run to compare
+
+    Returns:
+    --------
+
+    df_comp : dataframe
+
+    Time and memory of both runs per
+    benchmark and size with the ratio
+    new / base
+
+    """
+
+    import pandas as pd
+
+    frames = []
+    for label, pos in [("base", base), ("new", new)]:
+        df_run = pd.DataFrame(history[pos]["results"])
+        df_run = df_run.loc[df_run["status"] == "ok"]
+        df_run = df_run.set_index(["benchmark", "size"])[["seconds", "peak_rss_mb"]]
+        frames.append(df_run.add_prefix(f"{label}_"))
+
+    df_comp = frames[0].join(frames[1], how="outer")
+    df_comp["time_ratio"] = df_comp["new_seconds"] / df_comp["base_seconds"]
+    df_comp["mem_ratio"] = df_comp["new_peak_rss_mb"] / df_comp["base_peak_rss_mb"]
+    df_comp[["time_ratio", "mem_ratio"]] = df_comp[["time_ratio", "mem_ratio"]].round(2)
+
+    return df_comp.reset_index()
+
+
+def main(argv=None):
+
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the src functions.")
+    parser.add_argument("--sizes", nargs="+", default=["10k"], choices=list(SIZES))
+    parser.add_argument("--benchmarks", nargs="+", default=None, choices=BENCHMARKS)
+    parser.add_argument("--no-limits", action="store_true")
+    parser.add_argument("--history", default=str(HISTORY_PATH))
+    parser.add_argument(
+        "--compare", action="store_true", help="Compare the last two runs and exit"
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        history = load_history(args.history)
+        if len(history) < 2:
+            print("Need at least two runs in the history to compare.")
+            return 1
+        print(compare_runs(history).to_string(index=False))
+        return 0
+
+    results = run_benchmarks(
+        args.sizes, names=args.benchmarks, limits=not args.no_limits
+    )
+    save_run(results, path=args.history)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
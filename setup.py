@@ -7,4 +7,7 @@ setup(
     description='This is project that explores the an E-commerce transaction data.',
     author='stratoshad',
     license='MIT',
+    entry_points={
+        'console_scripts': ['ecom-pipeline=src.pipeline:main'],
+    },
 )
@@ -0,0 +1,348 @@
+"""
+INGEST Module
+-------------
+
+@author : Stratoshad
+
+This module ingests the raw transaction
+extracts (e.g. one Excel or csv file per
+month) from data/raw. The files are parsed
+in parallel worker processes, brought to
+one schema and written as one Parquet file
+each. A manifest records what was ingested
+so a rerun only parses new or changed files.
+
+The ingested folder can be read like a
+single file:
+
+    load_raw_data("data/interim", fn="raw_parquet")
+
+"""
+
+import os
+import json
+import time
+import warnings
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from src.data.profiling import instrument
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+RAW_DIR = PROJECT_DIR / "data" / "raw"
+INGEST_DIR = PROJECT_DIR / "data" / "interim" / "raw_parquet"
+
+# Files starting with "_" are not read
+# as part of the Parquet dataset
+MANIFEST_FILE = "_manifest.json"
+
+EXTENSIONS = [".xlsx", ".xls", ".csv"]
+
+# The columns of the raw extracts and their types
+RAW_SCHEMA = {
+    "InvoiceNo": "str",
+    "StockCode": "str",
+    "Description": "str",
+    "Quantity": "int64",
+    "InvoiceDate": "datetime64[ns]",
+    "UnitPrice": "float64",
+    "CustomerID": "float64",
+    "Country": "str",
+}
+
+
+def discover_files(raw_dir=RAW_DIR, extensions=None):
+
+    """
+    Returns the raw extracts of a folder
+    sorted by name (Excel and csv files)
+    """
+
+    extensions = EXTENSIONS if extensions is None else extensions
+
+    return sorted(
+        path
+        for path in Path(raw_dir).iterdir()
+        if path.is_file()
+        and path.suffix.lower() in extensions
+        and not path.name.startswith(("~$", "."))
+    )
+
+
+def apply_schema(df, schema=None):
+
+    """
+    Brings a raw extract to the shared
+    schema: the same columns in the same
+    order with the same types. Codes that
+    Excel reads as numbers (e.g. StockCode
+    85123) become strings while missing
+    values stay missing.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The raw extract
+
+    schema : dictionary (default = None)
+
+    The column types. If None
+    it uses RAW_SCHEMA.
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    The extract with the schema
+
+    """
+
+    schema = RAW_SCHEMA if schema is None else schema
+
+    missing = [col for col in schema if col not in df.columns]
+    if len(missing) > 0:
+        raise ValueError(f"Missing columns: {missing}")
+
+    df_out = df[list(schema)].copy()
+
+    for col, dtype in schema.items():
+
+        if dtype == "str":
+            values = df_out[col]
+            df_out[col] = values.where(values.isna(), values.astype(str))
+        elif dtype.startswith("datetime"):
+            df_out[col] = pd.to_datetime(df_out[col]).astype(dtype)
+        else:
+            df_out[col] = df_out[col].astype(dtype)
+
+    return df_out
+
+
+def _fingerprint(path):
+
+    """
+    The size and modification time of a
+    file. A file with the same fingerprint
+    as in the manifest is not parsed again.
+    """
+
+    stat = os.stat(path)
+
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _ingest_file(path, ingest_dir):
+
+    """
+    Parses one extract, applies the schema
+    and writes it as a Parquet file. Runs
+    in a worker process.
+    """
+
+    start = time.perf_counter()
+    path = Path(path)
+
+    # Taken before reading so a file rewritten
+    # while it is parsed is ingested again
+    fingerprint = _fingerprint(path)
+
+    # Codes are read as text so nothing is lost
+    # to type guessing (e.g. leading zeros)
+    text_cols = {"InvoiceNo": str, "StockCode": str, "Description": str}
+
+    if path.suffix.lower() == ".csv":
+        df = pd.read_csv(path, dtype=text_cols)
+    else:
+        df = pd.read_excel(path, dtype=text_cols)
+
+    df = apply_schema(df)
+
+    out_path = Path(ingest_dir) / f"{path.name}.parquet"
+    tmp_path = Path(ingest_dir) / f"_{path.name}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, out_path)
+
+    return {
+        "file": path.name,
+        "partition": out_path.name,
+        "rows": df.shape[0],
+        "seconds": round(time.perf_counter() - start, 2),
+        **fingerprint,
+    }
+
+
+def read_manifest(ingest_dir=INGEST_DIR):
+
+    """
+    Returns the manifest of an ingest
+    folder (file name -> entry)
+    """
+
+    path = Path(ingest_dir) / MANIFEST_FILE
+
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest, ingest_dir):
+
+    """
+    Writes the manifest atomically so an
+    interrupted run never corrupts it
+    """
+
+    path = Path(ingest_dir) / MANIFEST_FILE
+    tmp_path = path.with_suffix(".tmp")
+
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, path)
+
+
+@instrument
+def ingest_raw_files(raw_dir=RAW_DIR, ingest_dir=INGEST_DIR, n_jobs=None, force=False):
+
+    """
+    Ingests every extract of the raw folder
+    that is new or changed since the last
+    run. The files are parsed in parallel
+    processes (Excel parsing is CPU bound)
+    and the manifest is updated as each
+    one finishes. The partitions of
+    extracts that are no longer in the
+    raw folder are deleted.
+
+    Parameters:
+    -----------
+
+    raw_dir : str (default = "data/raw")
+
+    The folder with the extracts
+
+    ingest_dir : str (default = "data/interim/raw_parquet")
+
+    The folder for the Parquet files
+    and the manifest
+
+    n_jobs : int (default = None)
+
+    The number of worker processes.
+    If None it uses all cores.
+
+    force : bool (default = False)
+
+    Parse every file again
+
+    Returns:
+    --------
+
+    df_report : dataframe
+
+    The status ("ingested", "skipped",
+    "removed" or "failed"), rows and wall
+    time of every file
+
+    """
+
+    ingest_dir = Path(ingest_dir)
+    ingest_dir.mkdir(parents=True, exist_ok=True)
+    n_jobs = (os.cpu_count() or 1) if n_jobs is None else n_jobs
+
+    manifest = read_manifest(ingest_dir)
+    paths = discover_files(raw_dir)
+    report = []
+    todo = []
+
+    # Drop the partitions of extracts that were
+    # removed so the dataset no longer reads them
+    removed = sorted(set(manifest) - {path.name for path in paths})
+    for name in removed:
+        (ingest_dir / manifest.pop(name)["partition"]).unlink(missing_ok=True)
+        report.append({"file": name, "status": "removed"})
+
+    if removed:
+        _write_manifest(manifest, ingest_dir)
+
+    if force:
+        manifest = {}
+
+    for path in paths:
+
+        entry = manifest.get(path.name)
+        if (
+            entry is not None
+            and {key: entry[key] for key in ["size", "mtime_ns"]} == _fingerprint(path)
+            and (ingest_dir / entry["partition"]).exists()
+        ):
+            report.append({"file": path.name, "status": "skipped"})
+        else:
+            todo.append(path)
+
+    def _record(path, result=None, error=None):
+        if error is None:
+            manifest[path.name] = result
+            _write_manifest(manifest, ingest_dir)
+            report.append({**result, "status": "ingested"})
+        else:
+            warnings.warn(f"Could not ingest {path.name}: {error}")
+            report.append({"file": path.name, "status": "failed", "error": str(error)})
+
+    if n_jobs <= 1 or len(todo) <= 1:
+        for path in todo:
+            try:
+                _record(path, result=_ingest_file(path, ingest_dir))
+            except Exception as e:
+                _record(path, error=e)
+
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(todo))) as executor:
+
+            futures = {
+                executor.submit(_ingest_file, path, ingest_dir): path for path in todo
+            }
+
+            for future in as_completed(futures):
+                try:
+                    _record(futures[future], result=future.result())
+                except Exception as e:
+                    _record(futures[future], error=e)
+
+    df_report = pd.DataFrame(report)
+    cols = ["file", "status", "rows", "seconds", "partition", "error"]
+    df_report = df_report[[col for col in cols if col in df_report.columns]]
+
+    return df_report.sort_values(by="file", kind="mergesort").reset_index(drop=True)
+
+
+def load_ingested(ingest_dir=INGEST_DIR):
+
+    """
+    Reads all the ingested files (in
+    file name order) as one dataframe
+    (empty with the RAW_SCHEMA columns
+    if nothing was ingested)
+    """
+
+    manifest = read_manifest(ingest_dir)
+
+    if not manifest:
+        return pd.DataFrame(
+            {col: pd.Series(dtype=dtype) for col, dtype in RAW_SCHEMA.items()}
+        )
+
+    return pd.concat(
+        [
+            pd.read_parquet(Path(ingest_dir) / manifest[name]["partition"])
+            for name in sorted(manifest)
+        ],
+        ignore_index=True,
+    )
@@ -0,0 +1,368 @@
+"""
+MAKE_DATASET Module
+-------------------
+
+@author : Stratoshad
+
+This module contains the data loading
+and cleaning steps of NB1 as functions
+so they can run outside the notebook
+(e.g. from the pipeline CLI).
+
+"""
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from src.data import utils, validation
+from src.data.profiling import instrument
+
+RAW_FILE = "Online Retail.xlsx"
+
+# The column order and names of the cleaned
+# transactions (see NB1)
+CLEAN_COL_ORDER = [
+    "CustomerID",
+    "Country",
+    "InvoiceNo",
+    "InvoiceDate",
+    "StockCode",
+    "Description",
+    "Actual_Quantity",
+    "UnitPrice",
+    "Total_Price",
+]
+
+CLEAN_RENAME_DICT = {
+    "InvoiceNo": "invc_num",
+    "StockCode": "stock_code",
+    "Description": "prod_desc",
+    "Quantity": "qty_all",
+    "InvoiceDate": "invc_date",
+    "UnitPrice": "unit_price",
+    "CustomerID": "customer_id",
+    "Country": "country",
+    "Quantity_Canc": "qty_canc",
+    "Cancel_Date": "canc_date",
+    "Full_Canc": "full_canc",
+    "Actual_Quantity": "qty",
+    "Total_Price": "total_price",
+}
+
+
+@instrument
+def load_raw_data(raw_path, fn=RAW_FILE):
+    """
+    Reads the raw transactions and
+    flags the cancelled ones (invoice
+    numbers starting with "C").
+
+    Parameters:
+    -----------
+
+    raw_path : str
+
+    The folder with the raw data
+
+    fn : str (default = "Online Retail.xlsx")
+
+    The file name. Excel, csv and
+    parquet files are supported as
+    well as a folder of parquet files
+    (see ingest.ingest_raw_files).
+
+    Returns:
+    --------
+
+    df_raw : dataframe
+
+    The raw transactions with
+    the "Cancelled" column
+
+    """
+
+    path = os.path.join(raw_path, fn)
+
+    if fn.endswith(".csv"):
+        df_raw = pd.read_csv(path, parse_dates=["InvoiceDate"])
+    elif fn.endswith(".parquet") or os.path.isdir(path):
+        df_raw = pd.read_parquet(path)
+    else:
+        df_raw = pd.read_excel(path)
+
+    df_raw["Cancelled"] = (
+        df_raw["InvoiceNo"].astype(str).str.upper().str.startswith("C").astype(int)
+    )
+
+    return df_raw
+
+
+def _hash_uniform(values, seed):
+    """
+    Maps every value to a number in [0, 1)
+    with a seeded hash. The same value always
+    gets the same number for the same seed.
+    """
+
+    hashes = pd.util.hash_pandas_object(
+        pd.Series(values, dtype=object), index=False, hash_key=f"{seed:016d}"[-16:]
+    ).values
+
+    return (hashes >> np.uint64(11)) / 2.0**53
+
+
+@instrument
+def sample_customers(df_raw, frac, seed=0, n_bins=10):
+    """
+    Keeps a deterministic sample of the
+    customers with all of their transactions
+    so that every later step (cancellation
+    matching, customer features, modeling)
+    sees complete customers.
+
+    The customers are ordered by country,
+    spend decile and a seeded hash of their
+    CustomerID and every 1 / frac-th of them
+    is taken (systematic sampling). Each
+    country and decile gets its share of
+    the sample and the same inputs always
+    give the same customers. Transactions
+    without a customer are sampled by
+    invoice with the same fraction.
+
+    Parameters:
+    -----------
+
+    df_raw : dataframe
+
+    The raw transactions
+
+    frac : float
+
+    The share of the customers to keep
+
+    seed : int (default = 0)
+
+    Picks a different sample
+
+    n_bins : int (default = 10)
+
+    The number of spend bins
+
+    Returns:
+    --------
+
+    df_sample : dataframe
+
+    The transactions of the sampled
+    customers (with the original index)
+
+    """
+
+    if not 0 < frac <= 1:
+        raise ValueError("frac has to be between 0 and 1.")
+
+    if frac == 1:
+        return df_raw
+
+    known = df_raw["CustomerID"].notna() & (df_raw["CustomerID"] != "00000")
+    df_known = df_raw.loc[known]
+
+    # Strata: the first country and the spend decile
+    line_spend = df_known["Quantity"] * df_known["UnitPrice"]
+    spend = line_spend.groupby(df_known["CustomerID"]).sum()
+    country = df_known.groupby("CustomerID")["Country"].first().loc[spend.index]
+    country_codes, _ = pd.factorize(country, sort=True)
+    spend_bin = np.ceil(spend.rank(method="first", pct=True).values * n_bins) - 1
+
+    # Take every 1 / frac-th customer of the ordered list
+    order = np.lexsort([_hash_uniform(spend.index, seed), spend_bin, country_codes])
+    pos = np.empty(len(order))
+    pos[order] = np.arange(len(order))
+    start = np.random.RandomState(seed).rand()
+    selected = np.floor((pos + 1) * frac + start) > np.floor(pos * frac + start)
+
+    chosen = df_raw["CustomerID"].isin(spend.index[selected])
+    guests = ~known & (_hash_uniform(df_raw["InvoiceNo"].values, seed) < frac)
+
+    return df_raw.loc[(known & chosen) | guests]
+
+
+@instrument
+def clean_raw_data(df_raw):
+    """
+    Applies the cleaning steps of NB1
+    to the raw transactions:
+
+    - Drops rows without a description
+    - Fills missing CustomerIDs with "00000"
+    - Merges invoice dates less than an hour apart
+    - Drops non-cancelled rows with a zero or
+      negative unit price
+    - Keeps the most common description per
+      stock code
+    - Keeps the country with the most quantity
+      per customer
+    - Drops invoices with only non-product codes
+      and un-cancels discount only invoices
+
+    Parameters:
+    -----------
+
+    df_raw : dataframe
+
+    The raw transactions with
+    the "Cancelled" column
+
+    Returns:
+    --------
+
+    df_clean : dataframe
+
+    The cleaned transactions ready
+    for process_cancellations()
+
+    """
+
+    # All the NB1 checks in one pass over the raw data.
+    # The fixes below only run for the checks that fail
+    # (they can't fail after dropping rows if they pass).
+    df_report = validation.validate(df_raw, validation.RAW_RULES, errors="ignore")
+    failed = set(df_report.loc[df_report["status"] == "failed", "rule"])
+
+    if "reserved_customer_id" in failed:
+        raise ValueError("CustomerID 00000 already exists.")
+
+    df_clean = df_raw.dropna(subset=["Description"]).copy()
+
+    # Fill in the missing customers
+    df_clean["CustomerID"] = df_clean["CustomerID"].astype(object)
+    df_clean.loc[df_clean["CustomerID"].isnull(), "CustomerID"] = "00000"
+
+    # Invoices with more than one date. If consecutive rows
+    # are less than an hour apart use the first date
+    if "invoice_multiple_dates" in failed:
+        df_multi = df_clean.loc[
+            df_clean.groupby("InvoiceNo")["InvoiceDate"].transform("nunique") > 1,
+            ["InvoiceNo", "InvoiceDate"],
+        ]
+    else:
+        df_multi = df_clean.iloc[:0]
+
+    if df_multi.shape[0] > 0:
+        gaps = df_multi.groupby("InvoiceNo")["InvoiceDate"].diff()
+        has_gap = (gaps >= pd.Timedelta(hours=1)).groupby(df_multi["InvoiceNo"]).any()
+
+        if has_gap.sum() > 0:
+            warnings.warn(
+                f"There are {has_gap.sum()} invoices with dates more than 1 hr apart."
+            )
+
+        fix_rows = df_multi.index[~df_multi["InvoiceNo"].map(has_gap).values]
+        first_dates = df_multi.groupby("InvoiceNo")["InvoiceDate"].transform("min")
+        df_clean.loc[fix_rows, "InvoiceDate"] = first_dates.loc[fix_rows]
+
+    # Non-cancelled transactions need a positive price
+    df_clean = df_clean.loc[
+        ((df_clean["Cancelled"] == 0) & (df_clean["UnitPrice"] > 0))
+        | (df_clean["Cancelled"] == 1)
+    ].copy()
+
+    # Use the most common description for every stock code
+    if "stock_code_multiple_descriptions" in failed:
+        desc_counts = df_clean.groupby(["StockCode", "Description"]).size()
+        desc_counts = desc_counts.sort_values(ascending=False, kind="mergesort")
+        top_desc = desc_counts.reset_index().drop_duplicates(subset=["StockCode"])
+        top_desc = top_desc.set_index("StockCode")["Description"].str.strip()
+        multi_desc = (
+            df_clean.groupby("StockCode")["Description"].transform("nunique") > 1
+        )
+        df_clean.loc[multi_desc, "Description"] = df_clean.loc[
+            multi_desc, "StockCode"
+        ].map(top_desc)
+
+    # Use the country with the highest quantity for
+    # customers with more than one country
+    df_known = df_clean.loc[df_clean["CustomerID"] != "00000"]
+    if "customer_multiple_countries" in failed:
+        multi_country = df_known.groupby("CustomerID")["Country"].nunique() > 1
+    else:
+        multi_country = pd.Series(dtype=bool)
+
+    if multi_country.sum() > 0:
+        df_grp = df_known.loc[df_known["CustomerID"].isin(multi_country.index[multi_country])]
+        df_grp = df_grp.groupby(["CustomerID", "Country"])["Quantity"].sum()
+        df_grp = df_grp.reset_index().sort_values(by="Quantity", kind="mergesort")
+        top_country = df_grp.drop_duplicates(subset=["CustomerID"], keep="last")
+        top_country = top_country.set_index("CustomerID")["Country"]
+
+        fix_rows = df_clean["CustomerID"].isin(top_country.index)
+        df_clean.loc[fix_rows, "Country"] = df_clean.loc[fix_rows, "CustomerID"].map(
+            top_country
+        )
+
+    # Invoices with only non-digit stock codes (postage,
+    # manual etc.) are dropped. Discount only ones are kept
+    # but not treated as cancellations.
+    non_digit = ~df_clean["StockCode"].astype(str).str.contains(r"\d", regex=True)
+    is_discount = df_clean["StockCode"] == "D"
+    inv_grp = pd.DataFrame(
+        {
+            "InvoiceNo": df_clean["InvoiceNo"],
+            "digit": ~non_digit,
+            "other": non_digit & ~is_discount,
+        }
+    ).groupby("InvoiceNo")[["digit", "other"]].any()
+
+    removed_invs = inv_grp.index[~inv_grp["digit"] & inv_grp["other"]]
+    discount_invs = inv_grp.index[~inv_grp["digit"] & ~inv_grp["other"]]
+
+    df_clean = df_clean.loc[~df_clean["InvoiceNo"].isin(removed_invs)].copy()
+    df_clean.loc[df_clean["InvoiceNo"].isin(discount_invs), "Cancelled"] = 0
+
+    return df_clean
+
+
+@instrument
+def finalize_cancellations(df_canc):
+    """
+    Takes the output of process_cancellations()
+    and drops the cancellation rows, adds the
+    actual quantity and price columns and
+    renames everything as in NB1.
+
+    Parameters:
+    -----------
+
+    df_canc : dataframe
+
+    The transactions returned by
+    process_cancellations()
+
+    Returns:
+    --------
+
+    df_clean : dataframe
+
+    The final cleaned transactions
+    (saved as "data_cleanned.csv" in NB1)
+
+    """
+
+    df_clean = df_canc.loc[df_canc["Cancelled"] == 0].copy()
+    df_clean = df_clean.drop("Cancelled", axis=1)
+
+    # Transactions that had all their quantity cancelled
+    df_clean["Full_Canc"] = (df_clean["Quantity"] == df_clean["Quantity_Canc"]).astype(int)
+
+    df_clean["Actual_Quantity"] = df_clean["Quantity"] - df_clean["Quantity_Canc"]
+    df_clean["Total_Price"] = df_clean["Actual_Quantity"] * df_clean["UnitPrice"]
+
+    df_clean = utils.rearrange_and_rename(
+        df_clean, col_order=CLEAN_COL_ORDER, rename_dict=CLEAN_RENAME_DICT
+    )
+
+    return df_clean
@@ -0,0 +1,409 @@
+"""
+PROFILING Module
+----------------
+
+@author : Stratoshad
+
+This module contains an opt-in
+instrumentation layer for the src
+functions. When enabled every decorated
+call records its wall time, CPU time,
+peak memory and input / output rows.
+When disabled the decorator only adds
+a single flag check per call.
+
+Enable it either by calling enable() or
+by setting the SRC_PROFILE environment
+variable to a JSON lines output path
+(or to "1" to only keep the records
+in memory).
+
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_STATE = {
+    "enabled": False,
+    "output": None,
+    "tracemalloc": False,
+    "profile": set(),
+    "profile_dir": None,
+    "profiler": "cprofile",
+}
+_RECORDS = []
+
+# The traced peak of every open block (the
+# innermost last) so nested calls don't hide
+# the peak of the calls around them
+_PEAKS = []
+
+
+def enable(
+    output=None, trace_memory=False, profile=None, profile_dir=".", profiler="cprofile"
+):
+
+    """
+    Turns the instrumentation on.
+
+    Parameters:
+    -----------
+
+    output : str (default = None)
+
+    A file to append one JSON line per
+    call to. If None the records are
+    only kept in memory (see summary()).
+
+    trace_memory : bool (default = False)
+
+    Whether to track the peak python
+    memory of each call with tracemalloc.
+    This is accurate but slows calls down.
+
+    profile : list (default = None)
+
+    Names of functions (e.g.
+    ["process_cancellations"]) to run
+    under a profiler and dump its output
+
+    profile_dir : str (default = ".")
+
+    The folder for the profiler dumps
+
+    profiler : str (default = "cprofile")
+
+    "cprofile" writes a .prof file (open it
+    with snakeviz or pstats) and
+    "pyinstrument" writes an html report
+
+    Returns:
+    --------
+
+    None
+
+    """
+
+    _STATE["enabled"] = True
+    _STATE["output"] = output
+    _STATE["tracemalloc"] = trace_memory
+    _STATE["profile"] = set(profile or [])
+    _STATE["profile_dir"] = profile_dir
+    _STATE["profiler"] = profiler
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return
+
+
+def disable():
+
+    """
+    Turns the instrumentation off
+    """
+
+    _STATE["enabled"] = False
+
+    if _STATE["tracemalloc"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    _STATE["tracemalloc"] = False
+
+    return
+
+
+def reset():
+
+    """
+    Clears all records kept in memory
+    """
+
+    _RECORDS.clear()
+
+    return
+
+
+def _count_rows(obj):
+
+    """
+    Returns the number of rows of a
+    dataframe / array (or of the first
+    one in a tuple / list) or None
+    """
+
+    if isinstance(obj, (tuple, list)):
+        for item in obj:
+            rows = _count_rows(item)
+            if rows is not None:
+                return rows
+        return None
+
+    shape = getattr(obj, "shape", None)
+
+    if shape is not None and len(shape) > 0:
+        return int(shape[0])
+
+    return None
+
+
+def _peak_rss_mb():
+
+    """
+    Returns the peak resident memory of
+    the process in MB (None on Windows)
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KB while macOS reports bytes
+    if sys.platform == "darwin":
+        return round(peak / 1024 ** 2, 1)
+
+    return round(peak / 1024, 1)
+
+
+def _emit(record):
+
+    """
+    Stores a record and writes it
+    to the output file if one is set
+    """
+
+    _RECORDS.append(record)
+
+    if _STATE["output"] is not None:
+        with open(_STATE["output"], "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    return
+
+
+def _run_profiled(name, func, args, kwargs):
+
+    """
+    Runs a function under the chosen
+    profiler and dumps the results
+    """
+
+    os.makedirs(_STATE["profile_dir"], exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(_STATE["profile_dir"], f"{name}-{stamp}-{len(_RECORDS)}")
+
+    if _STATE["profiler"] == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+            with open(path + ".html", "w") as f:
+                f.write(profiler.output_html())
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path + ".prof")
+
+
+@contextmanager
+def profile_block(name, rows_in=None):
+
+    """
+    Context manager that records the same
+    metrics as the decorator for any block
+    of code. It yields a dictionary where
+    "rows_out" can be set.
+
+    Parameters:
+    -----------
+
+    name : str
+
+    The name to record the block under
+
+    rows_in : int (default = None)
+
+    The number of input rows
+
+    Yields:
+    -------
+
+    record : dictionary
+
+    The record of the block
+
+    """
+
+    record = {"function": name, "rows_in": rows_in, "rows_out": None}
+
+    if not _STATE["enabled"]:
+        yield record
+        return
+
+    # Keep the peak of the enclosing block before
+    # resetting it. reset_peak() only exists from
+    # python 3.9.
+    tracing = _STATE["tracemalloc"]
+    if tracing:
+        if _PEAKS:
+            _PEAKS[-1] = max(_PEAKS[-1], tracemalloc.get_traced_memory()[1])
+        _PEAKS.append(0)
+
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+
+    rss_start = _peak_rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield record
+    finally:
+        record["wall_s"] = round(time.perf_counter() - wall_start, 6)
+        record["cpu_s"] = round(time.process_time() - cpu_start, 6)
+
+        # The process peak only ever grows so we
+        # record how much this call raised it
+        rss_end = _peak_rss_mb()
+        record["rss_growth_mb"] = (
+            None if rss_end is None else round(rss_end - rss_start, 1)
+        )
+
+        if tracing:
+            peak = max(_PEAKS.pop(), tracemalloc.get_traced_memory()[1])
+            if _PEAKS:
+                _PEAKS[-1] = max(_PEAKS[-1], peak)
+            record["peak_traced_mb"] = round(peak / 1024 ** 2, 2)
+
+        record["timestamp"] = time.time()
+        _emit(record)
+
+
+def instrument(func):
+
+    """
+    Decorator that records the wall time,
+    CPU time, peak memory and input / output
+    rows of every call when the
+    instrumentation is enabled.
+
+    Parameters:
+    -----------
+
+    func : function
+
+    The function to instrument
+
+    Returns:
+    --------
+
+    wrapper : function
+
+    The instrumented function
+
+    """
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        if not _STATE["enabled"]:
+            return func(*args, **kwargs)
+
+        rows_in = _count_rows(list(args) + list(kwargs.values()))
+
+        with profile_block(name, rows_in=rows_in) as record:
+
+            if name in _STATE["profile"]:
+                result = _run_profiled(name, func, args, kwargs)
+            else:
+                result = func(*args, **kwargs)
+
+            record["rows_out"] = _count_rows(result)
+
+        return result
+
+    return wrapper
+
+
+def get_records():
+
+    """
+    Returns all records kept in
+    memory as a dataframe
+    """
+
+    return pd.DataFrame(_RECORDS)
+
+
+def summary():
+
+    """
+    Summarises the records kept in
+    memory per function.
+
+    Returns:
+    --------
+
+    df_summary : dataframe
+
+    The number of calls, total and mean
+    wall time, total CPU time, largest
+    growth of the process peak memory,
+    peak traced memory (if tracked) and
+    rows per function, sorted by the
+    total wall time
+
+    """
+
+    df_rec = get_records()
+
+    if df_rec.shape[0] == 0:
+        return df_rec
+
+    agg_dict = {
+        "calls": ("wall_s", "size"),
+        "total_wall_s": ("wall_s", "sum"),
+        "mean_wall_s": ("wall_s", "mean"),
+        "total_cpu_s": ("cpu_s", "sum"),
+        "max_rss_growth_mb": ("rss_growth_mb", "max"),
+        "max_rows_in": ("rows_in", "max"),
+        "max_rows_out": ("rows_out", "max"),
+    }
+
+    if "peak_traced_mb" in df_rec.columns:
+        agg_dict["peak_traced_mb"] = ("peak_traced_mb", "max")
+
+    df_summary = df_rec.groupby("function").agg(**agg_dict).reset_index()
+
+    return df_summary.sort_values(by="total_wall_s", ascending=False)
+
+
+# Allow turning it on without touching any code
+if os.environ.get("SRC_PROFILE"):
+    _env_value = os.environ["SRC_PROFILE"]
+    enable(output=None if _env_value == "1" else _env_value)
@@ -0,0 +1,506 @@
+"""
+QUERY Module
+------------
+
+@author : Stratoshad
+
+This module exposes the cleaned and
+aggregated tables to DuckDB, an in-process
+SQL engine, through Parquet files. DuckDB
+only reads the columns and row groups a
+query needs and scans them in parallel, so
+ad-hoc questions don't need the whole csv
+loaded into pandas.
+
+DuckDB and pyarrow are optional and only
+imported when these functions are used.
+
+Usage:
+
+    from src.data import query
+
+    query.export_tables()
+    query.query("SELECT country, SUM(total_price) FROM transactions GROUP BY 1")
+
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+INTERIM_DIR = PROJECT_DIR / "data" / "interim"
+STORE_DIR = PROJECT_DIR / "data" / "processed" / "store"
+
+# SQL table name -> file name of the pipeline / NB1 output
+TABLES = {
+    "transactions": "data_cleanned",
+    "customers": "customer_data",
+    "products": "product_data",
+    "invoices": "invoice_data",
+    "main": "main_data",
+    "segments": "customer_segments",
+}
+
+# Sorting on the usual filter column keeps the
+# min / max of every row group tight so that
+# date filters skip most of the file
+SORT_KEYS = {
+    "transactions": "invc_date",
+    "invoices": "invc_date",
+    "main": "invc_date",
+}
+
+# Columns of the NB1 csv files that need their
+# type back (csv files have no types). IDs stay
+# text so "00000" is not read as the number 0.
+CSV_DATE_COLS = ["invc_date", "canc_date", "first_purchase", "last_purchase", "date"]
+CSV_TEXT_COLS = ["customer_id", "invc_num", "stock_code"]
+
+# DuckDB's own row group size
+ROW_GROUP_SIZE = 122880
+
+
+def _import_duckdb():
+
+    """
+    Imports duckdb or raises an
+    ImportError that says how to get it
+    """
+
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "The query module needs duckdb. Install it with 'pip install duckdb'."
+        ) from e
+
+    return duckdb
+
+
+def _read_csv_table(path):
+
+    """
+    Reads an NB1 csv file with its dates
+    parsed and its IDs as text. Whole number
+    IDs lose their ".0" (e.g. "12487.0")
+    like in _to_storable().
+    """
+
+    header = pd.read_csv(path, nrows=0).columns
+    text_cols = [col for col in CSV_TEXT_COLS if col in header]
+
+    df = pd.read_csv(
+        path,
+        dtype={col: str for col in text_cols},
+        parse_dates=[col for col in CSV_DATE_COLS if col in header],
+    )
+
+    for col in text_cols:
+        df[col] = df[col].str.replace(r"^(\d+)\.0$", r"\1", regex=True)
+
+    return df
+
+
+def _to_storable(df):
+
+    """
+    Parquet needs one type per column. Object
+    columns that mix numbers and strings (e.g.
+    customer_id with "00000") become strings
+    and whole number floats lose their ".0".
+    """
+
+    df = df.copy()
+
+    for col in df.columns[df.dtypes == object]:
+
+        values = df[col].dropna()
+        if values.shape[0] == 0 or isinstance(values.iloc[0], (list, tuple)):
+            continue
+
+        # Convert the unique values only
+        codes, uniques = pd.factorize(df[col])
+        if pd.Series(uniques).map(type).nunique() > 1:
+            uniques = np.array(
+                [
+                    str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)
+                    for v in uniques
+                ]
+                + [None],
+                dtype=object,
+            )
+            df[col] = uniques[codes]
+
+    return df
+
+
+@instrument
+def export_tables(
+    source_dir=INTERIM_DIR, store_dir=STORE_DIR, tables=None, row_group_size=None
+):
+
+    """
+    Writes the persisted tables to Parquet
+    so they can be queried. The pipeline
+    pickles are used if they exist and the
+    NB1 csv files otherwise.
+
+    Parameters:
+    -----------
+
+    source_dir : str (default = "data/interim")
+
+    The folder with the tables
+
+    store_dir : str (default = "data/processed/store")
+
+    The folder for the Parquet files
+
+    tables : list (default = None)
+
+    The tables to export (see TABLES).
+    If None exports all that exist.
+
+    row_group_size : int (default = None)
+
+    Rows per row group. If None it
+    uses the DuckDB default.
+
+    Returns:
+    --------
+
+    paths : dictionary
+
+    The Parquet file of every
+    exported table
+
+    """
+
+    source_dir = Path(source_dir)
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    row_group_size = ROW_GROUP_SIZE if row_group_size is None else row_group_size
+
+    paths = {}
+
+    for table in TABLES if tables is None else tables:
+
+        pkl_path = source_dir / f"{TABLES[table]}.pkl"
+        csv_path = source_dir / f"{TABLES[table]}.csv"
+
+        if pkl_path.exists():
+            df = pd.read_pickle(pkl_path)
+        elif csv_path.exists():
+            df = _read_csv_table(csv_path)
+        else:
+            continue
+
+        if table in SORT_KEYS and SORT_KEYS[table] in df.columns:
+            df = df.sort_values(by=SORT_KEYS[table], kind="mergesort")
+
+        path = store_dir / f"{table}.parquet"
+        tmp_path = path.with_suffix(".parquet.tmp")
+        _to_storable(df).to_parquet(
+            tmp_path, index=False, row_group_size=row_group_size
+        )
+        tmp_path.replace(path)
+        paths[table] = path
+
+    return paths
+
+
+def connect(store_dir=STORE_DIR, threads=None, database=":memory:"):
+
+    """
+    Opens a DuckDB connection with a view
+    for every Parquet table of the store.
+    The views read the files directly so
+    nothing is loaded up front.
+
+    Parameters:
+    -----------
+
+    store_dir : str (default = "data/processed/store")
+
+    The folder with the Parquet files
+
+    threads : int (default = None)
+
+    The number of scan threads. If
+    None DuckDB uses all cores.
+
+    database : str (default = ":memory:")
+
+    The DuckDB database file
+
+    Returns:
+    --------
+
+    con : duckdb connection
+
+    The connection
+
+    """
+
+    duckdb = _import_duckdb()
+
+    con = duckdb.connect(database)
+
+    if threads is not None:
+        con.execute(f"SET threads TO {int(threads)}")
+
+    for table in TABLES:
+        path = Path(store_dir) / f"{table}.parquet"
+        if path.exists():
+            path = str(path).replace("'", "''")
+            con.execute(
+                f"CREATE OR REPLACE VIEW {table} AS "
+                f"SELECT * FROM read_parquet('{path}')"
+            )
+
+    return con
+
+
+@instrument
+def query(sql, params=None, con=None, store_dir=STORE_DIR):
+
+    """
+    Runs a SQL query over the store.
+
+    Parameters:
+    -----------
+
+    sql : str
+
+    The query. The tables are named as
+    in TABLES (e.g. "transactions").
+
+    params : list (default = None)
+
+    Values for the "?" placeholders
+
+    con : duckdb connection (default = None)
+
+    An open connection (see connect).
+    If None a new one is opened.
+
+    store_dir : str (default = "data/processed/store")
+
+    The folder with the Parquet files
+    (only used without a connection)
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    The result of the query
+
+    """
+
+    if con is None:
+        con = connect(store_dir)
+
+    return con.execute(sql, params or []).df()
+
+
+def explain(sql, con=None, store_dir=STORE_DIR):
+
+    """
+    Returns the physical plan of a query.
+    Useful to check that only the needed
+    columns are read and that the filters
+    are pushed into the Parquet scan.
+    """
+
+    if con is None:
+        con = connect(store_dir)
+
+    return con.execute(f"EXPLAIN {sql}").fetchall()[0][1]
+
+
+def _date_filter(start, end, params, col="invc_date"):
+
+    """
+    Builds the WHERE conditions (and
+    their parameters) for a date range
+    """
+
+    conditions = []
+
+    if start is not None:
+        conditions.append(f"{col} >= ?")
+        params.append(pd.Timestamp(start).to_pydatetime())
+
+    if end is not None:
+        conditions.append(f"{col} < ?")
+        params.append(pd.Timestamp(end).to_pydatetime())
+
+    return conditions
+
+
+def revenue_by_country_month(start=None, end=None, countries=None, con=None):
+
+    """
+    Revenue, orders and customers per
+    country and month.
+
+    Parameters:
+    -----------
+
+    start : str (default = None)
+
+    The first date to include
+
+    end : str (default = None)
+
+    The date to stop at (excluded)
+
+    countries : list (default = None)
+
+    The countries to include.
+    If None includes all.
+
+    con : duckdb connection (default = None)
+
+    An open connection (see connect)
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    One row per country and month
+
+    """
+
+    params = []
+    conditions = _date_filter(start, end, params)
+
+    if countries is not None:
+        conditions.append(f"country IN ({', '.join('?' * len(countries))})")
+        params.extend(countries)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    sql = f"""
+        SELECT country,
+               date_trunc('month', invc_date) AS month,
+               SUM(total_price) AS revenue,
+               COUNT(DISTINCT invc_num) AS orders,
+               COUNT(DISTINCT customer_id) AS customers
+        FROM transactions
+        {where}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """
+
+    return query(sql, params=params, con=con)
+
+
+def top_products_by_loss(n=10, start=None, end=None, con=None):
+
+    """
+    The products that lost the most
+    revenue to cancellations.
+
+    Parameters:
+    -----------
+
+    n : int (default = 10)
+
+    The number of products
+
+    start : str (default = None)
+
+    The first date to include
+
+    end : str (default = None)
+
+    The date to stop at (excluded)
+
+    con : duckdb connection (default = None)
+
+    An open connection (see connect)
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    The products with their total
+    cancellation loss and quantity
+
+    """
+
+    params = []
+    conditions = _date_filter(start, end, params)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(int(n))
+
+    sql = f"""
+        SELECT stock_code,
+               ANY_VALUE(prod_desc) AS prod_desc,
+               SUM(qty_all * unit_price - total_price) AS canc_loss,
+               SUM(qty_canc) AS qty_canc
+        FROM transactions
+        {where}
+        GROUP BY 1
+        ORDER BY canc_loss DESC
+        LIMIT ?
+    """
+
+    return query(sql, params=params, con=con)
+
+
+def cohort_counts(con=None):
+
+    """
+    Active customers per acquisition month
+    (cohort) and months since acquisition.
+    Customers without an ID are left out.
+
+    Parameters:
+    -----------
+
+    con : duckdb connection (default = None)
+
+    An open connection (see connect)
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    The columns "cohort", "month_offset"
+    and "customers"
+
+    """
+
+    sql = """
+        WITH activity AS (
+            SELECT customer_id,
+                   date_trunc('month', invc_date) AS month
+            FROM transactions
+            WHERE customer_id <> '00000'
+            GROUP BY 1, 2
+        ),
+        cohorts AS (
+            SELECT customer_id, MIN(month) AS cohort
+            FROM activity
+            GROUP BY 1
+        )
+        SELECT c.cohort,
+               date_diff('month', c.cohort, a.month) AS month_offset,
+               COUNT(*) AS customers
+        FROM activity a
+        JOIN cohorts c USING (customer_id)
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """
+
+    return query(sql, con=con)
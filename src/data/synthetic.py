@@ -0,0 +1,223 @@
+"""
+SYNTHETIC Module
+----------------
+
+@author : Stratoshad
+
+This module contains functions that
+generate synthetic transaction data
+with the same schema as the UCI
+"Online Retail" dataset. It is meant
+for benchmarks and tests at sizes the
+real dataset doesn't cover. The output
+is deterministic for a given seed.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+RAW_COLUMNS = [
+    "InvoiceNo",
+    "StockCode",
+    "Description",
+    "Quantity",
+    "InvoiceDate",
+    "UnitPrice",
+    "CustomerID",
+    "Country",
+]
+
+# Non product codes found in the real data
+SERVICE_CODES = {
+    "POST": "POSTAGE",
+    "D": "Discount",
+    "M": "Manual",
+    "C2": "CARRIAGE",
+    "DOT": "DOTCOM POSTAGE",
+    "BANK CHARGES": "Bank Charges",
+    "AMAZONFEE": "AMAZON FEE",
+}
+
+COUNTRIES = [
+    "United Kingdom",
+    "Germany",
+    "France",
+    "EIRE",
+    "Spain",
+    "Netherlands",
+    "Belgium",
+    "Switzerland",
+    "Portugal",
+    "Australia",
+]
+COUNTRY_WEIGHTS = [0.88, 0.025, 0.022, 0.018, 0.01, 0.01, 0.008, 0.007, 0.006, 0.014]
+
+
+def make_online_retail(
+    n_rows=10000,
+    n_customers=None,
+    n_products=None,
+    cancel_rate=0.02,
+    missing_customer_rate=0.25,
+    service_rate=0.005,
+    lines_per_invoice=20,
+    start_date="2010-12-01 08:00:00",
+    end_date="2011-12-09 20:00:00",
+    random_state=0,
+):
+
+    """
+    Generates a synthetic version of the
+    "Online Retail" transactions.
+
+    Parameters:
+    -----------
+
+    n_rows : int (default = 10000)
+
+    The approximate number of rows
+
+    n_customers : int (default = None)
+
+    The number of customers. If None it
+    scales with the rows like the real
+    data (~1 customer per 125 rows).
+
+    n_products : int (default = None)
+
+    The number of stock codes. If None it
+    scales with the rows (at most 50,000).
+
+    cancel_rate : float (default = 0.02)
+
+    The share of rows that are
+    cancellations (InvoiceNo starts
+    with "C")
+
+    missing_customer_rate : float (default = 0.25)
+
+    The share of invoices without
+    a CustomerID
+
+    service_rate : float (default = 0.005)
+
+    The share of rows with non product
+    codes (POST, D, M etc.)
+
+    lines_per_invoice : int (default = 20)
+
+    The average number of rows
+    per invoice
+
+    start_date : str (default = "2010-12-01 08:00:00")
+
+    The first possible invoice date
+
+    end_date : str (default = "2011-12-09 20:00:00")
+
+    The last possible invoice date
+
+    random_state : int (default = 0)
+
+    The seed of the generator
+
+    Returns:
+    --------
+
+    df_raw : dataframe
+
+    Transactions with the "Online
+    Retail" columns
+
+    """
+
+    rng = np.random.default_rng(random_state)
+
+    if n_customers is None:
+        n_customers = max(n_rows // 125, 10)
+
+    if n_products is None:
+        n_products = int(min(max(n_rows // 140, 20), 50000))
+
+    n_cancel = int(n_rows * cancel_rate)
+    n_buy = n_rows - n_cancel
+    n_invoices = max(n_buy // lines_per_invoice, 1)
+
+    # Customers with a skewed activity level
+    # (a few customers buy most of the time)
+    cust_ids = 12346.0 + np.arange(n_customers)
+    cust_country = rng.choice(len(COUNTRIES), size=n_customers, p=COUNTRY_WEIGHTS)
+    cust_weights = rng.pareto(1.2, size=n_customers) + 1
+    cust_weights /= cust_weights.sum()
+
+    # Products with a log-normal price and a
+    # power law popularity
+    prod_codes = (10002 + np.arange(n_products)).astype(str).astype(object)
+    has_letter = rng.random(n_products) < 0.2
+    prod_codes[has_letter] = prod_codes[has_letter] + "A"
+    prod_desc = np.array([f"PRODUCT {code}" for code in prod_codes], dtype=object)
+    prod_price = np.round(rng.lognormal(mean=0.8, sigma=0.9, size=n_products), 2)
+    prod_weights = 1 / np.arange(1, n_products + 1) ** 0.9
+    prod_weights /= prod_weights.sum()
+
+    # Invoices ordered by date with the customer (or
+    # no customer) and its country for the whole invoice
+    start = pd.Timestamp(start_date).value // 10 ** 9
+    end = pd.Timestamp(end_date).value // 10 ** 9
+    inv_secs = np.sort(rng.integers(start, end, size=n_invoices)) // 60 * 60
+    inv_cust = rng.choice(n_customers, size=n_invoices, p=cust_weights)
+    inv_missing = rng.random(n_invoices) < missing_customer_rate
+    inv_country = cust_country[inv_cust]
+    inv_nums = 536365 + np.arange(n_invoices)
+
+    # Rows of the purchases
+    row_inv = np.sort(rng.integers(0, n_invoices, size=n_buy))
+    row_prod = rng.choice(n_products, size=n_buy, p=prod_weights)
+    quantity = rng.geometric(0.15, size=n_buy)
+    codes = prod_codes[row_prod]
+    desc = prod_desc[row_prod]
+    price = prod_price[row_prod]
+
+    is_service = rng.random(n_buy) < service_rate
+    service_keys = np.array(list(SERVICE_CODES), dtype=object)
+    service_pick = rng.integers(0, len(service_keys), size=is_service.sum())
+    codes[is_service] = service_keys[service_pick]
+    desc[is_service] = np.array([SERVICE_CODES[c] for c in service_keys[service_pick]])
+    quantity[is_service] = 1
+
+    row_cust = np.where(inv_missing[row_inv], np.nan, cust_ids[inv_cust[row_inv]])
+
+    df_buy = pd.DataFrame(
+        {
+            "InvoiceNo": inv_nums[row_inv].astype(str),
+            "StockCode": codes,
+            "Description": desc,
+            "Quantity": quantity,
+            "InvoiceDate": pd.to_datetime(inv_secs[row_inv], unit="s"),
+            "UnitPrice": price,
+            "CustomerID": row_cust,
+            "Country": np.array(COUNTRIES, dtype=object)[inv_country[row_inv]],
+        }
+    )
+
+    # Cancellations refer back to earlier purchases of
+    # the same customer and product with the same or a
+    # lower quantity. They get their own "C" invoices.
+    candidates = np.flatnonzero(~inv_missing[row_inv] & ~is_service)
+    n_cancel = min(n_cancel, candidates.shape[0])
+    canc_rows = np.sort(rng.choice(candidates, size=n_cancel, replace=False))
+    df_canc = df_buy.iloc[canc_rows].copy()
+
+    canc_delay = rng.integers(60, 30 * 24 * 3600, size=n_cancel) // 60 * 60
+    canc_secs = np.minimum(inv_secs[row_inv[canc_rows]] + canc_delay, end)
+    df_canc["InvoiceDate"] = pd.to_datetime(canc_secs, unit="s")
+    df_canc["Quantity"] = -rng.integers(1, df_canc["Quantity"].values + 1)
+
+    _, canc_inv = np.unique(row_inv[canc_rows], return_inverse=True)
+    df_canc["InvoiceNo"] = np.char.add("C", (inv_nums[-1] + 1 + canc_inv).astype(str))
+
+    df_raw = pd.concat([df_buy, df_canc], ignore_index=True)
+    df_raw = df_raw.sort_values(by="InvoiceDate", kind="mergesort")
+
+    return df_raw.reset_index(drop=True)[RAW_COLUMNS]
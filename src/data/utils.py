@@ -9,9 +9,30 @@ functionality that automates common
 tasks you do during a project.
 """
 
+import uuid
+import pickle
+from pathlib import Path
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
 import pandas as pd
+from src.data import profiling
+
+# Byte alignment of the columns in shared memory
+_ALIGN = 64
+
+# The shared frames this process attached to
+# (kept so the memory stays mapped) and released
+# blocks with views that are still in use
+_ATTACHED = {}
+_IN_USE = []
 
+# Nullable arrays shared as their values and mask
+_MASKED_ARRAYS = ["IntegerArray", "FloatingArray", "BooleanArray"]
 
+
+@profiling.instrument
 def rearrange_and_rename(df, col_order, rename_dict=None):
     """
     Takes in a dataframe, a column
@@ -82,7 +103,7 @@ def cap_col(col, q):
 
     cap_val = col.quantile(q)
 
-    return col.apply(lambda x: cap_val if x > cap_val else x)
+    return col.clip(upper=cap_val)
 
 
 def print_bold(txt):
@@ -164,6 +185,7 @@ def quick_summary(df, title, row_num=5, show_summary=True):
     return
 
 
+@profiling.instrument
 def missing_summary(df):
     """
     Takes in a dataframe and 
@@ -202,3 +224,479 @@ def missing_summary(df):
     df_miss.columns = ["Column", "Not-Null", "Missing", "Perc Missing (%)"]
 
     return df_miss
+
+
+def get_columns(source):
+    """
+    Returns the column names of a data
+    source without loading its values.
+
+    Parameters:
+    -----------
+
+    source : dataframe, str, Path or pyarrow Table
+
+    A dataframe, a path to a csv / parquet
+    / pickle file or an Arrow table
+
+    Returns:
+    --------
+
+    columns : list
+
+    The column names of the source
+
+    """
+
+    if isinstance(source, pd.DataFrame):
+        return list(source.columns)
+
+    # Arrow tables (and datasets) expose their schema
+    if hasattr(source, "schema") and hasattr(source, "select"):
+        return list(source.schema.names)
+
+    suffix = Path(source).suffix.lower()
+
+    if suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        return list(pq.read_schema(source).names)
+
+    if suffix in [".pkl", ".pickle"]:
+        return list(pd.read_pickle(source).columns)
+
+    return list(pd.read_csv(source, nrows=0).columns)
+
+
+@profiling.instrument
+def select_columns(source, columns, optional=None):
+    """
+    Loads only the given columns of a data
+    source. For parquet, csv and Arrow
+    sources the other columns are never
+    read. None entries and duplicate names
+    are ignored.
+
+    Parameters:
+    -----------
+
+    source : dataframe, str, Path or pyarrow Table
+
+    A dataframe, a path to a csv / parquet
+    / pickle file or an Arrow table
+
+    columns : list
+
+    The columns to keep. A KeyError is
+    raised if any of them is missing.
+
+    optional : list (default = None)
+
+    Columns to keep only if the source has
+    them (e.g. a color that may not be
+    a column)
+
+    Returns:
+    --------
+
+    df_out : dataframe
+
+    A dataframe with only the
+    requested columns
+
+    """
+
+    available = get_columns(source)
+
+    missing = [col for col in columns if (col is not None) and (col not in available)]
+    if missing:
+        raise KeyError(f"Columns not found: {missing}")
+
+    cols = []
+    for col in list(columns) + list(optional or []):
+        if (col is not None) and (col in available) and (col not in cols):
+            cols.append(col)
+
+    if isinstance(source, pd.DataFrame):
+        return source.loc[:, cols]
+
+    if hasattr(source, "schema") and hasattr(source, "select"):
+        return source.select(cols).to_pandas()
+
+    suffix = Path(source).suffix.lower()
+
+    if suffix == ".parquet":
+        return pd.read_parquet(source, columns=cols)
+
+    if suffix in [".pkl", ".pickle"]:
+        return pd.read_pickle(source).loc[:, cols]
+
+    return pd.read_csv(source, usecols=cols)[cols]
+
+
+def _codes_dtype(n_categories):
+    """
+    The smallest integer type pandas
+    uses for categorical codes (so
+    the codes are not copied)
+    """
+
+    for dtype in [np.int8, np.int16, np.int32]:
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+
+    return np.int64
+
+
+def _column_layout(values):
+    """
+    Returns the arrays to copy into shared
+    memory for a column and how to read it
+    back:
+
+    - numbers, booleans and dates as they are
+    - nullable columns (e.g. Int64) as their
+      values and missing value mask
+    - dates with a time zone as UTC dates
+    - categoricals as their codes
+    - text (object or string) columns as
+      factorized codes
+
+    The categories are pickled into the block
+    as well so the size of the handle does
+    not depend on the data.
+    """
+
+    dtype = values.dtype
+
+    if isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+        return [np.ascontiguousarray(values)], {"kind": "array"}
+
+    if type(values).__name__ in _MASKED_ARRAYS:
+        data = values.to_numpy(dtype=dtype.numpy_dtype, na_value=0)
+        mask = np.asarray(values.isna())
+        return [data, mask], {"kind": "masked", "array_type": type(values).__name__}
+
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        utc = np.asarray(values.tz_convert(None))
+        return [utc], {"kind": "datetimetz", "tz": dtype.tz}
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        codes = np.asarray(values.codes)
+        layout = {"kind": "codes", "ordered": dtype.ordered, "text": False}
+        return [codes, _pickled(dtype.categories)], layout
+
+    if dtype == object or isinstance(dtype, pd.StringDtype):
+        codes, uniques = pd.factorize(values)
+        codes = codes.astype(_codes_dtype(len(uniques)))
+        layout = {"kind": "codes", "ordered": False, "text": True}
+        return [codes, _pickled(uniques)], layout
+
+    raise TypeError(f"Columns of type {dtype} can't be shared.")
+
+
+def _pickled(obj):
+    """
+    The bytes of a pickled
+    object as a numpy array
+    """
+
+    return np.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), np.uint8)
+
+
+def _backing_array(obj):
+    """
+    The numpy array of a column or index
+    (no copy) or its extension array
+    """
+
+    if isinstance(obj.dtype, np.dtype):
+        return obj.values
+
+    return obj.array
+
+
+@profiling.instrument
+def publish_dataframe(df):
+    """
+    Copies the columns of a dataframe into
+    one block of shared memory. Worker
+    processes attach to it by the (small)
+    handle so the table is never pickled.
+    The block has to be released with
+    release_dataframe() (or use
+    shared_dataframe() instead).
+    
+    Parameters:
+    -----------
+    
+    df : dataframe
+    
+    The dataframe to share
+    
+    Returns:
+    --------
+    
+    handle : dictionary
+    
+    The name of the shared memory and the
+    layout of every column. Its size does
+    not depend on the number of rows or
+    distinct values.
+    
+    """
+
+    if not df.columns.is_unique:
+        raise ValueError("Only dataframes with unique column names can be shared.")
+
+    columns = [(col, _backing_array(df[col])) for col in df.columns]
+
+    # A RangeIndex is rebuilt from its bounds,
+    # any other index is shared like a column
+    if isinstance(df.index, pd.RangeIndex):
+        index = {"start": df.index.start, "stop": df.index.stop, "step": df.index.step}
+    else:
+        index = None
+        columns.append((None, _backing_array(df.index)))
+
+    layouts = []
+    arrays = []
+    offset = 0
+
+    for col, values in columns:
+        col_arrays, layout = _column_layout(values)
+        layout["name"] = col
+        layout["buffers"] = []
+
+        for array in col_arrays:
+            layout["buffers"].append(
+                {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+            )
+            arrays.append(array)
+            offset += -(-array.nbytes // _ALIGN) * _ALIGN
+
+        layouts.append(layout)
+
+    shm = shared_memory.SharedMemory(
+        name=f"ecom_{uuid.uuid4().hex[:16]}", create=True, size=max(offset, 1)
+    )
+
+    buffers = [buffer for layout in layouts for buffer in layout["buffers"]]
+    for buffer, array in zip(buffers, arrays):
+        target = np.ndarray(
+            array.shape, dtype=array.dtype, buffer=shm.buf, offset=buffer["offset"]
+        )
+        target[:] = array
+
+    shm.close()
+
+    return {
+        "shm_name": shm.name,
+        "columns": layouts,
+        "index": index,
+        "index_name": df.index.name,
+    }
+
+
+def _open_shared_memory(name):
+    """
+    Attaches to an existing block without
+    registering it with the resource
+    tracker. Only the creator releases it,
+    otherwise the block could be removed
+    when a worker exits.
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Python < 3.13 has no track argument
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _buffer_view(shm, buffer):
+    """
+    A read-only array on top
+    of a buffer of the block
+    """
+
+    array = np.ndarray(
+        (buffer["length"],),
+        dtype=np.dtype(buffer["dtype"]),
+        buffer=shm.buf,
+        offset=buffer["offset"],
+    )
+    array.setflags(write=False)
+
+    return array
+
+
+def _from_codes(codes, categories, ordered):
+    """
+    A categorical on top of the shared
+    codes without checking them again
+    """
+
+    dtype = pd.CategoricalDtype(categories, ordered=ordered)
+
+    # Only pandas >= 2.1 can skip the check
+    try:
+        return pd.Categorical.from_codes(codes, dtype=dtype, validate=False)
+    except TypeError:
+        return pd.Categorical.from_codes(codes, dtype=dtype)
+
+
+def _read_column(arrays, layout, categorical):
+    """
+    Rebuilds a column from the views
+    of its buffers (see _column_layout)
+    """
+
+    if layout["kind"] == "masked":
+        array_type = getattr(pd.arrays, layout["array_type"])
+        return array_type(arrays[0], arrays[1], copy=False)
+
+    # pandas can't build time zone dates on
+    # top of an array so these are a copy
+    if layout["kind"] == "datetimetz":
+        values = pd.Series(arrays[0]).dt.tz_localize("UTC")
+        return values.dt.tz_convert(layout["tz"]).array
+
+    if layout["kind"] == "codes":
+        values = _from_codes(arrays[0], pickle.loads(arrays[1]), layout["ordered"])
+        if layout["text"] and not categorical:
+            values = values.astype(values.categories.dtype)
+        return values
+
+    return arrays[0]
+
+
+def attach_dataframe(handle, categorical=True):
+    """
+    Returns a read-only dataframe on top of
+    a shared block (see publish_dataframe).
+    The number, date and nullable columns
+    are views of the shared memory, nothing
+    is copied (dates with a time zone are
+    the exception). Attaching again in the same process
+    returns the same dataframe.
+    
+    Parameters:
+    -----------
+    
+    handle : dictionary
+    
+    The handle of publish_dataframe()
+    
+    categorical : bool (default = True)
+    
+    Return the text columns as categoricals
+    on top of the shared codes. If False
+    they are decoded into their original
+    type (a copy per process).
+    
+    Returns:
+    --------
+    
+    df : dataframe
+    
+    The shared dataframe. Changing it
+    makes a private copy (copy on write).
+    
+    """
+
+    key = (handle["shm_name"], categorical)
+    if key in _ATTACHED:
+        return _ATTACHED[key][1]
+
+    shm = _open_shared_memory(handle["shm_name"])
+    data = {}
+    index = None
+
+    for layout in handle["columns"]:
+
+        arrays = [_buffer_view(shm, buffer) for buffer in layout["buffers"]]
+
+        # The index keeps the type it was published with
+        if layout["name"] is None:
+            values = _read_column(arrays, layout, categorical=False)
+            index = pd.Index(values, name=handle["index_name"])
+        else:
+            data[layout["name"]] = _read_column(arrays, layout, categorical)
+
+    if index is None:
+        index = pd.RangeIndex(**handle["index"], name=handle["index_name"])
+
+    df = pd.DataFrame(data, index=index, copy=False)
+    _ATTACHED[key] = (shm, df)
+
+    return df
+
+
+def release_dataframe(handle):
+    """
+    Frees the shared memory of a published
+    dataframe. Processes that are still
+    attached (this one included) keep their
+    mapping until they exit.
+    """
+
+    # The dataframes attached here may still be in
+    # use so their mapping can't be closed. The block
+    # is unlinked and goes away with the process.
+    for key in [key for key in _ATTACHED if key[0] == handle["shm_name"]]:
+        _IN_USE.append(_ATTACHED.pop(key))
+
+    try:
+        shm = shared_memory.SharedMemory(name=handle["shm_name"])
+    except FileNotFoundError:
+        return
+
+    shm.close()
+    shm.unlink()
+
+
+@contextmanager
+def shared_dataframe(df):
+    """
+    Shares a dataframe with worker processes
+    for the duration of a with block and
+    frees the memory afterwards. Pass the
+    handle to the tasks and call
+    attach_dataframe() inside them.
+
+    Usage:
+
+        with shared_dataframe(df) as handle:
+            with ProcessPoolExecutor() as executor:
+                results = executor.map(task, [handle] * n, chunks)
+    
+    Parameters:
+    -----------
+    
+    df : dataframe
+    
+    The dataframe to share
+    
+    Returns:
+    --------
+    
+    handle : dictionary
+    
+    The handle (see publish_dataframe)
+    
+    """
+
+    handle = publish_dataframe(df)
+
+    try:
+        yield handle
+    finally:
+        release_dataframe(handle)
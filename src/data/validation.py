@@ -0,0 +1,354 @@
+"""
+VALIDATION Module
+-----------------
+
+@author : Stratoshad
+
+This module checks the transactions
+against a set of declarative rules (see
+RAW_RULES) and reports the violations.
+
+There are two kinds of rules. Row rules
+are a pandas expression that is True for
+the rows that break the rule. Group rules
+limit the number of distinct values of a
+column per key (e.g. one date per invoice).
+All group rules on the same key share one
+factorization of it, and the distinct
+(key, value) pairs they keep can be merged
+across chunks so partitioned data is
+checked one chunk at a time.
+
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+# The checks of NB1 on the raw transactions
+# (after the "Cancelled" column is added)
+RAW_RULES = [
+    {
+        "name": "invoice_multiple_dates",
+        "by": "InvoiceNo",
+        "col": "InvoiceDate",
+        "max_unique": 1,
+        "message": "Invoices with more than one date",
+    },
+    {
+        "name": "non_positive_quantity",
+        "expr": "Cancelled == 0 and Quantity <= 0",
+        "message": "Non-cancelled rows with a zero or negative quantity",
+    },
+    {
+        "name": "non_positive_price",
+        "expr": "Cancelled == 0 and UnitPrice <= 0",
+        "message": "Non-cancelled rows with a zero or negative unit price",
+    },
+    {
+        "name": "stock_code_multiple_descriptions",
+        "by": "StockCode",
+        "col": "Description",
+        "max_unique": 1,
+        "message": "Stock codes with more than one description",
+    },
+    {
+        "name": "customer_multiple_countries",
+        "by": "CustomerID",
+        "col": "Country",
+        "max_unique": 1,
+        "where": "CustomerID != '00000'",
+        "message": "Customers with more than one country",
+    },
+    {
+        "name": "reserved_customer_id",
+        "expr": "CustomerID == '00000'",
+        "message": "Rows that already use the missing customer id '00000'",
+    },
+]
+
+# The check at the end of process_cancellations()
+CANCELLATION_RULES = [
+    {
+        "name": "cancelled_above_bought",
+        "expr": "Cancelled != 1 and StockCode != 'D' and Quantity < Quantity_Canc",
+        "message": "Rows with more cancelled than bought quantity",
+    },
+]
+
+
+def _rule_kind(rule):
+
+    """
+    Returns "row" or "group"
+    for a rule definition
+    """
+
+    if "expr" in rule:
+        return "row"
+    if "by" in rule and "col" in rule:
+        return "group"
+
+    raise ValueError(f"Rule '{rule.get('name')}' needs an 'expr' or a 'by' and 'col'.")
+
+
+def _group_pairs(df, by, cols):
+
+    """
+    The distinct (key, value) pairs of every
+    column. The key is factorized once for
+    all the columns.
+    """
+
+    key_codes, key_uniques = pd.factorize(df[by])
+    pairs = {}
+
+    for col in cols:
+
+        val_codes, val_uniques = pd.factorize(df[col])
+        valid = (key_codes >= 0) & (val_codes >= 0)
+        n_vals = max(len(val_uniques), 1)
+
+        keys = pd.unique(key_codes[valid].astype(np.int64) * n_vals + val_codes[valid])
+        pairs[col] = pd.DataFrame(
+            {by: key_uniques[keys // n_vals], col: val_uniques[keys % n_vals]}
+        )
+
+    return pairs
+
+
+def _check_chunk(df, rules, n_samples):
+
+    """
+    The partial result of every rule for one
+    chunk: the count and sample index of the
+    row rules and the distinct pairs of the
+    group rules. Rules with missing columns
+    get None.
+    """
+
+    partials = {}
+    groups = {}
+
+    for rule in rules:
+
+        if _rule_kind(rule) == "row":
+            try:
+                mask = df.eval(rule["expr"]).values.astype(bool)
+            except pd.errors.UndefinedVariableError:
+                partials[rule["name"]] = None
+                continue
+
+            partials[rule["name"]] = (int(mask.sum()), list(df.index[mask][:n_samples]))
+
+        elif rule["by"] not in df.columns or rule["col"] not in df.columns:
+            partials[rule["name"]] = None
+
+        else:
+            groups.setdefault((rule["by"], rule.get("where")), []).append(rule)
+
+    # One pass per key (and filter) for all
+    # the group rules that use it
+    for (by, where), group_rules in groups.items():
+
+        cols = list(dict.fromkeys(rule["col"] for rule in group_rules))
+
+        try:
+            df_sub = df if where is None else df.loc[df.eval(where).values.astype(bool)]
+        except pd.errors.UndefinedVariableError:
+            partials.update({rule["name"]: None for rule in group_rules})
+            continue
+
+        pairs = _group_pairs(df_sub, by, cols)
+
+        for rule in group_rules:
+            partials[rule["name"]] = pairs[rule["col"]]
+
+    return partials
+
+
+def _merge_partials(partial_a, partial_b, n_samples):
+
+    """
+    Adds up the partial results
+    of two chunks for a rule
+    """
+
+    if partial_a is None:
+        return partial_b
+    if partial_b is None:
+        return partial_a
+
+    if isinstance(partial_a, tuple):
+        return (
+            partial_a[0] + partial_b[0],
+            (partial_a[1] + partial_b[1])[:n_samples],
+        )
+
+    return pd.concat([partial_a, partial_b], ignore_index=True).drop_duplicates()
+
+
+def _build_report(rules, partials, n_samples, errors):
+
+    """
+    Turns the partial results into the
+    violations report and warns or
+    raises for the failed rules
+    """
+
+    rows = []
+
+    for rule in rules:
+
+        partial = partials.get(rule["name"])
+        row = {"rule": rule["name"], "kind": _rule_kind(rule)}
+
+        if partial is None:
+            row.update({"status": "skipped", "count": 0, "sample": []})
+
+        elif row["kind"] == "row":
+            row.update({"count": partial[0], "sample": partial[1]})
+
+        else:
+            counts = partial[rule["by"]].value_counts(sort=False)
+            violators = counts.index[counts > rule.get("max_unique", 1)]
+            row.update({"count": len(violators), "sample": list(violators[:n_samples])})
+
+        if "status" not in row:
+            row["status"] = "failed" if row["count"] > 0 else "passed"
+
+        row["message"] = rule.get("message", "")
+        rows.append(row)
+
+    df_report = pd.DataFrame(
+        rows, columns=["rule", "kind", "status", "count", "sample", "message"]
+    )
+    failed = df_report.loc[df_report["status"] == "failed"]
+
+    if len(failed) > 0 and errors != "ignore":
+        text = "; ".join(
+            f"{row.message} ({row.count})" for row in failed.itertuples(index=False)
+        )
+        if errors == "raise":
+            raise ValueError(f"Validation failed: {text}")
+        warnings.warn(f"Validation failed: {text}")
+
+    return df_report
+
+
+@instrument
+def validate(df, rules=None, n_samples=5, errors="warn"):
+
+    """
+    Checks a dataframe against a set of
+    rules and reports the violations.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The transactions
+
+    rules : list (default = None)
+
+    The rule definitions. If None
+    it uses RAW_RULES.
+
+    n_samples : int (default = 5)
+
+    The number of violating rows (index
+    labels) or groups (keys) per rule
+
+    errors : str (default = "warn")
+
+    "warn", "raise" (ValueError) or
+    "ignore" for failed rules
+
+    Returns:
+    --------
+
+    df_report : dataframe
+
+    The "rule", "kind", "status" ("passed",
+    "failed" or "skipped" for missing
+    columns), the "count" of violating
+    rows or groups and a "sample" of them
+
+    """
+
+    rules = RAW_RULES if rules is None else rules
+
+    return _build_report(rules, _check_chunk(df, rules, n_samples), n_samples, errors)
+
+
+@instrument
+def validate_chunks(chunks, rules=None, n_samples=5, errors="warn"):
+
+    """
+    Checks data that comes in chunks (e.g.
+    the ingested partitions or a chunked
+    pd.read_csv()) one chunk at a time.
+    Groups can span chunks and are still
+    checked as a whole.
+
+    Parameters:
+    -----------
+
+    chunks : iterable of dataframes
+
+    The chunks of the transactions
+
+    rules : list (default = None)
+
+    The rule definitions. If None
+    it uses RAW_RULES.
+
+    n_samples : int (default = 5)
+
+    The number of violating rows (index
+    labels) or groups (keys) per rule
+
+    errors : str (default = "warn")
+
+    "warn", "raise" (ValueError) or
+    "ignore" for failed rules
+
+    Returns:
+    --------
+
+    df_report : dataframe
+
+    The violations report (see validate)
+
+    """
+
+    rules = RAW_RULES if rules is None else rules
+    partials = {}
+
+    for df_chunk in chunks:
+        for name, partial in _check_chunk(df_chunk, rules, n_samples).items():
+            partials[name] = _merge_partials(partials.get(name), partial, n_samples)
+
+    return _build_report(rules, partials, n_samples, errors)
+
+
+def sample_rows(df, df_report, rule, rules=None):
+
+    """
+    Returns the sample rows of a rule of
+    the report (all the rows of the sample
+    groups for group rules)
+    """
+
+    rules = RAW_RULES if rules is None else rules
+    definition = {r["name"]: r for r in rules}[rule]
+    sample = df_report.set_index("rule").loc[rule, "sample"]
+
+    if _rule_kind(definition) == "row":
+        return df.loc[sample]
+
+    return df.loc[df[definition["by"]].isin(sample)]
@@ -10,14 +10,16 @@ or aggregation.
 
 """
 
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import warnings
+from src.data import validation
+from src.data.profiling import instrument
 
 
-def process_cancellations(df, limit_rows=None):
+@instrument
+def process_cancellations(df):
     """
     Takes in the dataframe of transactions
     and identifies all cancellations. It
@@ -43,13 +45,9 @@ def process_cancellations(df, limit_rows=None):
     df : dataframe
     
     A dataframe of transactions that
-    has the "Cancelled" column
-    
-    limit_rows : int (default : None)
-    
-    Limits the numbers of cancellations to
-    look through. This is useful for testing. If
-    None looks through all of them.
+    has the "Cancelled" column. For quick
+    runs pass a sample of the customers
+    (see make_dataset.sample_customers).
     
     Returns:
     --------
@@ -67,6 +65,8 @@ def process_cancellations(df, limit_rows=None):
     
     """
 
+    from tqdm import tqdm
+
     # Create the main dataframes
     df_clean = df.copy()
     df_cancel = df_clean.loc[
@@ -79,10 +79,6 @@ def process_cancellations(df, limit_rows=None):
     df_clean["Quantity_Canc"] = 0
     df_clean["Cancel_Date"] = np.nan
 
-    if limit_rows is not None:
-
-        df_cancel = df_cancel.iloc[:limit_rows]
-
     for index, row in tqdm(df_cancel.iterrows(), total=df_cancel.shape[0]):
         #     for index, row in df_cancel.iterrows():
         # Extract all useful information
@@ -231,16 +227,12 @@ def process_cancellations(df, limit_rows=None):
 
     # At the end ensure that we don't have any canceled quantities above
     # the actual quantity except for Discounts
-    df_test = df_clean[
-        (df_clean["Cancelled"] != 1) & (df_clean["StockCode"] != "D")
-    ].copy()
-    assert (
-        df_test["Quantity"] < df_test["Quantity_Canc"]
-    ).sum() == 0, "There are transactions with canceled quantities > bought quantities"
+    validation.validate(df_clean, validation.CANCELLATION_RULES, errors="raise")
 
     return df_clean, match_dict
 
 
+@instrument
 def get_df_date_features(date_df, date_column):
 
     """
@@ -341,6 +333,7 @@ def get_df_date_features(date_df, date_column):
     return df_edited
 
 
+@instrument
 def get_customer_lifetime(df_cust, ref_date, start_date):
     """
     Takes in a customer dataframe and
@@ -393,6 +386,7 @@ def get_customer_lifetime(df_cust, ref_date, start_date):
     return df_life
 
 
+@instrument
 def get_purchase_freq(df_inv, df_cust):
 
     """
@@ -424,6 +418,8 @@ def get_purchase_freq(df_inv, df_cust):
     
     """
 
+    from tqdm import tqdm
+
     # Copy the dataframes
     df_cust_ind = df_cust.copy()
     df_main = df_inv.copy()
@@ -479,6 +475,7 @@ def get_purchase_freq(df_inv, df_cust):
     return df_freq
 
 
+@instrument
 def get_time_inactive(df_cust, ref_date):
     """
     Takes in a customer dataframe and
@@ -524,6 +521,7 @@ def get_time_inactive(df_cust, ref_date):
     return df_out
 
 
+@instrument
 def get_customer_rates(df_cust):
 
     """
@@ -563,6 +561,7 @@ def get_customer_rates(df_cust):
     return df_out
 
 
+@instrument
 def process_customer_data(df_cust, df_inv):
     """
     Takes in the customer dataframe
@@ -602,3 +601,804 @@ def process_customer_data(df_cust, df_inv):
     df_out = get_customer_rates(df_cust=df_out)
 
     return df_out
+
+
+@instrument
+def get_customer_table(df_clean):
+    """
+    Aggregates the cleaned transactions
+    per customer (see NB1).
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    
+    Returns:
+    --------
+    
+    df_cust : dataframe
+    
+    One row per customer and country
+    sorted by the total spend
+    
+    """
+
+    df_clean = df_clean.copy()
+
+    if "canc_loss" not in df_clean.columns:
+        df_clean["canc_loss"] = (
+            df_clean["qty_all"] * df_clean["unit_price"]
+        ) - df_clean["total_price"]
+
+    df_cust = df_clean[["customer_id", "country"]].drop_duplicates()
+
+    df_grp = df_clean.groupby(["customer_id", "country"]).agg(
+        orders=("invc_num", "nunique"),
+        first_purchase=("invc_date", "min"),
+        last_purchase=("invc_date", "max"),
+        quantity=("qty", "sum"),
+        unq_products=("stock_code", "nunique"),
+        total_spend=("total_price", "sum"),
+        cancel_rate=("full_canc", "mean"),
+        total_loss=("canc_loss", "sum"),
+    )
+
+    df_cust = df_cust.merge(
+        df_grp.reset_index(), how="left", on=["customer_id", "country"]
+    )
+
+    return df_cust.sort_values(by="total_spend", ascending=False)
+
+
+@instrument
+def get_product_table(df_clean):
+    """
+    Aggregates the cleaned transactions
+    per product (see NB1).
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    
+    Returns:
+    --------
+    
+    df_prod : dataframe
+    
+    One row per product sorted by
+    its share of the revenue
+    
+    """
+
+    df_prod = df_clean[["stock_code", "prod_desc"]].drop_duplicates()
+
+    df_grp = df_clean.groupby(["stock_code"]).agg(
+        sales=("qty", "sum"),
+        med_unit_price=("unit_price", "median"),
+        revenue=("total_price", "sum"),
+    )
+    df_grp = df_grp.reset_index()
+
+    # Add the "perc of total" columns
+    df_grp["sales_perc"] = (df_grp["sales"] / df_grp["sales"].sum()).round(3)
+    df_grp["revenue_perc"] = (df_grp["revenue"] / df_grp["revenue"].sum()).round(3)
+
+    df_prod = df_prod.merge(df_grp, how="left", on="stock_code")
+
+    return df_prod.sort_values(by="revenue_perc", ascending=False)
+
+
+@instrument
+def get_invoice_table(df_clean):
+    """
+    Aggregates the cleaned transactions
+    per invoice (see NB1).
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    
+    Returns:
+    --------
+    
+    df_invc : dataframe
+    
+    One row per invoice with the cancellation
+    and discount flags sorted by the revenue
+    
+    """
+
+    df_invc = df_clean[["invc_num", "customer_id", "invc_date"]].drop_duplicates()
+
+    df_grp = df_clean.groupby(["invc_num"]).agg(
+        total_qty=("qty", "sum"),
+        unq_products=("stock_code", "nunique"),
+        revenue=("total_price", "sum"),
+        perc_canc=("full_canc", "mean"),
+        item_list=("prod_desc", list),
+    )
+    df_grp = df_grp.reset_index()
+
+    # Add the cancellation and discount flag
+    df_grp["cancelled"] = (df_grp["perc_canc"] == 1).astype(int)
+    df_grp["is_discount"] = (df_grp["total_qty"] < 0).astype(int)
+
+    df_invc = df_invc.merge(df_grp, on=["invc_num"], how="outer")
+
+    return df_invc.sort_values(by="revenue", ascending=False)
+
+
+@instrument
+def get_main_table(df_clean, df_invc):
+    """
+    Builds the main dataframe of NB1 with
+    one row per customer and invoice, the
+    invoice metrics and the date features.
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    
+    df_invc : dataframe
+    
+    The invoice table (see get_invoice_table)
+    
+    Returns:
+    --------
+    
+    df_main : dataframe
+    
+    The main dataframe
+    
+    """
+
+    agg_cols = ["customer_id", "invc_num", "country"]
+    df_main = df_clean.groupby(agg_cols)["invc_date"].min().reset_index()
+
+    df_main = df_main.merge(
+        df_invc, on=["customer_id", "invc_num", "invc_date"], how="left"
+    )
+
+    return get_df_date_features(df_main, date_column="invc_date")
+
+
+def _invoice_aggregates(df_part):
+    """
+    The per invoice metrics of NB1 for
+    the rows of a partition (indexed
+    by the invoice code)
+    """
+
+    df_grp = df_part.groupby("_invc").agg(
+        total_qty=("qty", "sum"),
+        unq_products=("_stock", "nunique"),
+        revenue=("total_price", "sum"),
+        perc_canc=("full_canc", "mean"),
+    )
+
+    # A "list" aggregation runs python code per group
+    # so split the sorted descriptions in one go instead
+    codes = df_part["_invc"].values
+    order = np.argsort(codes, kind="stable")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    descs = np.split(df_part["prod_desc"].to_numpy(dtype=object)[order], bounds)
+    df_grp["item_list"] = [desc.tolist() for desc in descs]
+
+    return df_grp
+
+
+def _dimension_partials(df_part):
+    """
+    Computes the partial aggregates of
+    one customer partition. Customers and
+    their invoices are complete within a
+    partition while the products are split
+    across them and merged later on.
+    """
+
+    cust = df_part.groupby("_cust").agg(
+        orders=("_invc", "nunique"),
+        first_purchase=("invc_date", "min"),
+        last_purchase=("invc_date", "max"),
+        quantity=("qty", "sum"),
+        unq_products=("_stock", "nunique"),
+        total_spend=("total_price", "sum"),
+        cancel_rate=("full_canc", "mean"),
+        total_loss=("canc_loss", "sum"),
+    )
+
+    invc = _invoice_aggregates(df_part)
+    invc_keys = df_part[["_invc", "_custid", "invc_date"]].drop_duplicates()
+    main = df_part.groupby(["_custid", "_invc", "_country"])["invc_date"].min()
+
+    # Sums and price counts can be added up across
+    # partitions (the median comes from the counts)
+    prod = df_part.groupby("_stock")[["qty", "total_price"]].sum()
+    prices = df_part.groupby(["_stock", "unit_price"]).size()
+
+    return cust, invc, invc_keys, main, prod, prices
+
+
+def _median_from_counts(prices):
+    """
+    Takes a series of counts indexed by
+    (key, value) and returns the median
+    value of every key (the mean of the
+    two middle values for even counts)
+    """
+
+    prices = prices.sort_index()
+    keys = prices.index.get_level_values(0).values
+    values = prices.index.get_level_values(1).values
+    cum = np.cumsum(prices.values)
+
+    # Position of every key in the sorted counts
+    uniq_keys, starts = np.unique(keys, return_index=True)
+    offsets = np.concatenate([[0], cum[starts[1:] - 1]])
+    totals = np.append(offsets[1:], cum[-1]) - offsets
+
+    lower = np.searchsorted(cum, offsets + (totals - 1) // 2, side="right")
+    upper = np.searchsorted(cum, offsets + totals // 2, side="right")
+
+    return pd.Series((values[lower] + values[upper]) / 2, index=uniq_keys)
+
+
+@instrument
+def build_dimension_tables(df_clean, n_jobs=1, n_partitions=None):
+    """
+    Builds the customer, product and invoice
+    tables and the main dataframe of NB1 in a
+    single pass over the cleaned transactions.
+
+    The keys are factorized once and the rows
+    are split into customer partitions with
+    one stable sort. Each partition is
+    aggregated (optionally in parallel threads)
+    and the partial results are combined. The
+    output is the same as get_customer_table(),
+    get_product_table(), get_invoice_table()
+    and get_main_table().
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    
+    n_jobs : int (default = 1)
+    
+    The number of threads
+    
+    n_partitions : int (default = None)
+    
+    The number of customer partitions.
+    If None it uses one per thread.
+    
+    Returns:
+    --------
+    
+    tables : dictionary
+    
+    The dataframes under the keys
+    "customers", "products", "invoices"
+    and "main"
+    
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    n_partitions = n_jobs if n_partitions is None else n_partitions
+
+    # Factorize every key once. The codes follow the
+    # order of appearance which is the order NB1 uses
+    cust_codes, cust_uniq = pd.factorize(df_clean["customer_id"])
+    country_codes, country_uniq = pd.factorize(df_clean["country"])
+    invc_codes, invc_uniq = pd.factorize(df_clean["invc_num"])
+    stock_codes, stock_uniq = pd.factorize(df_clean["stock_code"])
+    desc_codes, desc_uniq = pd.factorize(df_clean["prod_desc"])
+
+    pair_codes, pair_uniq = pd.factorize(
+        cust_codes.astype(np.int64) * len(country_uniq) + country_codes
+    )
+    prod_codes, prod_uniq = pd.factorize(
+        stock_codes.astype(np.int64) * len(desc_uniq) + desc_codes
+    )
+
+    df_rows = pd.DataFrame(
+        {
+            "_cust": pair_codes,
+            "_custid": cust_codes,
+            "_country": country_codes,
+            "_invc": invc_codes,
+            "_stock": stock_codes,
+            "invc_date": df_clean["invc_date"].values,
+            "qty": df_clean["qty"].values,
+            "unit_price": df_clean["unit_price"].values,
+            "total_price": df_clean["total_price"].values,
+            "full_canc": df_clean["full_canc"].values,
+            "prod_desc": df_clean["prod_desc"].to_numpy(dtype=object),
+        }
+    )
+
+    if "canc_loss" in df_clean.columns:
+        df_rows["canc_loss"] = df_clean["canc_loss"].values
+    else:
+        df_rows["canc_loss"] = (
+            df_clean["qty_all"].values * df_clean["unit_price"].values
+        ) - df_clean["total_price"].values
+
+    # Split into customer partitions with one stable
+    # sort so the row order inside them is kept
+    if n_partitions > 1:
+        part_ids = cust_codes % n_partitions
+        order = np.argsort(part_ids, kind="stable")
+        bounds = np.searchsorted(part_ids[order], np.arange(n_partitions + 1))
+        parts = [
+            df_rows.iloc[order[bounds[i] : bounds[i + 1]]] for i in range(n_partitions)
+        ]
+        parts = [part for part in parts if part.shape[0] > 0]
+    else:
+        parts = [df_rows]
+
+    if n_jobs > 1 and len(parts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            partials = list(executor.map(_dimension_partials, parts))
+    else:
+        partials = [_dimension_partials(part) for part in parts]
+
+    cust_parts, invc_parts, key_parts, main_parts, prod_parts, price_parts = zip(
+        *partials
+    )
+
+    # Customers
+    df_grp = pd.concat(cust_parts).sort_index()
+    pair_uniq = np.asarray(pair_uniq)
+    df_cust = pd.DataFrame(
+        {
+            "customer_id": cust_uniq[pair_uniq // len(country_uniq)],
+            "country": country_uniq[pair_uniq % len(country_uniq)],
+        }
+    )
+    df_cust = pd.concat([df_cust, df_grp.reset_index(drop=True)], axis=1)
+    df_cust = df_cust.sort_values(by="total_spend", ascending=False)
+
+    # Products
+    df_grp = pd.concat(prod_parts).groupby(level=0).sum()
+    df_grp = df_grp.rename(columns={"qty": "sales", "total_price": "revenue"})
+    df_grp["med_unit_price"] = _median_from_counts(
+        pd.concat(price_parts).groupby(level=[0, 1]).sum()
+    )
+    df_grp = df_grp[["sales", "med_unit_price", "revenue"]]
+    df_grp["sales_perc"] = (df_grp["sales"] / df_grp["sales"].sum()).round(3)
+    df_grp["revenue_perc"] = (df_grp["revenue"] / df_grp["revenue"].sum()).round(3)
+
+    prod_uniq = np.asarray(prod_uniq)
+    prod_stock = prod_uniq // len(desc_uniq)
+    df_prod = pd.DataFrame(
+        {
+            "stock_code": stock_uniq[prod_stock],
+            "prod_desc": desc_uniq[prod_uniq % len(desc_uniq)],
+        }
+    )
+    df_prod = pd.concat(
+        [df_prod, df_grp.loc[prod_stock].reset_index(drop=True)], axis=1
+    )
+    df_prod = df_prod.sort_values(by="revenue_perc", ascending=False)
+
+    # Invoices. An invoice with rows from more than one
+    # customer ends up in several partitions so those
+    # are aggregated again over all of their rows
+    df_grp = pd.concat(invc_parts)
+    split_invs = df_grp.index[df_grp.index.duplicated()].unique()
+
+    if len(split_invs) > 0:
+        df_grp = pd.concat(
+            [
+                df_grp.loc[~df_grp.index.isin(split_invs)],
+                _invoice_aggregates(df_rows.loc[df_rows["_invc"].isin(split_invs)]),
+            ]
+        )
+
+    df_grp = df_grp.sort_index()
+    df_grp.index = invc_uniq[df_grp.index.values]
+    df_grp = df_grp.rename_axis("invc_num").reset_index()
+    df_grp["cancelled"] = (df_grp["perc_canc"] == 1).astype(int)
+    df_grp["is_discount"] = (df_grp["total_qty"] < 0).astype(int)
+
+    df_keys = pd.concat(key_parts).drop_duplicates()
+    df_keys = pd.DataFrame(
+        {
+            "invc_num": invc_uniq[df_keys["_invc"].values],
+            "customer_id": cust_uniq[df_keys["_custid"].values],
+            "invc_date": df_keys["invc_date"].values,
+        }
+    )
+    df_invc = df_keys.merge(df_grp, on=["invc_num"], how="outer")
+    df_invc = df_invc.sort_values(by="revenue", ascending=False)
+
+    # Main dataframe. Grouping the (small) combined
+    # result again gives the same order as NB1
+    df_main = pd.concat(main_parts).reset_index()
+    df_main = pd.DataFrame(
+        {
+            "customer_id": cust_uniq[df_main["_custid"].values],
+            "invc_num": invc_uniq[df_main["_invc"].values],
+            "country": country_uniq[df_main["_country"].values],
+            "invc_date": df_main["invc_date"].values,
+        }
+    )
+    agg_cols = ["customer_id", "invc_num", "country"]
+    df_main = df_main.groupby(agg_cols)["invc_date"].min().reset_index()
+    df_main = df_main.merge(
+        df_invc, on=["customer_id", "invc_num", "invc_date"], how="left"
+    )
+    df_main = get_df_date_features(df_main, date_column="invc_date")
+
+    return {
+        "customers": df_cust,
+        "products": df_prod,
+        "invoices": df_invc,
+        "main": df_main,
+    }
+
+
+@instrument
+def build_cohort_matrices(
+    df_clean, state=None, value_col="total_price", drop_anonymous=True
+):
+    """
+    Builds the monthly cohort matrices with
+    the acquisition month (first purchase)
+    as rows and the months since acquisition
+    as columns.
+
+    The transactions are reduced to one row
+    per customer and month in one grouped
+    pass and the months are integer offsets
+    so no dates are compared per customer.
+    The customer months are kept in a state
+    so a new month of invoices only needs
+    the new rows.
+    
+    Parameters:
+    -----------
+    
+    df_clean : dataframe
+    
+    The cleaned and renamed transactions
+    (or only the new ones when a state
+    is passed)
+    
+    state : dictionary (default = None)
+    
+    The "state" of an earlier call. The
+    new transactions are added to it.
+    
+    value_col : str (default = "total_price")
+    
+    The column summed for the revenue
+    
+    drop_anonymous : bool (default = True)
+    
+    Leave out the transactions without
+    a customer ("00000")
+    
+    Returns:
+    --------
+    
+    cohorts : dictionary
+    
+    The "counts" (active customers),
+    "retention" (share of the cohort
+    still active) and "revenue" matrices
+    and the "state" for the next update.
+    Months after the last invoice are NaN.
+    
+    """
+
+    if drop_anonymous:
+        df_clean = df_clean.loc[df_clean["customer_id"] != "00000"]
+
+    dates = pd.to_datetime(df_clean["invc_date"])
+
+    # Months since 1970-01 (the pandas period ordinal)
+    months = (dates.dt.year.values - 1970) * 12 + dates.dt.month.values - 1
+
+    df_act = (
+        pd.DataFrame(
+            {
+                "customer_id": df_clean["customer_id"].values,
+                "month": months,
+                "revenue": df_clean[value_col].values,
+            }
+        )
+        .groupby(["customer_id", "month"])["revenue"]
+        .sum()
+    )
+
+    # Add the customer months seen so far. A customer
+    # and month in both are summed so a partial month
+    # can be completed by the next batch.
+    if state is not None:
+        df_act = pd.concat([state["activity"], df_act]).groupby(level=[0, 1]).sum()
+
+    cust_codes, _ = pd.factorize(df_act.index.get_level_values(0))
+    month = df_act.index.get_level_values(1).values.astype(np.int64)
+    cohort = pd.Series(month).groupby(cust_codes).transform("min").values
+    offset = month - cohort
+
+    if len(month):
+        df_grp = pd.DataFrame(
+            {"cohort": cohort, "offset": offset, "revenue": df_act.values}
+        ).groupby(["cohort", "offset"])["revenue"]
+
+        counts = df_grp.size().unstack(fill_value=0)
+        revenue = df_grp.sum().unstack(fill_value=0)
+
+        # Every offset as a column and NaN for the
+        # months that haven't happened yet
+        cols = np.arange(month.max() - cohort.min() + 1)
+        future = (counts.index.values[:, None] + cols[None, :]) > month.max()
+
+        counts = counts.reindex(columns=cols, fill_value=0).astype(float)
+        counts = counts.mask(future)
+        revenue = revenue.reindex(columns=cols, fill_value=0).astype(float)
+        revenue = revenue.mask(future)
+        retention = counts.div(counts[0], axis=0)
+    else:
+        # No customer months yet
+        counts, revenue, retention = [
+            pd.DataFrame(index=np.array([], dtype=np.int64), dtype=float)
+            for _ in range(3)
+        ]
+
+    for df_out in [counts, revenue, retention]:
+        df_out.index = pd.PeriodIndex(
+            [pd.Period(ordinal=int(o), freq="M") for o in df_out.index.values],
+            freq="M",
+        )
+        df_out.index.name = "cohort"
+        df_out.columns.name = "month_offset"
+
+    return {
+        "counts": counts,
+        "retention": retention,
+        "revenue": revenue,
+        "state": {"activity": df_act},
+    }
+
+
+# The customer table columns of every RFM score
+RFM_COLS = {
+    "recency": "time_inactive",
+    "frequency": "orders",
+    "monetary": "total_spend",
+}
+
+
+@instrument
+def build_rfm_sketches(df_cust, rel_err=0.01):
+    """
+    Builds the quantile sketches of the
+    RFM columns of a customer table (or
+    of one partition of it). Sketches of
+    different partitions are merged with
+    sketches.merge_quantile_sketches().
+    
+    Parameters:
+    -----------
+    
+    df_cust : dataframe
+    
+    The customer table (or a partition)
+    with the RFM_COLS
+    
+    rel_err : float (default = 0.01)
+    
+    The relative error of the quantiles
+    
+    Returns:
+    --------
+    
+    rfm_sketches : dictionary
+    
+    A sketch per RFM column
+    
+    """
+
+    from src.features import sketches
+
+    return {
+        col: sketches.quantile_sketch(df_cust[col].values, rel_err=rel_err)
+        for col in RFM_COLS.values()
+    }
+
+
+@instrument
+def get_rfm_scores(df_cust, n_bins=5, method="exact", rfm_sketches=None, rel_err=0.01):
+    """
+    Scores every customer from 1 to n_bins on
+    recency, frequency and monetary value by
+    the quantile bin of each column. Recency
+    is reversed so the most recent customers
+    get the highest score.
+
+    The bin edges are found once and every
+    customer is binned with a vectorized
+    search so scoring is a linear pass.
+    With method "approx" the edges come from
+    quantile sketches so a table that is
+    streamed or split in partitions can be
+    scored chunk by chunk with the merged
+    sketches of all of them.
+    
+    Parameters:
+    -----------
+    
+    df_cust : dataframe
+    
+    The customer table with the RFM_COLS
+    
+    n_bins : int (default = 5)
+    
+    The number of scores
+    
+    method : str (default = "exact")
+    
+    "exact" for the quantiles of df_cust
+    or "approx" for sketch quantiles
+    
+    rfm_sketches : dictionary (default = None)
+    
+    The sketches for "approx" (see
+    build_rfm_sketches). If None they
+    are built from df_cust.
+    
+    rel_err : float (default = 0.01)
+    
+    The relative error of the sketches
+    built when none are passed
+    
+    Returns:
+    --------
+    
+    df_out : dataframe
+    
+    The customer table with the "r_score",
+    "f_score", "m_score", the "rfm_cell"
+    (e.g. 545) and the "rfm_score" (sum).
+    Missing values (and every value of a
+    column that has none) get a NaN score.
+    
+    """
+
+    from src.features import sketches
+
+    if method not in ["exact", "approx"]:
+        raise ValueError(f"Unknown method '{method}'.")
+
+    if method == "approx" and rfm_sketches is None:
+        rfm_sketches = build_rfm_sketches(df_cust, rel_err=rel_err)
+
+    df_out = df_cust.copy()
+    qs = np.arange(1, n_bins) / n_bins
+
+    for name, col in RFM_COLS.items():
+
+        values = df_out[col].values.astype(np.float64)
+        missing = np.isnan(values)
+
+        # Nothing to bin (e.g. an empty partition)
+        if missing.all():
+            df_out[f"{name[0]}_score"] = np.full(len(values), np.nan)
+            continue
+
+        if method == "exact":
+            edges = np.nanquantile(values, qs)
+        else:
+            # Compare at the resolution of the sketch so
+            # that ties (e.g. orders of 1) stay together
+            rel_err = rfm_sketches[col]["rel_err"]
+            edges = sketches.sketch_quantiles(rfm_sketches[col], qs)
+            edges = sketches.round_to_buckets(edges, rel_err=rel_err)
+            values = sketches.round_to_buckets(values, rel_err=rel_err)
+
+        # A value equal to an edge goes to the lower
+        # bin (right closed bins as in pd.qcut)
+        scores = np.searchsorted(edges, values, side="left") + 1
+
+        if name == "recency":
+            scores = n_bins + 1 - scores
+
+        # Missing values sort after every edge so
+        # they would get the top bin
+        if missing.any():
+            scores = np.where(missing, np.nan, scores)
+
+        df_out[f"{name[0]}_score"] = scores
+
+    df_out["rfm_cell"] = (
+        df_out["r_score"] * 100 + df_out["f_score"] * 10 + df_out["m_score"]
+    )
+    df_out["rfm_score"] = df_out["r_score"] + df_out["f_score"] + df_out["m_score"]
+
+    return df_out
+
+
+@instrument
+def aggregate_groups(df, by, aggs, approx_nunique=False, rel_err=0.01):
+    """
+    Aggregates a dataframe per group like
+    df.groupby(by).agg(**aggs) but can
+    count the distinct values ("nunique")
+    with HyperLogLog sketches, the most
+    expensive reducer on large groups.
+    
+    Parameters:
+    -----------
+    
+    df : dataframe
+    
+    The rows to aggregate
+    
+    by : str or list
+    
+    The group column(s)
+    
+    aggs : dictionary
+    
+    The output columns as (column, function)
+    pairs e.g. {"orders": ("invc_num", "nunique")}
+    
+    approx_nunique : bool (default = False)
+    
+    Use the approximate distinct counts
+    (see sketches.approx_nunique)
+    
+    rel_err : float (default = 0.01)
+    
+    The relative error of the
+    approximate counts
+    
+    Returns:
+    --------
+    
+    df_grp : dataframe
+    
+    One row per group (as the index)
+    
+    """
+
+    from src.features import sketches
+
+    if not approx_nunique:
+        return df.groupby(by).agg(**aggs)
+
+    # The groups in the same (sorted) order
+    # as the exact path
+    exact_aggs = {name: agg for name, agg in aggs.items() if agg[1] != "nunique"}
+    if exact_aggs:
+        df_grp = df.groupby(by).agg(**exact_aggs)
+    else:
+        df_grp = pd.DataFrame(index=df.groupby(by).size().index)
+
+    for name, (col, func) in aggs.items():
+        if func == "nunique":
+            counts = sketches.approx_nunique(df, col, by, rel_err=rel_err)
+            # Groups with only missing values count 0
+            df_grp[name] = counts.reindex(df_grp.index, fill_value=0)
+
+    return df_grp[list(aggs)]
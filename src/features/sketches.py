@@ -0,0 +1,676 @@
+"""
+SKETCHES Module
+---------------
+
+@author : Stratoshad
+
+This module contains small mergeable
+summaries (sketches) of large columns.
+A sketch is built in one pass over a
+chunk or partition, sketches of different
+chunks can be merged and the merged one
+answers the question (e.g. a quantile)
+within a known error.
+
+Quantile sketches keep counts of
+logarithmic buckets so every value is
+known up to a relative error (as in
+DDSketch). Distinct count sketches keep
+the HyperLogLog registers of every group
+(only the ones that are set) and the
+exact values of the small groups.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+
+def _bucket_store(keys):
+
+    """
+    Counts the bucket keys into a dense
+    array that starts at the smallest key
+    """
+
+    if len(keys) == 0:
+        return {"offset": 0, "counts": np.zeros(0, dtype=np.int64)}
+
+    offset = int(keys.min())
+
+    return {"offset": offset, "counts": np.bincount(keys - offset).astype(np.int64)}
+
+
+def _merge_stores(store_a, store_b):
+
+    """
+    Adds up the counts of two
+    bucket stores
+    """
+
+    if len(store_a["counts"]) == 0:
+        return store_b
+    if len(store_b["counts"]) == 0:
+        return store_a
+
+    offset = min(store_a["offset"], store_b["offset"])
+    end = max(
+        store_a["offset"] + len(store_a["counts"]),
+        store_b["offset"] + len(store_b["counts"]),
+    )
+
+    counts = np.zeros(end - offset, dtype=np.int64)
+    for store in [store_a, store_b]:
+        start = store["offset"] - offset
+        counts[start : start + len(store["counts"])] += store["counts"]
+
+    return {"offset": offset, "counts": counts}
+
+
+def _gamma(rel_err):
+
+    """
+    The ratio between the bounds of
+    a bucket for a relative error
+    """
+
+    if not 0 < rel_err < 1:
+        raise ValueError("rel_err has to be between 0 and 1.")
+
+    return (1 + rel_err) / (1 - rel_err)
+
+
+def _bucket_keys(values, gamma):
+
+    """
+    The bucket of every positive value
+    (gamma ** (k - 1) < value <= gamma ** k)
+    """
+
+    return np.ceil(np.log(values) / np.log(gamma)).astype(np.int64)
+
+
+def quantile_sketch(values, rel_err=0.01):
+
+    """
+    Builds a quantile sketch of a column.
+    Every value falls in a bucket
+    (gamma ** (k - 1), gamma ** k] so any
+    quantile is returned within rel_err
+    of the true value.
+
+    Parameters:
+    -----------
+
+    values : array-like
+
+    The values (NaNs are ignored)
+
+    rel_err : float (default = 0.01)
+
+    The relative error of the quantiles
+
+    Returns:
+    --------
+
+    sketch : dictionary
+
+    The bucket counts of the positive
+    and negative values, the number of
+    zeros, the count, min and max
+
+    """
+
+    gamma = _gamma(rel_err)
+
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+
+    return {
+        "rel_err": rel_err,
+        "gamma": gamma,
+        "positive": _bucket_store(_bucket_keys(values[values > 0], gamma)),
+        "negative": _bucket_store(_bucket_keys(-values[values < 0], gamma)),
+        "zeros": int((values == 0).sum()),
+        "count": len(values),
+        "min": values.min() if len(values) > 0 else np.nan,
+        "max": values.max() if len(values) > 0 else np.nan,
+    }
+
+
+def merge_quantile_sketches(sketches):
+
+    """
+    Merges the quantile sketches of
+    several chunks or partitions into
+    the sketch of all of them.
+
+    Parameters:
+    -----------
+
+    sketches : list
+
+    Sketches with the same rel_err
+    (see quantile_sketch)
+
+    Returns:
+    --------
+
+    sketch : dictionary
+
+    The merged sketch
+
+    """
+
+    sketches = list(sketches)
+
+    if len({sketch["rel_err"] for sketch in sketches}) != 1:
+        raise ValueError("Only sketches with the same rel_err can be merged.")
+
+    merged = dict(sketches[0])
+
+    for sketch in sketches[1:]:
+        merged["positive"] = _merge_stores(merged["positive"], sketch["positive"])
+        merged["negative"] = _merge_stores(merged["negative"], sketch["negative"])
+        merged["zeros"] += sketch["zeros"]
+        merged["count"] += sketch["count"]
+        merged["min"] = np.fmin(merged["min"], sketch["min"])
+        merged["max"] = np.fmax(merged["max"], sketch["max"])
+
+    return merged
+
+
+def sketch_quantiles(sketch, qs):
+
+    """
+    Returns the (approximate) quantiles
+    of a quantile sketch.
+
+    Parameters:
+    -----------
+
+    sketch : dictionary
+
+    The sketch (see quantile_sketch)
+
+    qs : float or list
+
+    The quantiles between 0 and 1
+
+    Returns:
+    --------
+
+    values : numpy array
+
+    The value of every quantile
+
+    """
+
+    qs = np.atleast_1d(np.asarray(qs, dtype=np.float64))
+
+    if sketch["count"] == 0:
+        return np.full(len(qs), np.nan)
+
+    gamma = sketch["gamma"]
+
+    # Every bucket with its middle value in
+    # ascending order (the negative buckets
+    # reversed, then the zeros)
+    neg, pos = sketch["negative"], sketch["positive"]
+    neg_keys = neg["offset"] + np.arange(len(neg["counts"]))
+    pos_keys = pos["offset"] + np.arange(len(pos["counts"]))
+
+    values = np.concatenate(
+        [
+            -2 * gamma ** neg_keys[::-1] / (gamma + 1),
+            [0.0],
+            2 * gamma ** pos_keys / (gamma + 1),
+        ]
+    )
+    counts = np.concatenate([neg["counts"][::-1], [sketch["zeros"]], pos["counts"]])
+    cum = np.cumsum(counts)
+
+    # The bucket that holds the value of rank q * (n - 1)
+    ranks = qs * (sketch["count"] - 1)
+    idx = np.searchsorted(cum, ranks, side="right")
+
+    return np.clip(values[idx], sketch["min"], sketch["max"])
+
+
+def round_to_buckets(values, rel_err=0.01):
+
+    """
+    Replaces every value with the middle
+    value of its sketch bucket. Comparing
+    rounded values with rounded quantiles
+    keeps values of the same bucket (e.g.
+    ties) on the same side of a quantile.
+
+    Parameters:
+    -----------
+
+    values : array-like
+
+    The values
+
+    rel_err : float (default = 0.01)
+
+    The relative error of the sketch
+
+    Returns:
+    --------
+
+    rounded : numpy array
+
+    The rounded values (zeros and
+    NaNs are kept)
+
+    """
+
+    gamma = _gamma(rel_err)
+
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.copy()
+
+    nonzero = (values != 0) & ~np.isnan(values)
+    keys = _bucket_keys(np.abs(values[nonzero]), gamma)
+    rounded[nonzero] = np.sign(values[nonzero]) * 2 * gamma ** keys / (gamma + 1)
+
+    return rounded
+
+
+def _hll_precision(rel_err):
+
+    """
+    The number of register bits for a
+    relative (standard) error. HyperLogLog
+    has an error of 1.04 / sqrt(2 ** p).
+    """
+
+    if not 0 < rel_err < 1:
+        raise ValueError("rel_err has to be between 0 and 1.")
+
+    return int(min(max(np.ceil(np.log2((1.04 / rel_err) ** 2)), 4), 18))
+
+
+def _leading_zeros(values):
+
+    """
+    The number of leading zero bits
+    of every uint64 value
+    """
+
+    # Split in 32 bit halves which are exact as floats
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+
+    return np.where(
+        high > 0, 32 - np.frexp(high)[1], np.where(low > 0, 64 - np.frexp(low)[1], 64)
+    )
+
+
+def _hash_values(values):
+
+    """
+    The 64 bit hash of every value. The
+    values are hashed as objects so a value
+    gets the same hash whatever the dtype
+    of its column in a partition.
+    """
+
+    codes, uniques = pd.factorize(values)
+    hashes = pd.util.hash_pandas_object(
+        pd.Series(uniques, dtype=object), index=False
+    ).values
+
+    return hashes[codes]
+
+
+def _reduce_registers(codes, registers, rho, precision):
+
+    """
+    Keeps the largest rho of every group
+    and register (one sort of the
+    combined integer key)
+    """
+
+    n_regs = 2 ** precision
+
+    keys = np.sort((codes * n_regs + registers) * 64 + rho)
+    keys = keys[np.flatnonzero(np.diff(keys // 64, append=-1))]
+
+    return pd.DataFrame(
+        {
+            "_group": keys // 64 // n_regs,
+            "register": (keys // 64 % n_regs).astype(np.int32),
+            "rho": (keys % 64).astype(np.int8),
+        }
+    )
+
+
+def _max_registers(codes, hashes, precision):
+
+    """
+    The HyperLogLog registers of every group.
+    The first bits of a hash pick the register
+    and the leading zeros of the rest give its
+    value (rho). Only the registers that are
+    set are returned.
+    """
+
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rho = _leading_zeros(hashes << np.uint64(precision)) + 1
+    rho = np.minimum(rho, 64 - precision + 1)
+
+    return _reduce_registers(codes, registers, rho, precision)
+
+
+def _split_exact(codes, hashes, n_groups, precision, exact_threshold):
+
+    """
+    Keeps the distinct hashes of the groups with
+    at most exact_threshold of them and turns
+    the hashes of the other groups into
+    registers
+    """
+
+    df_hash = pd.DataFrame({"_group": codes, "hash": hashes}).drop_duplicates()
+
+    counts = np.bincount(df_hash["_group"].values, minlength=n_groups)
+    exact = counts <= exact_threshold
+    keep = exact[df_hash["_group"].values]
+
+    df_regs = _max_registers(
+        df_hash["_group"].values[~keep], df_hash["hash"].values[~keep], precision
+    )
+
+    return df_hash.loc[keep].reset_index(drop=True), df_regs, exact
+
+
+@instrument
+def distinct_sketch(df, col, by, rel_err=0.01, exact_threshold=64):
+
+    """
+    Builds a HyperLogLog sketch of the
+    distinct values of a column per group.
+    Groups with few distinct values keep
+    their hashes for an exact count and
+    only the set registers of the other
+    groups are stored.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The rows (or a partition of them)
+
+    col : str
+
+    The column to count
+
+    by : str or list
+
+    The group column(s)
+
+    rel_err : float (default = 0.01)
+
+    The relative standard error of
+    the approximate counts
+
+    exact_threshold : int (default = 64)
+
+    Groups with up to this many
+    distinct values are counted
+    exactly
+
+    Returns:
+    --------
+
+    sketch : dictionary
+
+    The "groups" (labels), the "registers"
+    and the "hashes" of the exact groups
+    (by group code), the "exact" flag of
+    every group and the settings
+
+    """
+
+    by = [by] if isinstance(by, str) else list(by)
+    precision = _hll_precision(rel_err)
+
+    # Missing values (and group keys) are left out
+    codes = df.groupby(by, sort=False).ngroup().values.astype(np.int64)
+    valid = (codes >= 0) & df[col].notna().values
+    codes, _ = pd.factorize(codes[valid])
+    hashes = _hash_values(df[col].values[valid])
+
+    # The labels of every group code
+    first = pd.Series(np.arange(len(codes))).groupby(codes).min().values
+    groups = df[by].iloc[np.flatnonzero(valid)[first]].reset_index(drop=True)
+
+    # Groups with few distinct values keep their hashes
+    df_hash, df_regs, exact = _split_exact(
+        codes, hashes, len(groups), precision, exact_threshold
+    )
+
+    return {
+        "by": by,
+        "precision": precision,
+        "exact_threshold": exact_threshold,
+        "groups": groups,
+        "registers": df_regs,
+        "hashes": df_hash,
+        "exact": exact,
+    }
+
+
+@instrument
+def merge_distinct_sketches(sketches):
+
+    """
+    Merges the distinct count sketches of
+    several partitions (or days) into the
+    sketch of all of them.
+
+    Parameters:
+    -----------
+
+    sketches : list
+
+    Sketches with the same groups and
+    settings (see distinct_sketch)
+
+    Returns:
+    --------
+
+    sketch : dictionary
+
+    The merged sketch
+
+    """
+
+    sketches = list(sketches)
+    first = sketches[0]
+    by, precision = first["by"], first["precision"]
+
+    for sketch in sketches[1:]:
+        if (
+            sketch["by"] != by
+            or sketch["precision"] != precision
+            or sketch["exact_threshold"] != first["exact_threshold"]
+        ):
+            raise ValueError("Only sketches with the same settings can be merged.")
+
+    # New codes for the groups of all sketches
+    df_groups = pd.concat([sketch["groups"] for sketch in sketches], ignore_index=True)
+    all_codes, _ = pd.MultiIndex.from_frame(df_groups).factorize()
+    first_pos = pd.Series(np.arange(len(all_codes))).groupby(all_codes).min().values
+    groups = df_groups.iloc[first_pos].reset_index(drop=True)
+
+    bounds = np.cumsum([0] + [len(sketch["groups"]) for sketch in sketches])
+    code_maps = [all_codes[bounds[i] : bounds[i + 1]] for i in range(len(sketches))]
+
+    # A group is only exact if it is exact in all
+    # the sketches it appears in
+    inexact = np.zeros(len(groups), dtype=bool)
+    for sketch, code_map in zip(sketches, code_maps):
+        inexact[code_map[~sketch["exact"]]] = True
+
+    df_hash = pd.concat(
+        [
+            sketch["hashes"].assign(_group=code_map[sketch["hashes"]["_group"].values])
+            for sketch, code_map in zip(sketches, code_maps)
+        ],
+        ignore_index=True,
+    )
+    codes = df_hash["_group"].values
+    hashes = df_hash["hash"].values
+    merged = ~inexact[codes]
+
+    # Exact groups that grew too big and groups that
+    # are not exact everywhere become registers
+    df_hash, df_new, exact = _split_exact(
+        codes[merged],
+        hashes[merged],
+        len(groups),
+        precision,
+        first["exact_threshold"],
+    )
+    exact &= ~inexact
+
+    df_regs = pd.concat(
+        [
+            sketch["registers"].assign(
+                _group=code_map[sketch["registers"]["_group"].values]
+            )
+            for sketch, code_map in zip(sketches, code_maps)
+        ]
+        + [df_new, _max_registers(codes[~merged], hashes[~merged], precision)],
+        ignore_index=True,
+    )
+
+    # A register keeps its largest value
+    df_regs = _reduce_registers(
+        df_regs["_group"].values,
+        df_regs["register"].values.astype(np.int64),
+        df_regs["rho"].values.astype(np.int64),
+        precision,
+    )
+
+    return {
+        "by": by,
+        "precision": precision,
+        "exact_threshold": first["exact_threshold"],
+        "groups": groups,
+        "registers": df_regs,
+        "hashes": df_hash,
+        "exact": exact,
+    }
+
+
+def distinct_counts(sketch):
+
+    """
+    Returns the distinct count of every
+    group of a distinct count sketch.
+
+    Parameters:
+    -----------
+
+    sketch : dictionary
+
+    The sketch (see distinct_sketch)
+
+    Returns:
+    --------
+
+    counts : series
+
+    The (approximate) number of distinct
+    values per group in the order the
+    groups first appear, exact for the
+    groups with few distinct values
+
+    """
+
+    n_groups = len(sketch["groups"])
+    n_regs = 2 ** sketch["precision"]
+    alpha = 0.7213 / (1 + 1.079 / n_regs)
+
+    codes = sketch["registers"]["_group"].values
+    rho = sketch["registers"]["rho"].values.astype(np.float64)
+
+    # Registers that are not set count as 2 ** 0
+    inv_sum = np.bincount(codes, weights=np.exp2(-rho), minlength=n_groups)
+    empty = n_regs - np.bincount(codes, minlength=n_groups)
+    estimate = alpha * n_regs ** 2 / (inv_sum + empty)
+
+    # Linear counting is more accurate while
+    # there are still empty registers
+    with np.errstate(divide="ignore"):
+        linear = n_regs * np.log(n_regs / empty)
+    use_linear = (empty > 0) & (linear <= 2.5 * n_regs)
+    estimate = np.where(use_linear, linear, estimate)
+
+    exact = np.bincount(sketch["hashes"]["_group"].values, minlength=n_groups)
+    counts = np.where(sketch["exact"], exact, np.round(estimate)).astype(np.int64)
+
+    if len(sketch["by"]) == 1:
+        index = pd.Index(sketch["groups"].iloc[:, 0], name=sketch["by"][0])
+    else:
+        index = pd.MultiIndex.from_frame(sketch["groups"])
+
+    return pd.Series(counts, index=index)
+
+
+@instrument
+def approx_nunique(df, col, by, rel_err=0.01, exact_threshold=64):
+
+    """
+    The approximate number of distinct
+    values of a column per group (like
+    df.groupby(by)[col].nunique()).
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The rows
+
+    col : str
+
+    The column whose distinct
+    values are counted
+
+    by : str or list
+
+    The group column(s)
+
+    rel_err : float (default = 0.01)
+
+    The relative standard error
+
+    exact_threshold : int (default = 64)
+
+    Groups with up to this many
+    distinct values are counted
+    exactly
+
+    Returns:
+    --------
+
+    counts : series
+
+    The (estimated) number of distinct
+    non-missing values per group, not
+    a number of rows
+
+    """
+
+    return distinct_counts(
+        distinct_sketch(df, col, by, rel_err=rel_err, exact_threshold=exact_threshold)
+    )
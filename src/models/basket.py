@@ -0,0 +1,407 @@
+"""
+BASKET Module
+-------------
+
+@author : Stratoshad
+
+This module contains functions that mine
+frequent product pairs and triples from
+the invoices (baskets) and turn them into
+association rules.
+
+The invoices are stored as a sparse
+invoice x product matrix. Each column is
+the list of invoices (tid-list) of a
+product so the counts of all pairs come
+from one sparse product X.T @ X and the
+counts of the triples from the product of
+the frequent pair columns with X. Both
+are split into independent parts (ranges
+of invoices for the pairs, chunks of
+pairs for the triples) that bound the
+memory and can run in parallel.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+
+@instrument
+def build_basket_matrix(df_clean, basket_col="invc_num", item_col="stock_code"):
+
+    """
+    Builds a sparse 0 / 1 invoice x product
+    matrix. Rows with nothing left after the
+    cancellations (qty <= 0) are left out.
+
+    Parameters:
+    -----------
+
+    df_clean : dataframe
+
+    The cleaned and renamed transactions
+
+    basket_col : str (default = "invc_num")
+
+    The basket column
+
+    item_col : str (default = "stock_code")
+
+    The product column
+
+    Returns:
+    --------
+
+    matrix : scipy csr_matrix
+
+    The int32 invoice x product matrix
+
+    baskets : Index
+
+    The invoice of every row
+
+    items : Index
+
+    The product of every column
+
+    """
+
+    from scipy import sparse
+
+    if "qty" in df_clean.columns:
+        df_clean = df_clean.loc[df_clean["qty"] > 0]
+
+    basket_codes, baskets = pd.factorize(df_clean[basket_col])
+    item_codes, items = pd.factorize(df_clean[item_col])
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(basket_codes), dtype=np.int32), (basket_codes, item_codes)),
+        shape=(len(baskets), len(items)),
+    )
+
+    # A product can appear on more than one line of an invoice
+    matrix.data[:] = 1
+
+    return matrix, pd.Index(baskets), pd.Index(items)
+
+
+# The matrix of the current process. Worker processes
+# get it once when they start rather than with every task
+_WORKER = {}
+
+
+def _init_worker(matrix):
+
+    """
+    Stores the basket matrix
+    for the tasks of a process
+    """
+
+    _WORKER["matrix"] = matrix
+    _WORKER["matrix_csc"] = None
+
+
+def _pair_counts(start, end):
+
+    """
+    The number of baskets of every pair of
+    columns (upper triangle) in a range
+    of baskets
+    """
+
+    from scipy import sparse
+
+    matrix = _WORKER["matrix"][start:end]
+
+    return sparse.triu(matrix.T @ matrix, k=1, format="csr")
+
+
+def _triple_counts(pair_a, pair_b, min_count):
+
+    """
+    Counts every pair (a, b) of a chunk with
+    every column c > b over all the baskets
+    and keeps the frequent triples. The
+    baskets of a pair are the product of
+    its two columns.
+    """
+
+    from scipy import sparse
+
+    matrix = _WORKER["matrix"]
+    if _WORKER["matrix_csc"] is None:
+        _WORKER["matrix_csc"] = matrix.tocsc()
+    matrix_csc = _WORKER["matrix_csc"]
+
+    pairs = matrix_csc[:, pair_a].multiply(matrix_csc[:, pair_b])
+    block = (sparse.csr_matrix(pairs).T @ matrix).tocoo()
+
+    keep = (block.col > pair_b[block.row]) & (block.data >= min_count)
+
+    return block.row[keep], block.col[keep], block.data[keep]
+
+
+def _run_tasks(func, tasks, matrix, n_jobs):
+
+    """
+    Runs a function on every task (a tuple
+    of arguments) in this process or in
+    n_jobs worker processes
+    """
+
+    if n_jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(matrix,)
+        ) as executor:
+            futures = [executor.submit(func, *task) for task in tasks]
+            return [future.result() for future in futures]
+
+    _init_worker(matrix)
+    try:
+        return [func(*task) for task in tasks]
+    finally:
+        _WORKER.clear()
+
+
+@instrument
+def mine_itemsets(
+    matrix,
+    items,
+    min_support=0.01,
+    max_len=3,
+    n_jobs=1,
+    n_partitions=None,
+    chunk_size=512,
+):
+
+    """
+    Finds all itemsets of up to three products
+    that appear in at least min_support of
+    the baskets.
+
+    Parameters:
+    -----------
+
+    matrix : scipy sparse matrix
+
+    The 0 / 1 basket x product matrix
+    (see build_basket_matrix)
+
+    items : Index
+
+    The product of every column
+
+    min_support : float (default = 0.01)
+
+    The minimum share of baskets. Values
+    of 1 or more are a minimum count.
+
+    max_len : int (default = 3)
+
+    The largest itemset (1, 2 or 3)
+
+    n_jobs : int (default = 1)
+
+    The number of worker processes
+
+    n_partitions : int (default = None)
+
+    The number of basket ranges the pairs
+    are counted over. If None it uses
+    one per worker.
+
+    chunk_size : int (default = 512)
+
+    The number of pairs counted at
+    a time for the triples
+
+    Returns:
+    --------
+
+    df_sets : dataframe
+
+    The "itemset" (tuple of products),
+    its "length", "count" and "support"
+    sorted by length and count
+
+    """
+
+    from scipy import sparse
+
+    if max_len not in [1, 2, 3]:
+        raise ValueError("max_len has to be 1, 2 or 3.")
+
+    matrix = sparse.csr_matrix(matrix, dtype=np.int32)
+    items = np.asarray(items, dtype=object)
+    n_baskets = matrix.shape[0]
+    min_count = min_support if min_support >= 1 else np.ceil(min_support * n_baskets)
+
+    # Single products. Only the frequent ones
+    # can be part of a frequent pair or triple
+    item_counts = np.asarray(matrix.sum(axis=0)).ravel()
+    frequent = np.flatnonzero(item_counts >= min_count)
+    matrix = matrix[:, frequent]
+    items = items[frequent]
+
+    frames = [
+        pd.DataFrame(
+            {"itemset": [(item,) for item in items], "count": item_counts[frequent]}
+        )
+    ]
+
+    # Pairs are counted over ranges of baskets and
+    # added up (at most n_items ** 2 / 2 counts)
+    n_partitions = max(n_jobs, 1) if n_partitions is None else n_partitions
+    bounds = np.linspace(0, n_baskets, n_partitions + 1).astype(int)
+    tasks = [(bounds[i], bounds[i + 1]) for i in range(n_partitions)]
+
+    if max_len >= 2 and len(frequent) > 1:
+
+        results = _run_tasks(_pair_counts, tasks, matrix, n_jobs)
+        counts = results[0]
+        for result in results[1:]:
+            counts = counts + result
+
+        counts = counts.tocoo()
+        keep = counts.data >= min_count
+        order = np.lexsort([counts.col[keep], counts.row[keep]])
+        pair_a = counts.row[keep][order]
+        pair_b = counts.col[keep][order]
+
+        frames.append(
+            pd.DataFrame(
+                {
+                    "itemset": list(zip(items[pair_a], items[pair_b])),
+                    "count": counts.data[keep][order],
+                }
+            )
+        )
+
+        # Any subset of a frequent triple is frequent so
+        # extending the frequent pairs finds all of them.
+        # Each chunk of pairs is filtered as soon as it is
+        # counted which keeps the memory bounded.
+        if max_len == 3 and len(pair_a) > 0:
+
+            tasks = [
+                (pair_a[i : i + chunk_size], pair_b[i : i + chunk_size], min_count)
+                for i in range(0, len(pair_a), chunk_size)
+            ]
+            results = _run_tasks(_triple_counts, tasks, matrix, n_jobs)
+
+            rows = np.concatenate(
+                [rows + i * chunk_size for i, (rows, _, _) in enumerate(results)]
+            )
+            cols = np.concatenate([cols for _, cols, _ in results])
+            counts = np.concatenate([counts for _, _, counts in results])
+
+            # Same order however the work was split
+            order = np.lexsort([cols, rows])
+            rows, cols, counts = rows[order], cols[order], counts[order]
+
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "itemset": list(
+                            zip(items[pair_a[rows]], items[pair_b[rows]], items[cols])
+                        ),
+                        "count": counts,
+                    }
+                )
+            )
+
+    df_sets = pd.concat(frames, ignore_index=True)
+    df_sets["length"] = df_sets["itemset"].map(len)
+    df_sets["support"] = df_sets["count"] / n_baskets
+
+    df_sets = df_sets.sort_values(
+        by=["length", "count"], ascending=[True, False], kind="mergesort"
+    )
+
+    return df_sets[["itemset", "length", "count", "support"]].reset_index(drop=True)
+
+
+@instrument
+def association_rules(df_sets, n_baskets, min_confidence=0.5, min_lift=None):
+
+    """
+    Turns the frequent itemsets into rules
+    with a single product as consequent
+    (e.g. {A, B} -> C).
+
+    Parameters:
+    -----------
+
+    df_sets : dataframe
+
+    The frequent itemsets (see mine_itemsets)
+
+    n_baskets : int
+
+    The total number of baskets
+
+    min_confidence : float (default = 0.5)
+
+    The minimum share of the baskets with
+    the antecedent that also have the
+    consequent
+
+    min_lift : float (default = None)
+
+    The minimum lift. If None
+    there is no limit.
+
+    Returns:
+    --------
+
+    df_rules : dataframe
+
+    The "antecedent", "consequent", "support",
+    "confidence" and "lift" of every rule
+    sorted by the lift
+
+    """
+
+    counts = dict(zip(df_sets["itemset"], df_sets["count"]))
+    rules = []
+
+    for itemset, count in zip(df_sets["itemset"], df_sets["count"]):
+
+        if len(itemset) < 2:
+            continue
+
+        for pos, consequent in enumerate(itemset):
+            antecedent = itemset[:pos] + itemset[pos + 1 :]
+            rules.append(
+                (
+                    antecedent,
+                    consequent,
+                    count,
+                    counts[antecedent],
+                    counts[(consequent,)],
+                )
+            )
+
+    df_rules = pd.DataFrame(
+        rules,
+        columns=["antecedent", "consequent", "count", "ante_count", "cons_count"],
+    )
+
+    df_rules["support"] = df_rules["count"] / n_baskets
+    df_rules["confidence"] = df_rules["count"] / df_rules["ante_count"]
+    df_rules["lift"] = df_rules["confidence"] / (df_rules["cons_count"] / n_baskets)
+
+    keep = df_rules["confidence"] >= min_confidence
+    if min_lift is not None:
+        keep &= df_rules["lift"] >= min_lift
+
+    df_rules = df_rules.loc[
+        keep, ["antecedent", "consequent", "support", "confidence", "lift"]
+    ]
+
+    return df_rules.sort_values(by="lift", ascending=False).reset_index(drop=True)
@@ -0,0 +1,332 @@
+"""
+BOOTSTRAP Module
+----------------
+
+@author : Stratoshad
+
+This module contains functions that
+estimate the distribution of a statistic
+by resampling. All resample indices are
+drawn as one numpy matrix and the
+statistic is calculated for every
+replicate at once.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+# Reducers that work on a 2D matrix
+# of samples (one replicate per row)
+REDUCERS = {
+    "mean": lambda x: x.mean(axis=1),
+    "median": lambda x: np.median(x, axis=1),
+    "std": lambda x: x.std(axis=1, ddof=1),
+    "sum": lambda x: x.sum(axis=1),
+    "min": lambda x: x.min(axis=1),
+    "max": lambda x: x.max(axis=1),
+}
+
+
+def _get_reducer(reducer):
+
+    """
+    Turns a reducer name, a quantile
+    (float between 0 and 1) or a callable
+    into a function applied on axis=1
+    """
+
+    if callable(reducer):
+        return lambda x: reducer(x, axis=1)
+
+    if isinstance(reducer, float):
+        return lambda x: np.quantile(x, reducer, axis=1)
+
+    if reducer not in REDUCERS:
+        raise ValueError(
+            f"Unknown reducer '{reducer}'. Use one of {list(REDUCERS)}, "
+            "a quantile between 0 and 1 or a callable."
+        )
+
+    return REDUCERS[reducer]
+
+
+def _sample_without_replacement(rng, n_values, size, sample_size):
+
+    """
+    Draws "size" rows of sample_size distinct
+    indices below n_values. Small samples are
+    drawn with replacement and the rows with a
+    repeated index are drawn again, so the cost
+    follows the sample size. Large samples
+    (where repeats are likely) take the
+    smallest of a random key per value.
+    """
+
+    # A row has no repeats with a probability of
+    # about exp(-k^2 / 2n) so this keeps the
+    # expected number of draws below e
+    if sample_size * (sample_size - 1) > 2 * n_values:
+        keys = rng.random((size, n_values))
+        return np.argpartition(keys, sample_size - 1, axis=1)[:, :sample_size]
+
+    idx = rng.integers(0, n_values, size=(size, sample_size))
+    redraw = np.arange(size)
+
+    while len(redraw) > 0:
+        rows = np.sort(idx[redraw], axis=1)
+        redraw = redraw[(np.diff(rows, axis=1) == 0).any(axis=1)]
+        idx[redraw] = rng.integers(0, n_values, size=(len(redraw), sample_size))
+
+    return idx
+
+
+@instrument
+def bootstrap(
+    values,
+    reducer="mean",
+    n_boot=1000,
+    sample_size=None,
+    replace=True,
+    random_state=None,
+    max_elements=20000000,
+):
+
+    """
+    Draws n_boot samples of the values and
+    calculates the statistic for each of
+    them. The samples are drawn as one
+    (n_boot x sample_size) index matrix,
+    split in batches of at most
+    "max_elements" to bound memory.
+
+    Parameters:
+    -----------
+
+    values : array-like
+
+    The values to resample. Missing
+    values are dropped.
+
+    reducer : str, float or callable (default = "mean")
+
+    The statistic to calculate. One of
+    "mean", "median", "std", "sum", "min",
+    "max", a quantile between 0 and 1 or
+    a function taking (matrix, axis).
+
+    n_boot : int (default = 1000)
+
+    The number of replicates
+
+    sample_size : int (default = None)
+
+    The size of each sample. If None
+    uses the number of values.
+
+    replace : bool (default = True)
+
+    Whether to sample with replacement.
+    False mimics df.sample(sample_size)
+    but is slower for large samples.
+
+    random_state : int (default = None)
+
+    Seed for the random generator
+
+    max_elements : int (default = 20,000,000)
+
+    The maximum size of the index
+    matrix held in memory at once
+
+    Returns:
+    --------
+
+    stats : numpy array
+
+    The statistic of each replicate
+
+    """
+
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    n_values = values.shape[0]
+
+    if n_values == 0:
+        raise ValueError("There are no (non-missing) values to resample.")
+
+    if sample_size is None:
+        sample_size = n_values
+
+    if (not replace) and (sample_size > n_values):
+        raise ValueError(
+            "sample_size can't be larger than the data without replacement."
+        )
+
+    rng = np.random.default_rng(random_state)
+    func = _get_reducer(reducer)
+    stats = np.empty(n_boot)
+
+    # Large samples without replacement need a random
+    # key for every value (see _sample_without_replacement)
+    row_elements = sample_size
+    if (not replace) and (sample_size * (sample_size - 1) > 2 * n_values):
+        row_elements = n_values
+    batch = max(1, int(max_elements // max(row_elements, 1)))
+
+    for start in range(0, n_boot, batch):
+
+        size = min(batch, n_boot - start)
+
+        if replace:
+            idx = rng.integers(0, n_values, size=(size, sample_size))
+        else:
+            idx = _sample_without_replacement(rng, n_values, size, sample_size)
+
+        stats[start : start + size] = func(values[idx])
+
+    return stats
+
+
+def confidence_interval(stats, ci=0.95):
+
+    """
+    Returns the percentile confidence
+    interval of the bootstrap replicates
+
+    Parameters:
+    -----------
+
+    stats : array-like
+
+    The bootstrap replicates
+
+    ci : float (default = 0.95)
+
+    The confidence level
+
+    Returns:
+    --------
+
+    ci_low, ci_high : float
+
+    The lower and upper bounds
+
+    """
+
+    alpha = (1 - ci) / 2
+    ci_low, ci_high = np.quantile(stats, [alpha, 1 - alpha])
+
+    return ci_low, ci_high
+
+
+@instrument
+def bootstrap_summary(
+    df,
+    value_col,
+    group_col=None,
+    reducer="mean",
+    ci=0.95,
+    return_replicates=False,
+    **kwargs,
+):
+
+    """
+    Runs a bootstrap for a column of a
+    dataframe, optionally for every
+    segment separately, and summarises
+    the results with confidence intervals.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The dataframe with the values
+
+    value_col : str
+
+    The column to bootstrap
+
+    group_col : str (default = None)
+
+    A column to run separate bootstraps
+    for (e.g. the customer segment)
+
+    reducer : str, float or callable (default = "mean")
+
+    The statistic to calculate (see bootstrap())
+
+    ci : float (default = 0.95)
+
+    The confidence level
+
+    return_replicates : bool (default = False)
+
+    If True it also returns a long dataframe
+    with all replicates. Useful to plot
+    their distribution.
+
+    **kwargs
+
+    Any other arguments of bootstrap()
+    (e.g. n_boot, sample_size, replace)
+
+    Returns:
+    --------
+
+    df_summary : dataframe
+
+    One row per group with the statistic
+    on the full data, the mean and std of
+    the replicates and the CI bounds
+
+    df_reps : dataframe
+
+    All replicates. Only if
+    return_replicates is True
+
+    """
+
+    if group_col is None:
+        groups = [(None, df[value_col])]
+    else:
+        groups = df.groupby(group_col)[value_col]
+
+    summary_rows = []
+    reps_list = []
+
+    for name, col in groups:
+
+        stats = bootstrap(col.values, reducer=reducer, **kwargs)
+        ci_low, ci_high = confidence_interval(stats, ci=ci)
+
+        full_values = col.dropna().values.astype(float)[np.newaxis, :]
+        row = {
+            "n": full_values.shape[1],
+            "estimate": _get_reducer(reducer)(full_values)[0],
+            "boot_mean": stats.mean(),
+            "boot_std": stats.std(ddof=1),
+            "ci_low": ci_low,
+            "ci_high": ci_high,
+        }
+
+        if group_col is not None:
+            row = {group_col: name, **row}
+
+        summary_rows.append(row)
+
+        if return_replicates:
+            df_rep = pd.DataFrame({"replicate": stats})
+            if group_col is not None:
+                df_rep.insert(0, group_col, name)
+            reps_list.append(df_rep)
+
+    df_summary = pd.DataFrame(summary_rows)
+
+    if return_replicates:
+        return df_summary, pd.concat(reps_list, ignore_index=True)
+
+    return df_summary
@@ -11,14 +11,143 @@ techniques applied in this project.
 """
 
 import numpy as np
-from sklearn.cluster import KMeans
 from collections import defaultdict
-from tqdm import tqdm
 import pandas as pd
-import plotly.express as px
+from src.data.profiling import instrument
 
 
-def log_scale_dataset(df):
+def _apply_elementwise(df, func, cols, inplace=False, dtype=None):
+
+    """
+    Applies a numpy ufunc to the given
+    columns as a single 2D block rather
+    than column by column. Columns not in
+    "cols" are left untouched.
+    """
+
+    # Extension columns (e.g. nullable Int64) have no
+    # numpy dtype so they are computed as float64
+    if dtype is None:
+        dtypes = [
+            df[col].dtype if isinstance(df[col].dtype, np.dtype) else np.float64
+            for col in cols
+        ]
+        dtype = np.result_type(*dtypes, np.float32)
+
+    # This is the only copy we make. The ufunc
+    # then writes straight back into it
+    values = df[cols].to_numpy(dtype=dtype, na_value=np.nan)
+    if not values.flags.writeable:
+        values = values.copy()
+    func(values, out=values)
+
+    if inplace:
+        df[cols] = values
+        return df
+
+    # When all columns are transformed we can
+    # wrap the array without copying it again
+    # (the values are in the order of "cols")
+    if len(cols) == df.shape[1]:
+        df_out = pd.DataFrame(values, index=df.index, columns=cols, copy=False)
+        if list(cols) != list(df.columns):
+            df_out = df_out[list(df.columns)]
+        return df_out
+
+    df_out = df.copy()
+    df_out[cols] = values
+
+    return df_out
+
+
+class LogScaler:
+
+    """
+    Reusable version of log_scale_dataset()
+    that follows the sklearn transformer API.
+    It remembers which columns it scaled so
+    the transform can be inverted later on
+    (e.g. to report centroids in the
+    original units).
+    
+    Parameters:
+    -----------
+    
+    dtype : str (default = None)
+    
+    The output dtype. Use "float32" to halve
+    the memory of large feature matrices. If
+    None it keeps float64 (or the input
+    float dtype).
+    
+    """
+
+    def __init__(self, dtype=None):
+        self.dtype = dtype
+
+    # get_params / set_params let sklearn clone
+    # the scaler inside pipelines and grid searches
+    # without us importing sklearn at module level
+    def get_params(self, deep=True):
+        return {"dtype": self.dtype}
+
+    def set_params(self, **params):
+        for key, value in params.items():
+            setattr(self, key, value)
+        return self
+
+    def __repr__(self):
+        return f"LogScaler(dtype={self.dtype!r})"
+
+    def fit(self, df, y=None):
+
+        """
+        Stores the numerical columns
+        of the dataframe (booleans and
+        nullable integers included)
+        """
+
+        self.columns_ = [
+            col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])
+        ]
+
+        return self
+
+    def transform(self, df, inplace=False):
+
+        """
+        Applies np.log1p to the fitted
+        columns. If inplace is True the
+        input dataframe is updated and
+        returned.
+        """
+
+        return _apply_elementwise(
+            df, np.log1p, self.columns_, inplace=inplace, dtype=self.dtype
+        )
+
+    def inverse_transform(self, df, inplace=False):
+
+        """
+        Reverts the transform using
+        np.expm1
+        """
+
+        return _apply_elementwise(
+            df, np.expm1, self.columns_, inplace=inplace, dtype=self.dtype
+        )
+
+    def fit_transform(self, df, y=None, inplace=False):
+
+        """
+        Fits and transforms in one go
+        """
+
+        return self.fit(df).transform(df, inplace=inplace)
+
+
+@instrument
+def log_scale_dataset(df, inplace=False, dtype=None, return_scaler=False):
 
     """
     Takes in a dataframe of
@@ -32,7 +161,25 @@ def log_scale_dataset(df):
     df : dataframe
     
     Dataframe with numerical 
-    values to be scaled
+    values to be scaled. Any
+    non numerical columns are
+    left as they are.
+    
+    inplace : bool (default = False)
+    
+    If True the dataframe passed in is
+    updated rather than copied
+    
+    dtype : str (default = None)
+    
+    The output dtype (e.g. "float32").
+    If None it keeps float64.
+    
+    return_scaler : bool (default = False)
+    
+    If True it also returns the fitted
+    LogScaler so the transform can be
+    inverted or applied to new data
     
     Returns:
     --------
@@ -41,22 +188,170 @@ def log_scale_dataset(df):
     
     Dataframe with scaled values
     
+    scaler : LogScaler
+    
+    The fitted scaler. Only if
+    return_scaler is True
+    
     """
 
-    df_scaled = df.copy()
-    all_cols = df_scaled.columns
-
     # We use np.logp1 instead of log
     # as it copes deals a lot better
     # with very small values
     # https://numpy.org/doc/stable/reference/generated/numpy.log1p.html
-    for col in all_cols:
-        df_scaled[col] = np.log1p(df_scaled[col])
+    scaler = LogScaler(dtype=dtype).fit(df)
+    df_scaled = scaler.transform(df, inplace=inplace)
+
+    if return_scaler:
+        return df_scaled, scaler
 
     return df_scaled
 
 
-def run_kmeans(df, cluster_num, fit_only=False, iter_num=1000):
+def stratified_sample_idx(n_rows, sample_size, strata=None, random_state=None):
+
+    """
+    Draws a sample of row positions
+    of a given size. If strata are
+    given each stratum is represented
+    in proportion to its size (with
+    at least one row per stratum).
+    
+    Parameters:
+    -----------
+    
+    n_rows : int
+    
+    The total number of rows to
+    sample from
+    
+    sample_size : int
+    
+    The number of rows to sample
+    
+    strata : array-like (default = None)
+    
+    A label per row to stratify by
+    (e.g. country). If None a simple
+    random sample is drawn.
+    
+    random_state : int (default = None)
+    
+    Seed for the random generator
+    
+    Returns:
+    --------
+    
+    idx : numpy array
+    
+    Sorted array of sampled row positions
+    
+    """
+
+    rng = np.random.RandomState(random_state)
+    sample_size = min(sample_size, n_rows)
+
+    if strata is None:
+        return np.sort(rng.choice(n_rows, size=sample_size, replace=False))
+
+    # Shuffle once and then take the first
+    # rows of every stratum in the shuffled
+    # order. This keeps it a single pass
+    # rather than a loop of sample calls
+    codes, uniques = pd.factorize(np.asarray(strata))
+    counts = np.bincount(codes + 1, minlength=len(uniques) + 1)[1:]
+    quotas = np.maximum(np.round(counts * sample_size / n_rows), 1).astype(int)
+
+    perm = rng.permutation(n_rows)
+    perm_codes = codes[perm]
+    order = np.argsort(perm_codes, kind="stable")
+    sorted_codes = perm_codes[order]
+
+    # Rank of each row inside its stratum
+    starts = np.searchsorted(sorted_codes, sorted_codes, side="left")
+    ranks = np.arange(n_rows) - starts
+    valid = sorted_codes >= 0
+    keep = valid & (ranks < quotas[np.where(valid, sorted_codes, 0)])
+
+    return np.sort(perm[order[keep]])
+
+
+@instrument
+def nearest_centroid(values, centroids, chunk_size=100000):
+
+    """
+    Assigns every row to its nearest
+    centroid (squared euclidean distance)
+    working through the rows in chunks so
+    that memory stays bounded.
+    
+    Parameters:
+    -----------
+    
+    values : array-like
+    
+    The (already scaled) values to assign
+    
+    centroids : array-like
+    
+    Array of shape (n_clusters, n_features)
+    
+    chunk_size : int (default = 100000)
+    
+    The number of rows to process at once
+    
+    Returns:
+    --------
+    
+    labels : numpy array
+    
+    The index of the nearest centroid
+    for every row
+    
+    inertia : float
+    
+    Sum of squared distances of all
+    rows to their nearest centroid
+    
+    """
+
+    values = np.asarray(values)
+    centroids = np.asarray(centroids, dtype=values.dtype)
+    cent_sq = (centroids ** 2).sum(axis=1)
+
+    labels = np.empty(values.shape[0], dtype=np.int32)
+    inertia = 0.0
+
+    for start in range(0, values.shape[0], chunk_size):
+
+        chunk = values[start : start + chunk_size]
+
+        # ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2 which lets
+        # us get all the distances with one matrix product
+        dist = cent_sq - 2 * chunk @ centroids.T
+        chunk_labels = dist.argmin(axis=1)
+        row_sq = (chunk ** 2).sum(axis=1)
+        min_dist = np.maximum(dist[np.arange(len(chunk)), chunk_labels] + row_sq, 0)
+
+        labels[start : start + chunk_size] = chunk_labels
+        inertia += float(min_dist.sum())
+
+    return labels, inertia
+
+
+@instrument
+def run_kmeans(
+    df,
+    cluster_num,
+    fit_only=False,
+    iter_num=1000,
+    engine="full",
+    batch_size=1024,
+    sample_size=None,
+    strata=None,
+    chunk_size=100000,
+    random_state=None,
+):
 
     """
     Runs a kmeans algorithm using
@@ -85,7 +380,51 @@ def run_kmeans(df, cluster_num, fit_only=False, iter_num=1000):
     iter_num : int
     
     The number of iterations to run
-    the model for.
+    the model for. The "minibatch"
+    engine runs at most 100 passes
+    over the data.
+    
+    engine : str (default = "full")
+    
+    The algorithm to use. One of:
+    
+    - "full" : KMeans over every row
+    - "minibatch" : MiniBatchKMeans using
+      batches of "batch_size" rows
+    - "sampled" : KMeans fitted on a
+      (stratified) sample of "sample_size"
+      rows and then used to assign all
+      rows in chunks
+    
+    For "minibatch" and "sampled" the
+    model's inertia_ is recalculated
+    over the full data so that the values
+    are comparable with the "full" engine.
+    
+    batch_size : int (default = 1024)
+    
+    The batch size for the "minibatch"
+    engine
+    
+    sample_size : int (default = None)
+    
+    The number of rows to fit on for the
+    "sampled" engine. If None it uses
+    10% of the rows (at least 10,000).
+    
+    strata : array-like (default = None)
+    
+    A label per row used to stratify
+    the sample of the "sampled" engine
+    
+    chunk_size : int (default = 100000)
+    
+    The number of rows to assign at once
+    when working on the full data
+    
+    random_state : int (default = None)
+    
+    Seed to make the results reproducible
     
     Returns:
     --------
@@ -103,28 +442,94 @@ def run_kmeans(df, cluster_num, fit_only=False, iter_num=1000):
     
     """
 
-    values = df.copy()
-
-    # Define the model we use kmeans++
-    # as the initialisation which used
-    # "smart" initializing
-    # https://scikit-learn.org/stable/modules/generated/sklearn.cluster.KMeans.html
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if engine == "full":
+
+        # Define the model we use kmeans++
+        # as the initialisation which used
+        # "smart" initializing
+        # https://scikit-learn.org/stable/modules/generated/sklearn.cluster.KMeans.html
+
+        model = KMeans(
+            n_clusters=cluster_num,
+            init="k-means++",
+            max_iter=iter_num,
+            random_state=random_state,
+        )
+
+        # If we want to only return the
+        # model then we use the fit only
+        # method. This is useful when you
+        # are running the "Elbow Method"
+        if fit_only:
+            model.fit(df)
+            return model
+
+        else:
+            results = model.fit_predict(df)
+            return model, results
+
+    elif engine == "minibatch":
+
+        # For MiniBatchKMeans max_iter counts full
+        # passes over the data (not batches) so the
+        # KMeans iteration count is far too many.
+        # The labels are assigned below in chunks.
+        model = MiniBatchKMeans(
+            n_clusters=cluster_num,
+            init="k-means++",
+            max_iter=min(iter_num, 100),
+            batch_size=batch_size,
+            compute_labels=False,
+            random_state=random_state,
+        )
+        model.fit(df)
+
+    elif engine == "sampled":
+
+        if sample_size is None:
+            sample_size = max(int(df.shape[0] * 0.1), 10000)
+
+        idx = stratified_sample_idx(
+            n_rows=df.shape[0],
+            sample_size=sample_size,
+            strata=strata,
+            random_state=random_state,
+        )
+
+        model = KMeans(
+            n_clusters=cluster_num,
+            init="k-means++",
+            max_iter=iter_num,
+            random_state=random_state,
+        )
+        model.fit(np.asarray(df)[idx])
 
-    model = KMeans(n_clusters=cluster_num, init="k-means++", max_iter=iter_num)
+    else:
+        raise ValueError(
+            f"Unknown engine '{engine}'. Use 'full', 'minibatch' or 'sampled'."
+        )
+
+    # The minibatch and sampled labels and inertia
+    # only cover part of the data so we replace
+    # them with the ones over all rows
+    results, inertia = nearest_centroid(
+        np.asarray(df, dtype=model.cluster_centers_.dtype),
+        model.cluster_centers_,
+        chunk_size=chunk_size,
+    )
+    model.labels_ = results
+    model.inertia_ = inertia
 
-    # If we want to only return the
-    # model then we use the fit only
-    # method. This is useful when you
-    # are running the "Elbow Method"
     if fit_only:
-        model.fit(values)
         return model
 
     else:
-        results = model.fit_predict(values)
         return model, results
 
 
+@instrument
 def create_elbow_fig(df):
 
     """
@@ -150,6 +555,8 @@ def create_elbow_fig(df):
     
     """
 
+    import plotly.express as px
+
     # Copy the dataframe and build a line chart to
     # represent the elbow method
     df_elbow = df.copy()
@@ -172,7 +579,8 @@ def create_elbow_fig(df):
     return fig
 
 
-def run_elbow_method(df, max_clusters, iter_num=1000):
+@instrument
+def run_elbow_method(df, max_clusters, iter_num=1000, engine="full", **kwargs):
 
     """
     Takes in a dataframe and 
@@ -198,6 +606,17 @@ def run_elbow_method(df, max_clusters, iter_num=1000):
     The number of iterations to run
     the model for.
     
+    engine : str (default = "full")
+    
+    The kmeans engine to use. See
+    run_kmeans() for the options.
+    
+    **kwargs
+    
+    Any other keyword arguments are
+    passed on to run_kmeans() (e.g.
+    batch_size or sample_size)
+    
     Returns:
     --------
     
@@ -213,6 +632,8 @@ def run_elbow_method(df, max_clusters, iter_num=1000):
     
     """
 
+    from tqdm import tqdm
+
     # Initialize all variables
     score_dict = defaultdict(list)
 
@@ -222,7 +643,14 @@ def run_elbow_method(df, max_clusters, iter_num=1000):
     # number to the dictionary
     for cluster in tqdm(range(1, max_clusters + 1)):
 
-        model = run_kmeans(df=df, cluster_num=cluster, fit_only=True, iter_num=iter_num)
+        model = run_kmeans(
+            df=df,
+            cluster_num=cluster,
+            fit_only=True,
+            iter_num=iter_num,
+            engine=engine,
+            **kwargs,
+        )
 
         inertia = model.inertia_
         score_dict["cluster_num"].append(cluster)
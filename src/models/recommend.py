@@ -0,0 +1,344 @@
+"""
+RECOMMEND Module
+----------------
+
+@author : Stratoshad
+
+This module contains functions for item
+based product recommendations. Purchases
+are stored as a sparse customer x product
+matrix, the product similarities come from
+sparse matrix products and the top-k most
+similar products of every product are kept
+in an index. Recommending for a customer
+then only touches the products they bought
+and their neighbours.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.data.profiling import instrument
+
+
+@instrument
+def build_interaction_matrix(
+    df_clean,
+    weight="qty",
+    customer_col="customer_id",
+    item_col="stock_code",
+    drop_anonymous=True,
+):
+
+    """
+    Builds a sparse customer x product
+    matrix from the cleaned transactions.
+
+    Parameters:
+    -----------
+
+    df_clean : dataframe
+
+    The cleaned and renamed transactions
+
+    weight : str (default = "qty")
+
+    "qty" for the net quantity bought,
+    "total_price" for the net spend or
+    None for 1 per product bought. Net
+    values at or below zero (everything
+    returned) are dropped.
+
+    customer_col : str (default = "customer_id")
+
+    The customer column
+
+    item_col : str (default = "stock_code")
+
+    The product column
+
+    drop_anonymous : bool (default = True)
+
+    Leave out the transactions without
+    a customer ("00000")
+
+    Returns:
+    --------
+
+    matrix : scipy csr_matrix
+
+    The float32 customer x product matrix
+
+    customers : Index
+
+    The customer of every row
+
+    items : Index
+
+    The product of every column
+
+    """
+
+    from scipy import sparse
+
+    if weight not in [None, "qty", "total_price"]:
+        raise ValueError(f"Unknown weight '{weight}'.")
+
+    if drop_anonymous:
+        df_clean = df_clean.loc[df_clean[customer_col] != "00000"]
+
+    cust_codes, customers = pd.factorize(df_clean[customer_col])
+    item_codes, items = pd.factorize(df_clean[item_col])
+
+    if weight is None:
+        values = np.ones(df_clean.shape[0], dtype=np.float32)
+    else:
+        values = df_clean[weight].to_numpy(dtype=np.float32)
+
+    # Duplicate (customer, product) entries are summed
+    # when converting to CSR which gives the net value
+    matrix = sparse.coo_matrix(
+        (values, (cust_codes, item_codes)), shape=(len(customers), len(items))
+    ).tocsr()
+
+    matrix.data[matrix.data <= 0] = 0
+    matrix.eliminate_zeros()
+
+    if weight is None:
+        matrix.data[:] = 1
+
+    return matrix, pd.Index(customers), pd.Index(items)
+
+
+def _top_k_rows(block, k):
+
+    """
+    Returns the column indices and values
+    of the k largest values of every row
+    of a dense block (sorted descending)
+    """
+
+    k = min(k, block.shape[1])
+    top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    top_vals = np.take_along_axis(block, top, axis=1)
+
+    order = np.argsort(-top_vals, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_vals = np.take_along_axis(top_vals, order, axis=1)
+
+    return top, top_vals
+
+
+@instrument
+def build_neighbour_index(matrix, items, k=20, method="cosine", chunk_size=1024):
+
+    """
+    Computes the similarity between all
+    products and keeps the k most similar
+    products of every product.
+
+    The similarities are computed a block
+    of products at a time (a sparse product
+    of that block with the whole matrix) so
+    the full product x product matrix never
+    exists in memory.
+
+    Parameters:
+    -----------
+
+    matrix : scipy sparse matrix
+
+    The customer x product matrix
+    (see build_interaction_matrix)
+
+    items : Index
+
+    The product of every column
+
+    k : int (default = 20)
+
+    The neighbours to keep per product
+
+    method : str (default = "cosine")
+
+    "cosine" for the cosine similarity of
+    the product columns or "cooccurrence"
+    for the number of customers that
+    bought both products
+
+    chunk_size : int (default = 1024)
+
+    The number of products per block
+
+    Returns:
+    --------
+
+    index : dictionary
+
+    The "items", "neighbours" (positions,
+    one row per product), "scores" and
+    "method" of the index
+
+    """
+
+    from scipy import sparse
+
+    if method not in ["cosine", "cooccurrence"]:
+        raise ValueError(f"Unknown method '{method}'.")
+
+    matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+
+    if method == "cooccurrence":
+        matrix.data[:] = 1
+    else:
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+        norms[norms == 0] = 1
+        matrix = sparse.csr_matrix(matrix.multiply(1 / norms[None, :]))
+
+    matrix_t = matrix.T.tocsr()
+    n_items = matrix.shape[1]
+
+    # A catalogue of one product has no neighbours
+    k = max(min(k, n_items - 1), 0)
+
+    neighbours = np.zeros((n_items, k), dtype=np.int32)
+    scores = np.zeros((n_items, k), dtype=np.float32)
+
+    for start in range(0, n_items if k > 0 else 0, chunk_size):
+
+        end = min(start + chunk_size, n_items)
+        block = (matrix_t[start:end] @ matrix).toarray()
+
+        # A product is not its own neighbour
+        block[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        top, top_vals = _top_k_rows(block, k)
+        neighbours[start:end] = top
+        scores[start:end] = np.maximum(top_vals, 0)
+
+    return {
+        "items": pd.Index(items),
+        "neighbours": neighbours,
+        "scores": scores,
+        "method": method,
+    }
+
+
+def similar_items(index, item, n=10):
+
+    """
+    Returns the most similar products
+    of a product.
+
+    Parameters:
+    -----------
+
+    index : dictionary
+
+    The neighbour index
+    (see build_neighbour_index)
+
+    item : str
+
+    The product (stock code)
+
+    n : int (default = 10)
+
+    The number of products
+
+    Returns:
+    --------
+
+    df_sim : dataframe
+
+    The products and their similarity
+
+    """
+
+    pos = index["items"].get_loc(item)
+    keep = index["scores"][pos, :n] > 0
+
+    return pd.DataFrame(
+        {
+            "stock_code": index["items"][index["neighbours"][pos, :n][keep]],
+            "score": index["scores"][pos, :n][keep],
+        }
+    )
+
+
+@instrument
+def recommend(index, matrix, customers, customer_id, n=10, exclude_bought=True):
+
+    """
+    Recommends products to a customer. Every
+    product they bought votes for its
+    neighbours with its similarity times
+    the customer's weight for it.
+
+    Parameters:
+    -----------
+
+    index : dictionary
+
+    The neighbour index
+    (see build_neighbour_index)
+
+    matrix : scipy csr_matrix
+
+    The customer x product matrix
+
+    customers : Index
+
+    The customer of every row
+
+    customer_id : str or float
+
+    The customer to recommend to
+
+    n : int (default = 10)
+
+    The number of products
+
+    exclude_bought : bool (default = True)
+
+    Leave out products the
+    customer already bought
+
+    Returns:
+    --------
+
+    df_rec : dataframe
+
+    The recommended products and their
+    scores (empty for unknown customers)
+
+    """
+
+    if customer_id not in customers:
+        return pd.DataFrame({"stock_code": [], "score": []})
+
+    row = customers.get_loc(customer_id)
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    bought = matrix.indices[start:end]
+    weights = matrix.data[start:end]
+
+    # Scatter the votes of the neighbours
+    neigh = index["neighbours"][bought]
+    votes = index["scores"][bought] * weights[:, None]
+    item_scores = np.bincount(
+        neigh.ravel(), weights=votes.ravel(), minlength=len(index["items"])
+    )
+
+    if exclude_bought:
+        item_scores[bought] = 0
+
+    n = min(n, int((item_scores > 0).sum()))
+    if n == 0:
+        return pd.DataFrame({"stock_code": [], "score": []})
+
+    top, top_vals = _top_k_rows(item_scores[None, :], n)
+
+    return pd.DataFrame(
+        {"stock_code": index["items"][top[0]], "score": top_vals[0]}
+    )
@@ -0,0 +1,363 @@
+"""
+REGISTRY Module
+---------------
+
+@author : Stratoshad
+
+This module contains functions that
+save fitted models under the "models"
+folder and load them back. Each entry
+is keyed by a hash of the training data
+and the hyperparameters so that a model
+is only refitted when something changed.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.models import modeling
+from src.data.profiling import instrument
+
+# Bump this whenever the layout of the saved
+# entries changes. Entries written with a
+# different version are treated as missing.
+REGISTRY_VERSION = 1
+
+MODELS_DIR = Path(__file__).resolve().parents[2] / "models"
+
+
+def hash_training_data(df, params=None):
+
+    """
+    Creates a hash of a dataframe
+    and optionally a dictionary of
+    hyperparameters. The hash covers
+    the values, index, column names
+    and dtypes.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The training data
+
+    params : dictionary (default = None)
+
+    The hyperparameters used to
+    fit the model
+
+    Returns:
+    --------
+
+    key : str
+
+    A hex digest to use as the
+    registry key
+
+    """
+
+    hasher = hashlib.sha256()
+
+    # Hash the values row by row using pandas
+    # and then fold everything into one digest
+    row_hashes = pd.util.hash_pandas_object(df, index=True).values
+    hasher.update(row_hashes.tobytes())
+    hasher.update(json.dumps([str(c) for c in df.columns]).encode())
+    hasher.update(json.dumps([str(d) for d in df.dtypes]).encode())
+
+    if params is not None:
+        hasher.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    return hasher.hexdigest()[:24]
+
+
+def _entry_path(key, name, models_dir):
+
+    """
+    Returns the file path of an entry
+    """
+
+    return Path(models_dir) / f"{name}-{key}.joblib"
+
+
+def save_model(
+    model,
+    key,
+    feature_cols,
+    name="kmeans",
+    scaling=None,
+    params=None,
+    models_dir=MODELS_DIR,
+):
+
+    """
+    Saves a fitted model together with
+    its centroids, feature columns and
+    scaling parameters.
+
+    Parameters:
+    -----------
+
+    model : sklearn class
+
+    The fitted model
+
+    key : str
+
+    The registry key (see hash_training_data)
+
+    feature_cols : list
+
+    The columns the model was trained on
+
+    name : str (default = "kmeans")
+
+    The name of the model family. Used
+    as the prefix of the file name
+
+    scaling : object (default = None)
+
+    Scaling parameters (or a fitted
+    transformer) applied before the model
+
+    params : dictionary (default = None)
+
+    The hyperparameters used
+
+    models_dir : str (default = "<project>/models")
+
+    The folder to save the entry in
+
+    Returns:
+    --------
+
+    entry : dictionary
+
+    The saved entry
+
+    """
+
+    import joblib
+    import sklearn
+
+    os.makedirs(models_dir, exist_ok=True)
+
+    centroids = getattr(model, "cluster_centers_", None)
+
+    entry = {
+        "version": REGISTRY_VERSION,
+        "sklearn_version": sklearn.__version__,
+        "key": key,
+        "name": name,
+        "created_at": time.time(),
+        "params": params,
+        "feature_cols": list(feature_cols),
+        "scaling": scaling,
+        "centroids": None if centroids is None else np.asarray(centroids),
+        "model": model,
+    }
+
+    # Write to a temporary file first so that a
+    # crash never leaves a half written entry
+    path = _entry_path(key, name, models_dir)
+    tmp_path = path.with_suffix(".tmp")
+    joblib.dump(entry, tmp_path)
+    os.replace(tmp_path, path)
+
+    return entry
+
+
+def load_model(key, name="kmeans", max_age_days=None, models_dir=MODELS_DIR):
+
+    """
+    Loads a registry entry if it exists,
+    was written by the current registry
+    and sklearn versions and is not older
+    than the given age.
+
+    Parameters:
+    -----------
+
+    key : str
+
+    The registry key
+
+    name : str (default = "kmeans")
+
+    The name of the model family
+
+    max_age_days : float (default = None)
+
+    Entries older than this are ignored.
+    If None there is no age limit.
+
+    models_dir : str (default = "<project>/models")
+
+    The folder with the entries
+
+    Returns:
+    --------
+
+    entry : dictionary or None
+
+    The saved entry or None if there
+    is no valid entry
+
+    """
+
+    import joblib
+    import sklearn
+
+    path = _entry_path(key, name, models_dir)
+
+    if not path.exists():
+        return None
+
+    entry = joblib.load(path)
+
+    if (entry.get("version") != REGISTRY_VERSION) or (
+        entry.get("sklearn_version") != sklearn.__version__
+    ):
+        return None
+
+    if max_age_days is not None:
+        age_days = (time.time() - entry["created_at"]) / (24 * 3600)
+        if age_days > max_age_days:
+            return None
+
+    return entry
+
+
+def evict_models(max_age_days, name=None, models_dir=MODELS_DIR):
+
+    """
+    Deletes all registry entries that
+    are older than the given age.
+
+    Parameters:
+    -----------
+
+    max_age_days : float
+
+    Entries older than this are deleted
+
+    name : str (default = None)
+
+    Only evict entries of this model
+    family. If None evicts all of them.
+
+    models_dir : str (default = "<project>/models")
+
+    The folder with the entries
+
+    Returns:
+    --------
+
+    removed : list
+
+    The paths of the deleted entries
+
+    """
+
+    removed = []
+
+    if not Path(models_dir).exists():
+        return removed
+
+    pattern = "*.joblib" if name is None else f"{name}-*.joblib"
+    cutoff = time.time() - max_age_days * 24 * 3600
+
+    # Use the file modification time so we
+    # don't have to unpickle every entry
+    for path in Path(models_dir).glob(pattern):
+        if path.stat().st_mtime < cutoff:
+            path.unlink()
+            removed.append(str(path))
+
+    return removed
+
+
+@instrument
+def get_or_fit_kmeans(
+    df, cluster_num, scaling=None, max_age_days=None, models_dir=MODELS_DIR, **kwargs
+):
+
+    """
+    Returns a fitted kmeans model from the
+    registry if one exists for the same data
+    and hyperparameters. Otherwise it fits
+    one with run_kmeans() and saves it.
+
+    Parameters:
+    -----------
+
+    df : dataframe
+
+    The (already scaled) training data
+
+    cluster_num : int
+
+    The number of clusters
+
+    scaling : object (default = None)
+
+    The scaling parameters applied to
+    create df. Saved along with the model.
+
+    max_age_days : float (default = None)
+
+    Refit if the saved entry is older
+    than this. If None there is no limit.
+
+    models_dir : str (default = "<project>/models")
+
+    The folder of the registry
+
+    **kwargs
+
+    Any other arguments of run_kmeans()
+    (e.g. iter_num, engine, random_state)
+
+    Returns:
+    --------
+
+    entry : dictionary
+
+    The registry entry with the keys
+    "model", "centroids", "feature_cols",
+    "scaling", "params" and "key"
+
+    """
+
+    params = dict(kwargs, cluster_num=cluster_num)
+
+    # The strata are a whole array so we only
+    # keep their hash as part of the key
+    if params.get("strata") is not None:
+        strata = pd.Series(np.asarray(params["strata"]))
+        params["strata"] = hash_training_data(strata.to_frame())
+    key = hash_training_data(df, params=params)
+
+    entry = load_model(key, max_age_days=max_age_days, models_dir=models_dir)
+
+    if entry is not None:
+        return entry
+
+    model = modeling.run_kmeans(df=df, cluster_num=cluster_num, fit_only=True, **kwargs)
+
+    return save_model(
+        model,
+        key=key,
+        feature_cols=df.columns,
+        scaling=scaling,
+        params=params,
+        models_dir=models_dir,
+    )
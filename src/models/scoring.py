@@ -0,0 +1,204 @@
+"""
+SCORING Module
+--------------
+
+@author : Stratoshad
+
+This module contains functions that
+assign customers to the segments of
+an already fitted model. They work in
+fixed size chunks so memory stays the
+same however many customers we score.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.models import modeling
+from src.data.profiling import instrument
+
+
+def _iter_chunks(data, chunk_size):
+
+    """
+    Yields dataframe chunks from either
+    a single dataframe or an iterable
+    of dataframes (e.g. a chunked
+    pd.read_csv() reader)
+    """
+
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, data.shape[0], chunk_size):
+            yield data.iloc[start : start + chunk_size]
+
+    else:
+        for df_chunk in data:
+            for start in range(0, df_chunk.shape[0], chunk_size):
+                yield df_chunk.iloc[start : start + chunk_size]
+
+
+def iter_assign_segments(
+    data,
+    centroids,
+    feature_cols=None,
+    scale=True,
+    chunk_size=100000,
+    dtype="float32",
+    id_col=None,
+):
+
+    """
+    Assigns every customer to the nearest
+    centroid chunk by chunk and yields the
+    results as they are computed.
+
+    Parameters:
+    -----------
+
+    data : dataframe or iterable of dataframes
+
+    The customer features to score. Passing
+    a chunked reader (e.g. pd.read_csv with
+    chunksize) keeps memory constant.
+
+    centroids : array-like
+
+    The fitted centroids of shape
+    (n_clusters, n_features)
+
+    feature_cols : list (default = None)
+
+    The columns the model was trained on
+    (in order). If None uses all columns
+    apart from the id_col.
+
+    scale : bool or LogScaler (default = True)
+
+    Whether to apply log_scale_dataset()
+    to the features before assigning them.
+    A fitted LogScaler (or any transformer)
+    is applied as it is.
+
+    chunk_size : int (default = 100000)
+
+    The number of customers per chunk
+
+    dtype : str (default = "float32")
+
+    The dtype used for the distance
+    calculation. "float64" gives the
+    exact same results as the model.
+
+    id_col : str (default = None)
+
+    A column to carry over to the output
+    (e.g. "customer_id")
+
+    Yields:
+    -------
+
+    df_seg : dataframe
+
+    A dataframe with the original index,
+    the id column (if given) and a
+    "segment" column
+
+    """
+
+    centroids = np.asarray(centroids, dtype=dtype)
+
+    for df_chunk in _iter_chunks(data, chunk_size):
+
+        if feature_cols is not None:
+            cols = feature_cols
+        else:
+            cols = [col for col in df_chunk.columns if col != id_col]
+
+        df_feat = df_chunk[cols]
+
+        if hasattr(scale, "transform"):
+            df_feat = scale.transform(df_feat)
+
+        elif scale:
+            df_feat = modeling.log_scale_dataset(df_feat, dtype=dtype)
+
+        values = df_feat.to_numpy(dtype=dtype)
+        labels, _ = modeling.nearest_centroid(values, centroids, chunk_size=chunk_size)
+
+        df_seg = pd.DataFrame({"segment": labels}, index=df_chunk.index)
+
+        if id_col is not None:
+            df_seg.insert(0, id_col, df_chunk[id_col].values)
+
+        yield df_seg
+
+
+@instrument
+def assign_segments(data, centroids, **kwargs):
+
+    """
+    Assigns every customer to the nearest
+    centroid and returns all of them at
+    once. See iter_assign_segments() for
+    the parameters.
+
+    Returns:
+    --------
+
+    df_seg : dataframe
+
+    A dataframe with a "segment" column
+
+    """
+
+    df_list = list(iter_assign_segments(data, centroids, **kwargs))
+
+    if len(df_list) == 0:
+        return pd.DataFrame({"segment": np.array([], dtype=np.int32)})
+
+    return pd.concat(df_list)
+
+
+def iter_assign_from_entry(data, entry, **kwargs):
+
+    """
+    Same as iter_assign_segments() but takes
+    the centroids, feature columns and (if it
+    was saved) the fitted scaler from a
+    registry entry (see the registry module).
+
+    Parameters:
+    -----------
+
+    data : dataframe or iterable of dataframes
+
+    The customer features to score
+
+    entry : dictionary
+
+    The registry entry of a fitted model
+
+    **kwargs
+
+    Any other arguments of
+    iter_assign_segments()
+
+    Yields:
+    -------
+
+    df_seg : dataframe
+
+    A dataframe with a "segment" column
+
+    """
+
+    if hasattr(entry.get("scaling"), "transform"):
+        kwargs.setdefault("scale", entry["scaling"])
+
+    return iter_assign_segments(
+        data,
+        centroids=entry["centroids"],
+        feature_cols=entry["feature_cols"],
+        **kwargs,
+    )
@@ -0,0 +1,567 @@
+"""
+SERVICE Module
+--------------
+
+@author : Stratoshad
+
+This module serves the customer features
+and segments over HTTP on localhost so
+other tools can look customers up without
+running the notebooks. It only uses the
+standard library (http.server) and needs
+no external infrastructure.
+
+The customer features of the pipeline and
+the centroids of the fitted kmeans model
+are exported once to .npy files and opened
+as memory-mapped arrays, so starting the
+service is cheap and the operating system
+keeps the hot pages in memory. Customers are
+found through a sorted integer ID index and
+the scored results are kept in an LRU cache.
+
+Usage:
+
+    python -m src.models.service --port 8050
+
+    curl localhost:8050/customers/12487
+    curl -X POST localhost:8050/customers -d '{"ids": [12487, 12441]}'
+    curl localhost:8050/stats
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+from collections import deque
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from src import pipeline
+from src.models import registry
+from src.data.profiling import instrument
+
+STORE_DIR = pipeline.INTERIM_DIR / "service"
+META_FILE = "meta.json"
+
+# The customer without an ID is an
+# aggregate and can't be looked up
+MISSING_ID = "00000"
+
+# The number of request timings
+# kept for the latency report
+LATENCY_WINDOW = 10000
+
+
+def _source_fingerprint(paths):
+
+    """
+    The size and modification time of the
+    pipeline outputs the store is built from
+    """
+
+    fingerprint = {}
+
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint[Path(path).name] = [stat.st_size, stat.st_mtime_ns]
+
+    return fingerprint
+
+
+def _to_int_id(value):
+
+    """
+    Turns a customer ID (e.g. "12487",
+    12487.0 or 12487) into an int. IDs
+    that are not whole numbers (e.g.
+    12487.7) raise a ValueError.
+    """
+
+    if isinstance(value, (bool, np.bool_)):
+        raise ValueError(f"Invalid customer ID: {value!r}")
+
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+
+    if number is None or not number.is_integer():
+        raise ValueError(f"Invalid customer ID: {value!r}")
+
+    return int(number)
+
+
+def _to_int_ids(ids):
+
+    """
+    Turns a list of customer
+    IDs into int64 (see _to_int_id)
+    """
+
+    return np.array([_to_int_id(value) for value in ids], dtype=np.int64)
+
+
+@instrument
+def build_store(
+    interim_dir=pipeline.INTERIM_DIR,
+    models_dir=registry.MODELS_DIR,
+    store_dir=STORE_DIR,
+):
+
+    """
+    Exports the customer features and the
+    fitted kmeans model of the pipeline to
+    .npy files that load_store() opens as
+    memory-mapped arrays. The rows are
+    sorted by the integer customer ID.
+
+    Parameters:
+    -----------
+
+    interim_dir : str (default = "data/interim")
+
+    The folder with the outputs of the
+    customer_features and clustering stages
+
+    models_dir : str (default = "<project>/models")
+
+    The folder of the model registry
+
+    store_dir : str (default = "data/interim/service")
+
+    The folder for the arrays
+
+    Returns:
+    --------
+
+    meta : dictionary
+
+    The feature columns, the countries,
+    the model key and the fingerprint of
+    the pipeline outputs
+
+    """
+
+    feat_path = pipeline.output_path("customer_features", interim_dir)
+    seg_path = pipeline.output_path("clustering", interim_dir)
+
+    df_feat = pd.read_pickle(feat_path)
+    df_seg = pd.read_pickle(seg_path)
+
+    if df_seg.shape[0] == 0:
+        raise ValueError("The customer segments table is empty.")
+
+    model_key = df_seg["model_key"].iloc[0]
+    entry = registry.load_model(model_key, models_dir=models_dir)
+
+    if entry is None:
+        raise ValueError(
+            f"Model {model_key} is not in the registry. Rerun the clustering stage."
+        )
+
+    df_feat = df_feat.loc[df_feat["customer_id"] != MISSING_ID].copy()
+    df_feat["customer_id"] = _to_int_ids(df_feat["customer_id"])
+    df_feat = df_feat.sort_values(by="customer_id", kind="mergesort")
+
+    if df_feat["customer_id"].duplicated().any():
+        raise ValueError("The customer IDs are not unique.")
+
+    # The numeric features are returned as they are. The
+    # model features are scaled once here like in the
+    # clustering stage so scoring is a distance lookup.
+    feature_cols = list(
+        df_feat.drop(columns=["customer_id"]).select_dtypes(include="number").columns
+    )
+    df_model = df_feat[entry["feature_cols"]].clip(lower=0)
+    if hasattr(entry["scaling"], "transform"):
+        df_model = entry["scaling"].transform(df_model)
+
+    country_codes, countries = pd.factorize(df_feat["country"])
+
+    os.makedirs(store_dir, exist_ok=True)
+    arrays = {
+        "ids": df_feat["customer_id"].values,
+        "features": df_feat[feature_cols].values.astype(np.float64),
+        "model_features": np.asarray(df_model, dtype=np.float64),
+        "centroids": np.asarray(entry["centroids"], dtype=np.float64),
+        "countries": country_codes.astype(np.int32),
+    }
+    for name, values in arrays.items():
+        np.save(Path(store_dir) / f"{name}.npy", np.ascontiguousarray(values))
+
+    meta = {
+        "feature_cols": feature_cols,
+        "countries": [str(country) for country in countries],
+        "model_key": model_key,
+        "sources": _source_fingerprint([feat_path, seg_path]),
+    }
+
+    # The meta file is written last so a store
+    # without one is never treated as complete
+    tmp_path = Path(store_dir) / f"_{META_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, Path(store_dir) / META_FILE)
+
+    return meta
+
+
+def store_is_current(interim_dir=pipeline.INTERIM_DIR, store_dir=STORE_DIR):
+
+    """
+    Whether the store was built from the
+    current pipeline outputs
+    """
+
+    meta_path = Path(store_dir) / META_FILE
+
+    if not meta_path.exists():
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    paths = [
+        pipeline.output_path("customer_features", interim_dir),
+        pipeline.output_path("clustering", interim_dir),
+    ]
+
+    if not all(path.exists() for path in paths):
+        return True
+
+    return meta["sources"] == _source_fingerprint(paths)
+
+
+def load_store(store_dir=STORE_DIR, cache_size=100000):
+
+    """
+    Opens the arrays of build_store() as
+    memory-mapped (read only) arrays and
+    sets up the scoring cache and the
+    latency window.
+
+    Parameters:
+    -----------
+
+    store_dir : str (default = "data/interim/service")
+
+    The folder with the arrays
+
+    cache_size : int (default = 100000)
+
+    The number of scored customers
+    kept in the LRU cache
+
+    Returns:
+    --------
+
+    service : dictionary
+
+    The arrays, the meta data, the cached
+    "score" function (integer ID -> result
+    or None) and the request timings
+
+    """
+
+    with open(Path(store_dir) / META_FILE) as f:
+        meta = json.load(f)
+
+    service = {
+        name: np.load(Path(store_dir) / f"{name}.npy", mmap_mode="r")
+        for name in ["ids", "features", "model_features", "centroids", "countries"]
+    }
+    service["meta"] = meta
+    service["latencies"] = deque(maxlen=LATENCY_WINDOW)
+    service["lock"] = threading.Lock()
+    service["started_at"] = time.time()
+
+    @lru_cache(maxsize=cache_size)
+    def score(customer_id):
+        return score_customer(service, customer_id)
+
+    service["score"] = score
+
+    return service
+
+
+def score_customer(service, customer_id):
+
+    """
+    Looks a customer up in the store and
+    assigns it to the nearest centroid.
+
+    Parameters:
+    -----------
+
+    service : dictionary
+
+    The store (see load_store)
+
+    customer_id : int
+
+    The integer customer ID
+
+    Returns:
+    --------
+
+    result : dictionary or None
+
+    The "customer_id", "country", "segment",
+    the squared "distance" to its centroid
+    and the "features". None if the
+    customer is not in the store.
+
+    """
+
+    ids = service["ids"]
+    pos = int(np.searchsorted(ids, customer_id))
+
+    if pos == len(ids) or ids[pos] != customer_id:
+        return None
+
+    diff = service["centroids"] - service["model_features"][pos]
+    distances = (diff**2).sum(axis=1)
+    segment = int(distances.argmin())
+
+    # JSON has no NaN so missing values become None
+    features = {
+        col: (None if np.isnan(value) else float(value))
+        for col, value in zip(service["meta"]["feature_cols"], service["features"][pos])
+    }
+
+    return {
+        "customer_id": int(customer_id),
+        "country": service["meta"]["countries"][service["countries"][pos]],
+        "segment": segment,
+        "distance": float(distances[segment]),
+        "features": features,
+    }
+
+
+def lookup_customers(service, customer_ids):
+
+    """
+    Scores a batch of customers through the
+    cache. Returns the results and the IDs
+    that are not in the store.
+    """
+
+    results = []
+    missing = []
+
+    for customer_id in _to_int_ids(customer_ids):
+        result = service["score"](int(customer_id))
+        if result is None:
+            missing.append(int(customer_id))
+        else:
+            results.append(result)
+
+    return results, missing
+
+
+def latency_report(service):
+
+    """
+    The number of requests, the p50, p99
+    and max latency (in ms) of the last
+    LATENCY_WINDOW requests and the
+    cache statistics
+    """
+
+    with service["lock"]:
+        latencies = np.array(service["latencies"]) * 1000
+
+    cache = service["score"].cache_info()
+    report = {
+        "requests": len(latencies),
+        "uptime_s": round(time.time() - service["started_at"], 1),
+        "cache_hits": cache.hits,
+        "cache_misses": cache.misses,
+        "cache_size": cache.currsize,
+    }
+
+    if len(latencies) > 0:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        report.update(
+            {
+                "p50_ms": round(float(p50), 3),
+                "p99_ms": round(float(p99), 3),
+                "max_ms": round(float(latencies.max()), 3),
+            }
+        )
+
+    return report
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    """
+    Answers the requests of the service:
+
+    - GET /customers/<id> : one customer
+    - GET /customers?ids=<id>,<id> : a batch
+    - POST /customers {"ids": [...]} : a batch
+    - GET /stats : the latency report
+    - GET /health : the size of the store
+
+    """
+
+    # Keep-alive so clients can reuse the connection
+    # between lookups. Without TCP_NODELAY the body
+    # would wait for the ack of the headers.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # Per request logging costs more than the lookup
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _timed(self, func):
+        start = time.perf_counter()
+        try:
+            status, body = func()
+        except ValueError as e:
+            status, body = 400, {"error": str(e)}
+        except Exception as e:
+            # The client always gets an answer
+            status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+        self._send(status, body)
+
+        service = self.server.service
+        with service["lock"]:
+            service["latencies"].append(time.perf_counter() - start)
+
+    def _get(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["health"]:
+            return 200, {"status": "ok", "customers": len(service["ids"])}
+
+        if parts == ["stats"]:
+            return 200, latency_report(service)
+
+        if parts == ["customers"]:
+            ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+            results, missing = lookup_customers(service, [i for i in ids if i])
+            return 200, {"customers": results, "missing": missing}
+
+        if len(parts) == 2 and parts[0] == "customers":
+            result = service["score"](_to_int_id(parts[1]))
+            if result is None:
+                return 404, {"error": f"Customer {parts[1]} not found"}
+            return 200, result
+
+        return 404, {"error": f"Unknown path {url.path}"}
+
+    def _post(self):
+        if urlparse(self.path).path.rstrip("/") != "/customers":
+            return 404, {"error": f"Unknown path {self.path}"}
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}") from e
+
+        if not isinstance(body, dict) or not isinstance(body.get("ids", []), list):
+            raise ValueError('The body has to be an object like {"ids": [...]}')
+
+        results, missing = lookup_customers(self.server.service, body.get("ids", []))
+
+        return 200, {"customers": results, "missing": missing}
+
+    def do_GET(self):
+        self._timed(self._get)
+
+    def do_POST(self):
+        self._timed(self._post)
+
+
+def make_server(service, host="127.0.0.1", port=8050):
+
+    """
+    Creates the HTTP server of a loaded
+    store. Each request runs in its own
+    thread. Call serve_forever() on it
+    to start answering.
+    """
+
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+
+    return server
+
+
+def main(argv=None):
+
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Serve the customer features and segments on localhost."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--interim-dir", default=str(pipeline.INTERIM_DIR))
+    parser.add_argument("--models-dir", default=str(registry.MODELS_DIR))
+    parser.add_argument("--store-dir", default=None)
+    parser.add_argument("--cache-size", type=int, default=100000)
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Export the arrays even if current"
+    )
+    args = parser.parse_args(argv)
+
+    store_dir = (
+        Path(args.interim_dir) / "service" if args.store_dir is None else args.store_dir
+    )
+
+    if args.rebuild or not store_is_current(args.interim_dir, store_dir):
+        build_store(args.interim_dir, args.models_dir, store_dir)
+
+    service = load_store(store_dir, cache_size=args.cache_size)
+    server = make_server(service, host=args.host, port=args.port)
+
+    print(
+        f"Serving {len(service['ids'])} customers on http://{args.host}:{args.port}"
+    )
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(latency_report(service)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
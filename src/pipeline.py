@@ -0,0 +1,555 @@
+"""
+PIPELINE Module
+---------------
+
+@author : Stratoshad
+
+This module runs the whole workflow of
+the notebooks (loading, cleaning,
+cancellations, aggregation, customer
+features and clustering) as a graph of
+stages. Every stage persists its output
+under data/interim so a run can resume
+from any stage, and stages that don't
+depend on each other (e.g. the product
+and invoice tables) run in parallel
+worker processes.
+
+Usage:
+
+    ecom-pipeline
+    ecom-pipeline --from customers --until customer_features
+    ecom-pipeline --resume --jobs 4 --csv
+    ecom-pipeline --sample-frac 0.1
+
+"""
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+RAW_DIR = PROJECT_DIR / "data" / "raw"
+INTERIM_DIR = PROJECT_DIR / "data" / "interim"
+
+# The features used for the customer segments
+CLUSTER_FEATURES = ["orders", "total_spend", "time_inactive", "lifetime"]
+
+
+def _stage_raw(inputs, options):
+
+    """
+    Loads the raw transactions (or a
+    sample of their customers)
+    """
+
+    from src.data import make_dataset
+
+    df_raw = make_dataset.load_raw_data(options["raw_dir"], fn=options["raw_file"])
+
+    if options.get("sample_frac") is not None:
+        df_raw = make_dataset.sample_customers(
+            df_raw, frac=options["sample_frac"], seed=options["sample_seed"]
+        )
+
+    return df_raw
+
+
+def _stage_clean(inputs, options):
+
+    """
+    Applies the NB1 cleaning steps
+    """
+
+    from src.data import make_dataset
+
+    return make_dataset.clean_raw_data(inputs["raw"])
+
+
+def _stage_cancellations(inputs, options):
+
+    """
+    Matches the cancellations and
+    returns the final transactions
+    """
+
+    from src.data import make_dataset
+    from src.features import build_features
+
+    df_canc, _ = build_features.process_cancellations(inputs["clean"])
+
+    return make_dataset.finalize_cancellations(df_canc)
+
+
+def _stage_customers(inputs, options):
+
+    """
+    Builds the customer table
+    """
+
+    from src.features import build_features
+
+    return build_features.get_customer_table(inputs["cancellations"])
+
+
+def _stage_products(inputs, options):
+
+    """
+    Builds the product table
+    """
+
+    from src.features import build_features
+
+    return build_features.get_product_table(inputs["cancellations"])
+
+
+def _stage_invoices(inputs, options):
+
+    """
+    Builds the invoice table
+    """
+
+    from src.features import build_features
+
+    return build_features.get_invoice_table(inputs["cancellations"])
+
+
+def _stage_main(inputs, options):
+
+    """
+    Builds the main table with
+    the date features
+    """
+
+    from src.features import build_features
+
+    return build_features.get_main_table(inputs["cancellations"], inputs["invoices"])
+
+
+def _stage_customer_features(inputs, options):
+
+    """
+    Adds the frequency, lifetime,
+    inactivity and rate features
+    """
+
+    from src.features import build_features
+
+    # The customer functions expect the dates as
+    # strings (as read back from the NB1 csv files)
+    date_fmt = "%Y-%m-%d %H:%M:%S"
+    df_cust = inputs["customers"].copy()
+    df_inv = inputs["main"][["customer_id", "invc_num", "invc_date"]].copy()
+
+    for col in ["first_purchase", "last_purchase"]:
+        df_cust[col] = df_cust[col].dt.strftime(date_fmt)
+    df_inv["invc_date"] = df_inv["invc_date"].dt.strftime(date_fmt)
+
+    return build_features.process_customer_data(df_cust=df_cust, df_inv=df_inv)
+
+
+def _stage_clustering(inputs, options):
+
+    """
+    Fits (or loads from the registry)
+    the kmeans model on the log scaled
+    features and labels every customer
+    """
+
+    from src.models import modeling, registry
+
+    # Customers without an ID are a single
+    # aggregate so they are left out
+    df_feat = inputs["customer_features"]
+    df_feat = df_feat.loc[df_feat["customer_id"] != "00000"].reset_index(drop=True)
+
+    df_scaled, scaler = modeling.log_scale_dataset(
+        df_feat[CLUSTER_FEATURES].clip(lower=0), return_scaler=True
+    )
+
+    entry = registry.get_or_fit_kmeans(
+        df_scaled,
+        cluster_num=options["n_clusters"],
+        scaling=scaler,
+        random_state=options["random_state"],
+        models_dir=options["models_dir"],
+    )
+
+    df_seg = df_feat[["customer_id", "country"] + CLUSTER_FEATURES].copy()
+    df_seg["segment"] = entry["model"].predict(df_scaled)
+    df_seg["model_key"] = entry["key"]
+
+    return df_seg
+
+
+# Every stage with its dependencies and the name
+# of its output (the NB1 file names where they exist).
+# The order is a valid topological order.
+STAGES = {
+    "raw": {"deps": [], "func": _stage_raw, "output": "raw_data"},
+    "clean": {"deps": ["raw"], "func": _stage_clean, "output": "clean_data"},
+    "cancellations": {
+        "deps": ["clean"],
+        "func": _stage_cancellations,
+        "output": "data_cleanned",
+    },
+    "customers": {
+        "deps": ["cancellations"],
+        "func": _stage_customers,
+        "output": "customer_data",
+    },
+    "products": {
+        "deps": ["cancellations"],
+        "func": _stage_products,
+        "output": "product_data",
+    },
+    "invoices": {
+        "deps": ["cancellations"],
+        "func": _stage_invoices,
+        "output": "invoice_data",
+    },
+    "main": {
+        "deps": ["cancellations", "invoices"],
+        "func": _stage_main,
+        "output": "main_data",
+    },
+    "customer_features": {
+        "deps": ["customers", "main"],
+        "func": _stage_customer_features,
+        "output": "customer_features",
+    },
+    "clustering": {
+        "deps": ["customer_features"],
+        "func": _stage_clustering,
+        "output": "customer_segments",
+    },
+}
+
+# Stages whose output is also written as
+# csv (with the file names of NB1) on --csv
+CSV_STAGES = ["cancellations", "customers", "products", "invoices", "main"]
+
+
+def output_path(stage, interim_dir=INTERIM_DIR):
+
+    """
+    Returns the path of the persisted
+    output of a stage
+    """
+
+    return Path(interim_dir) / f"{STAGES[stage]['output']}.pkl"
+
+
+def _ancestors(stage):
+
+    """
+    Returns all the stages
+    a stage depends on
+    """
+
+    found = set(STAGES[stage]["deps"])
+
+    for dep in STAGES[stage]["deps"]:
+        found |= _ancestors(dep)
+
+    return found
+
+
+def select_stages(start=None, until=None):
+
+    """
+    Returns the stages to run in
+    topological order.
+
+    Parameters:
+    -----------
+
+    start : str (default = None)
+
+    Run this stage and every stage
+    after it. The outputs of the
+    earlier ones are read from disk.
+
+    until : str or list (default = None)
+
+    Stop once this stage (or stages)
+    and everything it needs has run
+
+    Returns:
+    --------
+
+    stages : list
+
+    The stage names in run order
+
+    """
+
+    selected = set(STAGES)
+
+    if start is not None:
+        names = list(STAGES)
+        selected &= set(names[names.index(start) :])
+
+    if until is not None:
+        until = [until] if isinstance(until, str) else until
+        needed = set(until)
+        for name in until:
+            needed |= _ancestors(name)
+        selected &= needed
+
+    if len(selected) == 0:
+        raise ValueError(f"Stage '{until}' runs before stage '{start}'.")
+
+    return [name for name in STAGES if name in selected]
+
+
+def run_stage(name, options):
+
+    """
+    Runs a single stage. Reads the outputs
+    of its dependencies from disk and
+    persists its own output.
+
+    Parameters:
+    -----------
+
+    name : str
+
+    The stage name
+
+    options : dictionary
+
+    The pipeline options (see main)
+
+    Returns:
+    --------
+
+    result : dictionary
+
+    The stage name, its wall time
+    in seconds and its output rows
+
+    """
+
+    start = time.perf_counter()
+    interim_dir = options["interim_dir"]
+
+    inputs = {
+        dep: pd.read_pickle(output_path(dep, interim_dir))
+        for dep in STAGES[name]["deps"]
+    }
+    df_out = STAGES[name]["func"](inputs, options)
+
+    # Write to a temporary file first so a failed
+    # run never leaves a half written output behind
+    path = output_path(name, interim_dir)
+    tmp_path = path.with_suffix(".pkl.tmp")
+    df_out.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+    if options["csv"] and name in CSV_STAGES:
+        df_out.to_csv(path.with_suffix(".csv"), index=False)
+
+    return {
+        "stage": name,
+        "seconds": round(time.perf_counter() - start, 2),
+        "rows": df_out.shape[0],
+    }
+
+
+def _is_stale(name, pending, interim_dir):
+
+    """
+    Whether a stage has to run on resume:
+    its output is missing, one of its
+    dependencies runs or was written after
+    it (e.g. by an earlier partial run)
+    """
+
+    path = output_path(name, interim_dir)
+
+    if not path.exists():
+        return True
+
+    for dep in STAGES[name]["deps"]:
+        dep_path = output_path(dep, interim_dir)
+        if dep in pending or (
+            dep_path.exists() and dep_path.stat().st_mtime_ns > path.stat().st_mtime_ns
+        ):
+            return True
+
+    return False
+
+
+def run_pipeline(stages, options, jobs=1, resume=False):
+
+    """
+    Runs the stages as a dependency graph.
+    A stage starts as soon as all of its
+    dependencies finished so independent
+    stages run at the same time.
+
+    Parameters:
+    -----------
+
+    stages : list
+
+    The stages to run (see select_stages)
+
+    options : dictionary
+
+    The pipeline options (see main)
+
+    jobs : int (default = 1)
+
+    The number of worker processes. With
+    1 everything runs in this process.
+
+    resume : bool (default = False)
+
+    Skip the stages that already have a
+    persisted output that is newer than
+    the outputs of their dependencies and
+    none of their dependencies runs
+
+    Returns:
+    --------
+
+    df_timing : dataframe
+
+    The status, wall time and output
+    rows of every stage
+
+    """
+
+    interim_dir = options["interim_dir"]
+    os.makedirs(interim_dir, exist_ok=True)
+
+    results = []
+    pending = []
+
+    # The stages are in topological order so the
+    # dependencies of a stage are decided before it
+    for name in stages:
+        if resume and not _is_stale(name, pending, interim_dir):
+            results.append({"stage": name, "status": "skipped"})
+            print(f"{name:<20} skipped (output exists)")
+        else:
+            pending.append(name)
+
+    # Anything not run here has to be on disk already
+    for name in pending:
+        for dep in STAGES[name]["deps"]:
+            if dep not in pending and not output_path(dep, interim_dir).exists():
+                raise FileNotFoundError(
+                    f"Stage '{name}' needs the output of '{dep}'. Run it first."
+                )
+
+    def _record(result):
+        result["status"] = "done"
+        results.append(result)
+        print(
+            f"{result['stage']:<20} {result['seconds']:>8.2f}s "
+            f"{result['rows']:>10} rows"
+        )
+
+    if jobs <= 1:
+        for name in pending:
+            _record(run_stage(name, options))
+
+    else:
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+
+            while pending or running:
+
+                # Ready once none of its dependencies is
+                # still waiting or running
+                waiting = set(pending) | set(running.values())
+                ready = [
+                    name
+                    for name in pending
+                    if not waiting.intersection(STAGES[name]["deps"])
+                ]
+
+                for name in ready:
+                    pending.remove(name)
+                    running[executor.submit(run_stage, name, options)] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    running.pop(future)
+                    _record(future.result())
+
+    return pd.DataFrame(results)
+
+
+def main(argv=None):
+
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(description="Run the e-commerce pipeline.")
+    parser.add_argument("--from", dest="start", choices=list(STAGES), default=None)
+    parser.add_argument("--until", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument(
+        "--resume", action="store_true", help="Skip stages with a persisted output"
+    )
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--raw-dir", default=str(RAW_DIR))
+    parser.add_argument("--raw-file", default="Online Retail.xlsx")
+    parser.add_argument("--interim-dir", default=str(INTERIM_DIR))
+    parser.add_argument("--models-dir", default=str(PROJECT_DIR / "models"))
+    parser.add_argument("--n-clusters", type=int, default=4)
+    parser.add_argument("--random-state", type=int, default=0)
+    parser.add_argument(
+        "--csv", action="store_true", help="Also write the NB1 csv files"
+    )
+    parser.add_argument(
+        "--sample-frac",
+        type=float,
+        default=None,
+        help="Run on this share of the customers (stratified by country and spend)",
+    )
+    parser.add_argument("--sample-seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # A sample gets its own outputs so it never
+    # mixes with (or resumes from) a full run
+    interim_dir = Path(args.interim_dir)
+    if args.sample_frac is not None:
+        interim_dir = interim_dir / f"sample_{args.sample_frac:g}_{args.sample_seed}"
+
+    options = {
+        "raw_dir": args.raw_dir,
+        "raw_file": args.raw_file,
+        "interim_dir": str(interim_dir),
+        "models_dir": args.models_dir,
+        "n_clusters": args.n_clusters,
+        "random_state": args.random_state,
+        "csv": args.csv,
+        "sample_frac": args.sample_frac,
+        "sample_seed": args.sample_seed,
+    }
+
+    stages = select_stages(start=args.start, until=args.until)
+    start = time.perf_counter()
+    df_timing = run_pipeline(stages, options, jobs=args.jobs, resume=args.resume)
+
+    print()
+    print(df_timing.to_string(index=False))
+    print(f"Total: {time.perf_counter() - start:.2f}s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
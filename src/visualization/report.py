@@ -0,0 +1,319 @@
+"""
+REPORT Module
+-------------
+
+@author : Stratoshad
+
+This module contains functions that
+render a list of chart specifications
+headlessly into "reports/figures". The
+charts are rendered in a process pool
+and any chart whose data and spec
+haven't changed since the last run is
+skipped.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from src.data.profiling import instrument
+
+FIGURES_DIR = Path(__file__).resolve().parents[2] / "reports" / "figures"
+MANIFEST_NAME = ".report_manifest.json"
+
+# The chart functions each spec "kind" maps to
+# as (module, function name) so that workers
+# only import what they need
+CHART_KINDS = {
+    "histogram": ("src.visualization.visualize", "make_histogram"),
+    "barchart": ("src.visualization.visualize", "make_barchar"),
+    "scatter": ("src.visualization.visualize", "make_scatter"),
+    "elbow": ("src.models.modeling", "create_elbow_fig"),
+}
+
+# Chart kinds whose functions take the path and
+# only read the columns they plot (see
+# utils.select_columns). The others get the
+# loaded dataframe.
+PATH_KINDS = ["histogram", "barchart", "scatter"]
+
+
+def load_data(source):
+
+    """
+    Loads a dataframe from a path based
+    on its suffix (csv, parquet or pickle).
+    Dataframes are returned as they are.
+
+    Parameters:
+    -----------
+
+    source : str, Path or dataframe
+
+    The data to load
+
+    Returns:
+    --------
+
+    df : dataframe
+
+    The loaded dataframe
+
+    """
+
+    if isinstance(source, pd.DataFrame):
+        return source
+
+    suffix = Path(source).suffix.lower()
+
+    if suffix == ".parquet":
+        return pd.read_parquet(source)
+
+    if suffix in [".pkl", ".pickle"]:
+        return pd.read_pickle(source)
+
+    return pd.read_csv(source)
+
+
+def hash_spec(spec):
+
+    """
+    Creates a content hash of a chart
+    spec and its input data. For paths
+    it hashes the file contents and for
+    dataframes the values.
+
+    Parameters:
+    -----------
+
+    spec : dictionary
+
+    The chart spec
+
+    Returns:
+    --------
+
+    spec_hash : str
+
+    The hex digest of the spec
+
+    """
+
+    hasher = hashlib.sha256()
+    data = spec["data"]
+
+    if isinstance(data, pd.DataFrame):
+        hasher.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+        hasher.update(json.dumps([str(c) for c in data.columns]).encode())
+
+    else:
+        with open(data, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+
+    spec_info = {k: v for k, v in spec.items() if k != "data"}
+    hasher.update(json.dumps(spec_info, sort_keys=True, default=str).encode())
+
+    return hasher.hexdigest()
+
+
+def render_spec(spec, out_dir=FIGURES_DIR):
+
+    """
+    Builds a single chart from its spec and
+    writes it to the output folder. This is
+    what runs inside every worker.
+
+    Parameters:
+    -----------
+
+    spec : dictionary
+
+    The chart spec with the keys:
+
+    - "name" : the output file name
+    - "kind" : one of CHART_KINDS
+    - "data" : a path or a dataframe
+    - "kwargs" : arguments of the chart function
+    - "formats" : e.g. ["html", "png"]
+
+    out_dir : str (default = "<project>/reports/figures")
+
+    The output folder
+
+    Returns:
+    --------
+
+    result : dictionary
+
+    The name, written files and formats,
+    time taken and any errors of the chart
+
+    """
+
+    import importlib
+
+    start = time.perf_counter()
+    module_name, func_name = CHART_KINDS[spec["kind"]]
+    chart_func = getattr(importlib.import_module(module_name), func_name)
+
+    if spec["kind"] in PATH_KINDS:
+        data = spec["data"]
+    else:
+        data = load_data(spec["data"])
+
+    fig = chart_func(data, **spec.get("kwargs", {}))
+
+    files = []
+    formats = []
+    errors = []
+
+    for fmt in spec.get("formats", ["html", "png"]):
+
+        path = os.path.join(out_dir, f"{spec['name']}.{fmt}")
+
+        if fmt == "html":
+            fig.write_html(path, include_plotlyjs="cdn")
+            files.append(path)
+            formats.append(fmt)
+            continue
+
+        # Static images need an image export engine
+        # (kaleido or orca). If it is missing we still
+        # keep the html output and report the error.
+        try:
+            fig.write_image(path)
+            files.append(path)
+            formats.append(fmt)
+        except Exception as e:
+            errors.append(f"{fmt}: {e}")
+
+    return {
+        "name": spec["name"],
+        "files": files,
+        "formats": formats,
+        "errors": errors,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+@instrument
+def build_report(specs, out_dir=FIGURES_DIR, max_workers=None, force=False):
+
+    """
+    Renders a list of chart specs in a
+    process pool and writes them to the
+    output folder. Charts whose content
+    hash matches the last run are skipped.
+
+    Parameters:
+    -----------
+
+    specs : list
+
+    List of chart specs (see render_spec)
+
+    out_dir : str (default = "<project>/reports/figures")
+
+    The output folder
+
+    max_workers : int (default = None)
+
+    The number of worker processes. If
+    None uses the number of CPUs.
+
+    force : bool (default = False)
+
+    Render every chart even if it
+    hasn't changed
+
+    Returns:
+    --------
+
+    df_report : dataframe
+
+    One row per chart with its status
+    ("rendered", "skipped" or "failed"),
+    time taken and written files
+
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError("Every chart spec needs a unique name.")
+
+    results = []
+    to_render = {}
+
+    # Work out which charts changed
+    for spec in specs:
+
+        if spec["kind"] not in CHART_KINDS:
+            raise ValueError(
+                f"Unknown chart kind '{spec['kind']}'. Use one of {list(CHART_KINDS)}."
+            )
+
+        spec_hash = hash_spec(spec)
+        entry = manifest.get(spec["name"], {})
+        files = entry.get("files", [])
+        files_exist = len(files) > 0 and all(os.path.exists(p) for p in files)
+
+        if (not force) and entry.get("hash") == spec_hash and files_exist:
+            results.append(
+                {"name": spec["name"], "status": "skipped", "files": entry["files"]}
+            )
+        else:
+            to_render[spec["name"]] = (spec, spec_hash)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        futures = {
+            name: executor.submit(render_spec, spec, out_dir)
+            for name, (spec, _) in to_render.items()
+        }
+
+        for name, future in futures.items():
+
+            try:
+                result = future.result()
+            except Exception as e:
+                results.append({"name": name, "status": "failed", "errors": [str(e)]})
+                continue
+
+            result["status"] = "failed" if len(result["files"]) == 0 else "rendered"
+            results.append(result)
+
+            # Record the formats that were written. A format
+            # that failed (e.g. png without an image export
+            # engine) would fail again for the same spec so
+            # it doesn't stop the chart from being skipped.
+            # Use force=True to retry it.
+            if len(result["files"]) > 0:
+                manifest[name] = {
+                    "hash": to_render[name][1],
+                    "files": result["files"],
+                    "formats": result["formats"],
+                }
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    df_report = pd.DataFrame(results).set_index("name").reindex(names).reset_index()
+
+    return df_report
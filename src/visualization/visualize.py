@@ -11,10 +11,270 @@ return the figure.
 
 """
 
-import plotly.express as px
+import warnings
+
+import numpy as np
+import pandas as pd
 from src.data import utils
+from src.data.profiling import instrument
+
+# The most classes a density scatter colors.
+# The smaller classes are merged into "Other"
+# (one grid of counts is kept per class).
+MAX_DENSITY_CLASSES = 10
+OTHER_COLOR = "rgb(150, 150, 150)"
+
+
+def _get_box_stats(values, codes, n_groups):
+
+    """
+    Calculates the box-plot statistics
+    (quartiles and Tukey fences) of the
+    values for every group code
+    """
+
+    df_vals = pd.DataFrame({"code": codes, "value": values})
+    grouped = df_vals.groupby("code")["value"]
+    quarts = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    quarts = quarts.reindex(range(n_groups))
+    q1, med, q3 = (quarts[q].values for q in [0.25, 0.5, 0.75])
+
+    # Plotly draws the whiskers to the furthest
+    # points that are within 1.5 IQR of the box
+    iqr = q3 - q1
+    low_lim = (q1 - 1.5 * iqr)[codes]
+    high_lim = (q3 + 1.5 * iqr)[codes]
+    lower = df_vals["value"].where(values >= low_lim).groupby(codes).min()
+    upper = df_vals["value"].where(values <= high_lim).groupby(codes).max()
+
+    return {
+        "q1": q1,
+        "median": med,
+        "q3": q3,
+        "lowerfence": lower.reindex(range(n_groups)).values,
+        "upperfence": upper.reindex(range(n_groups)).values,
+    }
+
+
+def _make_binned_histogram(values, groups, color, col_name, title, marginal, nbins):
+
+    """
+    Builds a histogram (and optionally a
+    box marginal) from bin counts computed
+    with numpy. Only the aggregates end up
+    in the figure so its size doesn't
+    depend on the number of rows.
+    """
+
+    import plotly.graph_objects as go
+    import plotly.io as pio
+    from plotly.subplots import make_subplots
+
+    if marginal not in [None, "box"]:
+        raise ValueError("Pre-binned histograms only support marginal='box' or None.")
+
+    values = np.asarray(values, dtype=float)
+    mask = ~np.isnan(values)
+
+    if groups is None:
+        codes = np.zeros(values.shape[0], dtype=int)
+        names = [col_name]
+        colors = [color]
+    else:
+        codes, names = pd.factorize(groups, sort=True)
+        mask &= codes >= 0
+        colorway = pio.templates["ggplot2"].layout.colorway
+        colors = [colorway[i % len(colorway)] for i in range(len(names))]
+
+    values = values[mask]
+    codes = codes[mask]
+    n_groups = len(names)
+
+    # Count every (group, bin) pair in a single bincount
+    edges = np.histogram_bin_edges(values, bins=nbins)
+    n_bins = len(edges) - 1
+    bin_idx = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, n_bins - 1)
+    counts = np.bincount(codes * n_bins + bin_idx, minlength=n_groups * n_bins)
+    counts = counts.reshape(n_groups, n_bins)
+
+    centers = (edges[:-1] + edges[1:]) / 2
+    widths = np.diff(edges)
+
+    if marginal == "box":
+        fig = make_subplots(
+            rows=2,
+            cols=1,
+            shared_xaxes=True,
+            row_heights=[0.26, 0.74],
+            vertical_spacing=0.03,
+        )
+        box_stats = _get_box_stats(values, codes, n_groups)
+        hist_row = 2
+    else:
+        fig = make_subplots(rows=1, cols=1)
+        hist_row = 1
+
+    for i, name in enumerate(names):
+
+        fig.add_trace(
+            go.Bar(
+                x=centers,
+                y=counts[i],
+                width=widths,
+                name=str(name),
+                legendgroup=str(name),
+                marker_color=colors[i],
+                showlegend=groups is not None,
+            ),
+            row=hist_row,
+            col=1,
+        )
+
+        if marginal == "box":
+            fig.add_trace(
+                go.Box(
+                    y=[str(name)],
+                    orientation="h",
+                    q1=[box_stats["q1"][i]],
+                    median=[box_stats["median"][i]],
+                    q3=[box_stats["q3"][i]],
+                    lowerfence=[box_stats["lowerfence"][i]],
+                    upperfence=[box_stats["upperfence"][i]],
+                    name=str(name),
+                    legendgroup=str(name),
+                    marker_color=colors[i],
+                    showlegend=False,
+                ),
+                row=1,
+                col=1,
+            )
+
+    fig.update_layout(
+        title=title, template="ggplot2", barmode="relative", bargap=0,
+    )
+    fig.update_xaxes(title=col_name, row=hist_row, col=1)
+    fig.update_yaxes(title="count", row=hist_row, col=1)
+
+    if marginal == "box":
+        fig.update_yaxes(showticklabels=False, row=1, col=1)
+
+    return fig
 
 
+def _make_density_trace(x, y, groups, color, grid_size):
+
+    """
+    Aggregates the points onto a pixel grid
+    and returns a heatmap trace. Every pixel
+    takes the color of the class with the
+    most points in it and gets darker the
+    more points it holds (log scale).
+    Numeric groups with more than
+    MAX_DENSITY_CLASSES values are drawn
+    in one color and other groups keep
+    their largest classes.
+    """
+
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    mask = ~(np.isnan(x) | np.isnan(y))
+
+    colorway = pio.templates["ggplot2"].layout.colorway
+
+    if groups is not None:
+        codes, names = pd.factorize(groups, sort=True)
+        names = list(names)
+
+        # A continuous column (e.g. total_spend)
+        # has no meaningful classes
+        if len(names) > MAX_DENSITY_CLASSES and pd.api.types.is_numeric_dtype(
+            pd.Series(groups).dtype
+        ):
+            warnings.warn(
+                f"Too many values to color the density by ({len(names)}). "
+                "Using a single color."
+            )
+            groups, color = None, colorway[0]
+
+    if groups is None:
+        codes = np.zeros(x.shape[0], dtype=int)
+        names = [None]
+        colors = [color]
+    else:
+        mask &= codes >= 0
+
+        # Keep the largest classes (in sorted
+        # order) and merge the rest
+        merged = len(names) > MAX_DENSITY_CLASSES
+        if merged:
+            n_keep = MAX_DENSITY_CLASSES - 1
+            sizes = np.bincount(codes[codes >= 0], minlength=len(names))
+            keep = np.sort(np.argsort(-sizes, kind="stable")[:n_keep])
+            remap = np.full(len(names), n_keep)
+            remap[keep] = np.arange(n_keep)
+            codes = np.where(codes >= 0, remap[codes], -1)
+            names = [names[i] for i in keep] + ["Other"]
+
+        colors = [colorway[i % len(colorway)] for i in range(max(len(names), 1))]
+        if merged:
+            colors[-1] = OTHER_COLOR
+
+    x, y, codes = x[mask], y[mask], codes[mask]
+    n_groups = len(colors)
+    n_x, n_y = grid_size
+
+    # Without any points the grid is just empty
+    x_range = (x.min(), x.max()) if x.shape[0] > 0 else (0.0, 1.0)
+    y_range = (y.min(), y.max()) if y.shape[0] > 0 else (0.0, 1.0)
+    x_edges = np.linspace(*x_range, n_x + 1)
+    y_edges = np.linspace(*y_range, n_y + 1)
+    x_idx = np.clip(np.searchsorted(x_edges, x, side="right") - 1, 0, n_x - 1)
+    y_idx = np.clip(np.searchsorted(y_edges, y, side="right") - 1, 0, n_y - 1)
+
+    # One bincount gives the counts of every
+    # (class, y pixel, x pixel) combination
+    flat_idx = (codes * n_y + y_idx) * n_x + x_idx
+    counts = np.bincount(flat_idx, minlength=n_groups * n_y * n_x)
+    counts = counts.reshape(n_groups, n_y, n_x)
+
+    total = counts.sum(axis=0)
+    dominant = counts.argmax(axis=0)
+    intensity = np.log1p(total) / np.log1p(max(total.max(), 1))
+
+    # Each class owns the [i, i + 1) range of z so a
+    # single colorscale covers every class. Plotly
+    # blends from white to the class color in that
+    # range and z starts a quarter of the way in so
+    # the lightest pixels are a light version of the
+    # color. Any color plotly knows (e.g. names)
+    # works without converting it.
+    z = np.where(total > 0, dominant + 0.25 + 0.749 * intensity, np.nan)
+
+    colorscale = []
+    for i, col in enumerate(colors):
+        colorscale.append([i / n_groups, "rgb(255, 255, 255)"])
+        colorscale.append([(i + 1) / n_groups - 1e-9, col])
+    colorscale[-1][0] = 1.0
+
+    trace = go.Heatmap(
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        z=z,
+        zmin=0,
+        zmax=n_groups,
+        text=total,
+        colorscale=colorscale,
+        showscale=False,
+        hovertemplate="x: %{x}<br>y: %{y}<br>points: %{text}<extra></extra>",
+    )
+
+    return trace, names, colors
+
+
+@instrument
 def make_histogram(
     df,
     col_name,
@@ -24,6 +284,8 @@ def make_histogram(
     cap=False,
     q_cap=0.95,
     marginal="box",
+    prebinned=False,
+    nbins=50,
 ):
 
     """
@@ -35,9 +297,12 @@ def make_histogram(
     Parameters:
     -----------
     
-    df : dataframe
+    df : dataframe, str or pyarrow Table
     
-    The dataframe to plot
+    The dataframe to plot. It can also be
+    a path to a csv / parquet file or an
+    Arrow table in which case only the
+    columns needed are read.
     
     col_name : string 
     
@@ -74,6 +339,21 @@ def make_histogram(
     provided it doesn't plot any. Takes
     standard inputs of px.histogram()
     
+    prebinned : bool (default = False)
+    
+    If True the bin counts (and box-plot
+    quartiles) are calculated with numpy
+    and only those are plotted. Use this
+    for large dataframes as the figure
+    size stays the same however many rows
+    go in. Hover columns are not shown and
+    only the "box" marginal is supported.
+    
+    nbins : int (default = 50)
+    
+    The number of bins when prebinned
+    is True
+    
     Returns:
     
     fig : plotly figure
@@ -82,16 +362,45 @@ def make_histogram(
     
     """
 
-    df_plot = df.copy()
+    import plotly.express as px
 
     if title is None:
         title = f"Distribution of {col_name}"
 
+    # Only keep the columns the chart needs
+    # before doing anything else
+    hover_list = [] if hover_cols is None else list(hover_cols)
+    plot_cols = [col_name] + ([] if prebinned else hover_list)
+    df_plot = utils.select_columns(df, plot_cols, optional=[color])
+
     # Check whether the column requires
     # cap. If yes then cap it using the
     # given percentile
     if cap:
-        df_plot[col_name] = utils.cap_col(df[col_name], q=q_cap)
+        capped = utils.cap_col(df_plot[col_name], q=q_cap)
+        df_plot = df_plot.assign(**{col_name: capped})
+
+    if prebinned:
+
+        values = df_plot[col_name]
+        groups = df_plot[color].values if color in df_plot.columns else None
+
+        fig = _make_binned_histogram(
+            values=values.values,
+            groups=groups,
+            color=color,
+            col_name=col_name,
+            title=title,
+            marginal=marginal,
+            nbins=nbins,
+        )
+
+        fig.update_traces(
+            marker_line_color="rgb(45, 46, 45)", marker_line_width=1.5, opacity=0.9,
+        )
+        fig.update_layout(title_font_size=14, font_size=10)
+
+        return fig
 
     if color in df_plot.columns:
 
@@ -129,6 +438,7 @@ def make_histogram(
     return fig
 
 
+@instrument
 def make_barchar(df, x_axis, y_axis, color, text_col=None, title=None):
 
     """
@@ -140,9 +450,10 @@ def make_barchar(df, x_axis, y_axis, color, text_col=None, title=None):
     Parameters:
     -----------
     
-    df : dataframe
+    df : dataframe, str or pyarrow Table
     
-    The dataframe to plot
+    The dataframe to plot (or a path to
+    a csv / parquet file or an Arrow table)
     
     x_axis : str
     
@@ -172,7 +483,9 @@ def make_barchar(df, x_axis, y_axis, color, text_col=None, title=None):
     
     """
 
-    df_plot = df.copy()
+    import plotly.express as px
+
+    df_plot = utils.select_columns(df, [x_axis, y_axis, text_col])
 
     # Check whether a title was passed
     # if not just create a generic title
@@ -199,8 +512,19 @@ def make_barchar(df, x_axis, y_axis, color, text_col=None, title=None):
     return fig
 
 
+@instrument
 def make_scatter(
-    df, x_axis, y_axis, title, color_by, x_axis_title=None, y_axis_title=None
+    df,
+    x_axis,
+    y_axis,
+    title,
+    color_by,
+    x_axis_title=None,
+    y_axis_title=None,
+    render_mode="auto",
+    webgl_threshold=5000,
+    density_threshold=500000,
+    grid_size=(400, 300),
 ):
 
     """
@@ -209,9 +533,10 @@ def make_scatter(
     
     Parameters:
     
-    df : dataframe
+    df : dataframe, str or pyarrow Table
     
-    The dataframe to plot from
+    The dataframe to plot from (or a path
+    to a csv / parquet file or an Arrow table)
     
     x_axis : str
     
@@ -233,6 +558,33 @@ def make_scatter(
     
     The y_axis title
     
+    render_mode : str (default = "auto")
+    
+    How to draw the points. One of:
+    
+    - "svg" : one SVG marker per point
+    - "webgl" : markers drawn with WebGL
+    - "density" : the points are counted
+      on a pixel grid and drawn as a heatmap
+      colored by the dominant class
+    - "auto" : picks one of the above
+      based on the number of rows
+    
+    webgl_threshold : int (default = 5000)
+    
+    Above this number of rows "auto"
+    switches to WebGL
+    
+    density_threshold : int (default = 500,000)
+    
+    Above this number of rows "auto"
+    switches to the density mode
+    
+    grid_size : tuple (default = (400, 300))
+    
+    The number of (x, y) pixels of
+    the density mode
+    
     Returns:
     --------
     
@@ -242,7 +594,10 @@ def make_scatter(
     
     """
 
-    df_plot = df.copy()
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    df_plot = utils.select_columns(df, [x_axis, y_axis], optional=[color_by])
 
     if x_axis_title is None:
         x_axis_title = x_axis
@@ -250,22 +605,69 @@ def make_scatter(
     if y_axis_title is None:
         y_axis_title = y_axis
 
-    if color_by not in df_plot.columns:
+    if render_mode == "auto":
+        if df_plot.shape[0] > density_threshold:
+            render_mode = "density"
+        elif df_plot.shape[0] > webgl_threshold:
+            render_mode = "webgl"
+        else:
+            render_mode = "svg"
+
+    if render_mode == "density":
+
+        groups = df_plot[color_by].values if color_by in df_plot.columns else None
+        trace, names, colors = _make_density_trace(
+            df_plot[x_axis].values, df_plot[y_axis].values, groups, color_by, grid_size
+        )
+
+        fig = go.Figure(trace)
+        fig.update_layout(title=title, template="ggplot2")
+
+        # Add empty traces so the legend
+        # still shows the class colors
+        if names != [None]:
+            for name, col in zip(names, colors):
+                fig.add_trace(
+                    go.Scatter(
+                        x=[None],
+                        y=[None],
+                        mode="markers",
+                        marker_color=col,
+                        name=str(name),
+                    )
+                )
+
+    elif color_by not in df_plot.columns:
 
         # Create the scatter plot figure
-        fig = px.scatter(df_plot, x=x_axis, y=y_axis, title=title, template="ggplot2")
+        fig = px.scatter(
+            df_plot,
+            x=x_axis,
+            y=y_axis,
+            title=title,
+            template="ggplot2",
+            render_mode=render_mode,
+        )
 
         fig.update_traces(marker_color=color_by)
     else:
 
         # Create the scatter plot figure
         fig = px.scatter(
-            df_plot, x=x_axis, y=y_axis, color=color_by, title=title, template="ggplot2"
+            df_plot,
+            x=x_axis,
+            y=y_axis,
+            color=color_by,
+            title=title,
+            template="ggplot2",
+            render_mode=render_mode,
         )
 
     # Update the layout and the traces
     # to keep a consistent look
-    fig.update_traces(marker_size=7, marker_line_width=0.5)
+    fig.update_traces(
+        marker_size=7, marker_line_width=0.5, selector=dict(mode="markers")
+    )
 
     fig.update_layout(
         xaxis_title=x_axis_title,